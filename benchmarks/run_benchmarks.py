@@ -0,0 +1,323 @@
+"""Benchmark the cleaning pipelines across data sizes.
+
+A DummyDataset is simulated for every combination of channel count, duration
+and sampling frequency of the sweep. Each pipeline variant of
+main_cleaner_pipelines is then run alone on the dataset, in a fresh process
+so its peak memory is not inherited from the previous runs. The results hold
+one record per variant (wall time, throughput, peak memory and size of the
+outputs) and one record per CleanerPipelines step, taken from the step
+metrics written by main.
+
+The results are saved as JSON and CSV in the output folder. When a baseline
+file exists, every record is compared to the matching record of the
+baseline and the script exits with an error if one of them is slower (or
+uses more memory) than the tolerance allows::
+
+    python benchmarks/run_benchmarks.py --channels 16 64 --durations 25 100
+    python benchmarks/run_benchmarks.py --save-baseline
+
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from cleaner_pipelines import OUTPUT_FORMATS
+from main_cleaner_pipelines import PIPELINE_VARIANTS, main
+from simulated_data import DummyDataset
+
+BENCHMARKS_PATH = Path(__file__).parent
+DEFAULT_BASELINE = BENCHMARKS_PATH.joinpath("baseline.json")
+RECORD_KEYS = ("kind", "name", "variant",
+               "n_channels", "duration", "sampling_frequency")
+COMPARED_METRICS = ("wall_time", "peak_memory")
+
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the arguments of the benchmark."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the cleaning pipelines across data sizes."
+    )
+    parser.add_argument("--channels", type=int, nargs="+", default=[16, 64],
+                        help="The channel counts of the sweep.")
+    parser.add_argument("--durations", type=float, nargs="+",
+                        default=[25, 100],
+                        help="The durations of the sweep in seconds.")
+    parser.add_argument("--sampling-frequencies", type=int, nargs="+",
+                        default=[1000, 5000],
+                        help="The sampling frequencies of the sweep in Hz.")
+    parser.add_argument("--variants", nargs="+",
+                        choices=list(PIPELINE_VARIANTS),
+                        default=list(PIPELINE_VARIANTS),
+                        help="The pipeline variants to run.")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="The number of runs of each variant. The fastest "
+                        "run is kept.")
+    parser.add_argument("--output", type=Path,
+                        default=BENCHMARKS_PATH.joinpath("results"),
+                        help="The folder of the results.")
+    parser.add_argument("--work-dir", type=Path, default=None,
+                        help="The folder of the simulated datasets. A "
+                        "temporary folder of the system by default.")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE,
+                        help="The results to compare to.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="The relative increase of a metric over the "
+                        "baseline reported as a regression.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Save the results as the new baseline.")
+    parser.add_argument("--random-state", type=int, default=42,
+                        help="The seed of the simulated datasets.")
+    return parser.parse_args(argv)
+
+
+def make_dataset(
+    work_dir: Path | None,
+    n_channels: int,
+    duration: float,
+    sampling_frequency: int,
+    random_state: int,
+) -> DummyDataset:
+    """Simulate the BIDS dataset of one benchmark case.
+
+    The dataset holds a single 'checker' recording so it is cleaned by main.
+    It is simulated inside the scanner (see simulate_eeg_fmri_data): the EEG
+    holds the gradient artifact of a 2 seconds TR with its R128 volume
+    markers and the BCG artifact following the ECG, as a real recording. The
+    EEG channels are named and positioned after the smallest biosemi montage
+    that fits them, so the 64 channels case has a full 10-20 cap.
+    """
+    dataset = DummyDataset(task="checker", root=work_dir, flush=False)
+    dataset.create_eeg_dataset(
+        fmt="eeglab",
+        simulator="eeg_fmri",
+        repetition_time=2.0,
+        heart_rate=70.0,
+        n_channels=n_channels,
+        duration=duration,
+        sampling_frequency=sampling_frequency,
+        random_state=random_state,
+    )
+    return dataset
+
+
+def _run_variant(
+    bids_path: str,
+    variant: str,
+) -> dict[str, float]:
+    """Run one variant with main and measure it.
+
+    It is executed in its own process, so the peak resident memory of the
+    process is the peak memory of the variant.
+    """
+    wall_start = time.perf_counter()
+    main(bids_path, variants={variant: PIPELINE_VARIANTS[variant]})
+    wall_time = time.perf_counter() - wall_start
+    return {
+        "wall_time": wall_time,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def _output_size(derivatives_path: Path) -> float:
+    """Get the size of the saved outputs of the derivatives in MB."""
+    return sum(
+        path.stat().st_size for path in derivatives_path.rglob("*")
+        if path.suffix in OUTPUT_FORMATS.values()
+        and "decoded" not in path.relative_to(derivatives_path).parts
+    ) / 1024**2
+
+
+def benchmark_variant(
+    dataset: DummyDataset,
+    variant: str,
+    n_samples: int,
+    repeats: int = 1,
+) -> list[dict]:
+    """Benchmark one variant on a dataset.
+
+    The derivatives are removed before each run so the runs are independent.
+    The fastest run is kept, for the variant as for each step. The throughput
+    of the variant is computed with n_samples, the number of samples of the
+    recording.
+
+    Returns:
+        list[dict]: The variant record followed by the step records.
+    """
+    bids_path = Path(dataset.bids_path)
+    derivatives_path = bids_path.parent.joinpath("DERIVATIVES")
+    context = multiprocessing.get_context("spawn")
+    variant_record, step_records = None, dict()
+    for _ in range(repeats):
+        shutil.rmtree(derivatives_path, ignore_errors=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            measures = pool.submit(_run_variant, str(bids_path), variant)
+            measures = measures.result()
+
+        if (variant_record is None
+                or measures["wall_time"] < variant_record["wall_time"]):
+            variant_record = dict(
+                kind="variant",
+                name=variant,
+                variant=variant,
+                n_samples=n_samples,
+                output_size=_output_size(derivatives_path),
+                **measures,
+            )
+
+        metrics = pd.read_json(derivatives_path.joinpath("step_metrics.jsonl"),
+                               lines=True)
+        steps = metrics.groupby("step").agg(
+            wall_time=("wall_time", "sum"),
+            cpu_time=("cpu_time", "sum"),
+            peak_memory=("peak_rss_delta", "max"),
+            n_samples=("n_samples_in", "sum"),
+        )
+        for step, measures in steps.iterrows():
+            if (step not in step_records
+                    or measures["wall_time"] < step_records[step]["wall_time"]):
+                step_records[step] = dict(
+                    kind="step",
+                    name=step,
+                    variant=variant,
+                    **measures.to_dict(),
+                )
+
+    shutil.rmtree(derivatives_path, ignore_errors=True)
+    records = [variant_record, *step_records.values()]
+    for record in records:
+        record["throughput"] = record["n_samples"] / record["wall_time"]
+    return records
+
+
+def run_benchmarks(
+    channels: list[int],
+    durations: list[float],
+    sampling_frequencies: list[int],
+    variants: list[str],
+    repeats: int = 1,
+    work_dir: Path | None = None,
+    random_state: int = 42,
+) -> pd.DataFrame:
+    """Run the whole sweep.
+
+    Returns:
+        pd.DataFrame: One row per variant and per step of every case.
+    """
+    records = list()
+    for n_channels, duration, sampling_frequency in itertools.product(
+        channels, durations, sampling_frequencies
+    ):
+        case = dict(n_channels=n_channels,
+                    duration=duration,
+                    sampling_frequency=sampling_frequency)
+        print(f"Benchmarking {case}")
+        dataset = make_dataset(work_dir, random_state=random_state, **case)
+        n_samples = int(round(duration * sampling_frequency))
+        try:
+            for variant in variants:
+                for record in benchmark_variant(dataset,
+                                                variant,
+                                                n_samples,
+                                                repeats):
+                    records.append({**case, **record})
+        finally:
+            dataset.flush(check=False)
+    return pd.DataFrame.from_records(records)
+
+
+def compare_to_baseline(
+    results: pd.DataFrame,
+    baseline: pd.DataFrame,
+    tolerance: float = 0.2,
+) -> pd.DataFrame:
+    """Compare the results to a baseline.
+
+    Args:
+        results (pd.DataFrame): The current results.
+        baseline (pd.DataFrame): The results of the reference version.
+        tolerance (float, optional): The relative increase of a metric
+            considered as a regression. Defaults to 0.2.
+
+    Returns:
+        pd.DataFrame: The records found in both, with the relative change of
+            each compared metric (NaN when the baseline is 0) and a
+            'regression' column.
+    """
+    comparison = results.merge(baseline,
+                               on=list(RECORD_KEYS),
+                               suffixes=("", "_baseline"))
+    regression = pd.Series(False, index=comparison.index)
+    for metric in COMPARED_METRICS:
+        reference = comparison[f"{metric}_baseline"]
+        change = comparison[metric] / reference.where(reference > 0) - 1
+        comparison[f"{metric}_change"] = change
+        regression |= change > tolerance
+    comparison["regression"] = regression
+    return comparison
+
+
+def save_results(results: pd.DataFrame, path: Path) -> None:
+    """Save the results as JSON with the description of the machine."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    document = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "records": results.to_dict(orient="records"),
+    }
+    with open(path, "w") as results_file:
+        json.dump(document, results_file, indent=2)
+
+
+def load_results(path: Path) -> pd.DataFrame:
+    """Load results saved by save_results."""
+    with open(path) as results_file:
+        return pd.DataFrame.from_records(json.load(results_file)["records"])
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    results = run_benchmarks(args.channels,
+                             args.durations,
+                             args.sampling_frequencies,
+                             args.variants,
+                             repeats=args.repeats,
+                             work_dir=args.work_dir,
+                             random_state=args.random_state)
+    timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    results_path = args.output.joinpath(f"benchmark_{timestamp}.json")
+    save_results(results, results_path)
+    results.to_csv(results_path.with_suffix(".csv"), index=False)
+    print(f"Results saved in {results_path}")
+
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        print(f"Baseline saved in {args.baseline}")
+    elif args.baseline.exists():
+        comparison = compare_to_baseline(results,
+                                         load_results(args.baseline),
+                                         args.tolerance)
+        comparison.to_csv(results_path.with_name(
+            f"comparison_{timestamp}.csv"
+        ), index=False)
+        regressions = comparison[comparison["regression"]]
+        if not regressions.empty:
+            print("Regressions compared to the baseline:")
+            print(regressions[[*RECORD_KEYS,
+                               "wall_time_change",
+                               "peak_memory_change"]].to_string(index=False))
+            sys.exit(1)
+        print("No regression compared to the baseline.")
@@ -0,0 +1,207 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+
+"""Persistent ASR calibrations shared by the runs of a session.
+
+Fitting ASR is a large share of its cost. The runs of a subject-session are
+recorded with the same cap so a single calibration can be fitted once,
+persisted, and reused to clean the other runs. This also makes the outputs
+more comparable across runs.
+
+A calibration only applies to data cleaned the same way: the calibrations of
+the variants are told apart by the process history of the data they were
+fitted on (e.g. GRAD_BCG for cbin_asr, GRAD_BCG_PREP for cbin_pyprep_asr).
+"""
+
+import contextlib
+import fcntl
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Generator
+
+import asrpy
+import numpy as np
+
+# Entities identifying the recordings that share a calibration.
+KEY_ENTITIES = ("subject", "session")
+
+
+class ASRCalibrationStore:
+    """Store of the ASR calibrations indexed by BIDS entities and history.
+
+    Each calibration is a .npz file holding the mixing (M) and threshold (T)
+    matrices of ASR along with the sampling frequency and the channel names
+    it was fitted on.
+    """
+    def __init__(
+        self,
+        root: str | os.PathLike,
+        key_entities: tuple[str, ...] = KEY_ENTITIES,
+    ) -> None:
+        """Initialize the store.
+
+        Args:
+            root (str | os.PathLike): The directory of the calibration files.
+            key_entities (tuple[str, ...], optional): The entities identifying
+                the recordings sharing a calibration. Defaults to
+                ("subject", "session").
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.key_entities = key_entities
+
+    def filename(
+        self,
+        entities: dict[str, Any],
+        process_history: list[str] | tuple[str, ...] = (),
+    ) -> Path:
+        """Get the calibration file of a recording.
+
+        Args:
+            entities (dict[str, Any]): The entities of the recording as
+                returned by BIDSFile.get_entities().
+            process_history (list[str] | tuple[str, ...], optional): The
+                process history of the data ASR is fitted on. It is added
+                as a desc label, e.g. desc-GradBcgPrep. Defaults to ().
+
+        Returns:
+            Path: The path of the calibration file.
+        """
+        labels = [
+            f"{entity[:3]}-{entities[entity]}"
+            for entity in self.key_entities if entity in entities
+        ]
+        if process_history:
+            labels.append(
+                "desc-" + "".join(label.capitalize()
+                                  for label in process_history)
+            )
+        return self.root.joinpath("_".join(labels + ["asr.npz"]))
+
+    @contextlib.contextmanager
+    def lock(
+        self,
+        entities: dict[str, Any],
+        process_history: list[str] | tuple[str, ...] = (),
+    ) -> Generator[None, None, None]:
+        """Hold an exclusive lock on the calibration of a recording.
+
+        It prevents several processes from fitting the same calibration.
+        """
+        lock_filename = self.filename(entities,
+                                      process_history).with_suffix(".lock")
+        with open(lock_filename, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def exists(
+        self,
+        entities: dict[str, Any],
+        process_history: list[str] | tuple[str, ...] = (),
+    ) -> bool:
+        """Check if a calibration exists for a recording."""
+        return self.filename(entities, process_history).is_file()
+
+    def save(
+        self,
+        entities: dict[str, Any],
+        asr: asrpy.ASR,
+        ch_names: list[str],
+        process_history: list[str] | tuple[str, ...] = (),
+    ) -> Path:
+        """Persist the calibration of a fitted ASR.
+
+        Args:
+            entities (dict[str, Any]): The entities of the recording.
+            asr (asrpy.ASR): The fitted ASR.
+            ch_names (list[str]): The channels ASR was fitted on.
+            process_history (list[str] | tuple[str, ...], optional): The
+                process history of the data ASR was fitted on.
+
+        Returns:
+            Path: The path of the calibration file.
+        """
+        filename = self.filename(entities, process_history)
+        file_descriptor, temporary_filename = tempfile.mkstemp(
+            dir=self.root, suffix=".npz"
+        )
+        with os.fdopen(file_descriptor, "wb") as f:
+            np.savez(f,
+                     M=asr.M,
+                     T=asr.T,
+                     sfreq=asr.sfreq,
+                     cutoff=asr.cutoff,
+                     ch_names=np.array(ch_names))
+        os.replace(temporary_filename, filename)
+        return filename
+
+    def load(
+        self,
+        entities: dict[str, Any],
+        asr: asrpy.ASR,
+        ch_names: list[str],
+        process_history: list[str] | tuple[str, ...] = (),
+    ) -> asrpy.ASR:
+        """Set a persisted calibration on an ASR object.
+
+        Args:
+            entities (dict[str, Any]): The entities of the recording.
+            asr (asrpy.ASR): The ASR object to calibrate.
+            ch_names (list[str]): The channels ASR will be applied on.
+            process_history (list[str] | tuple[str, ...], optional): The
+                process history of the data ASR will be applied on.
+
+        Returns:
+            asrpy.ASR: The calibrated ASR object.
+
+        Raises:
+            ValueError: If the calibration was fitted on other channels, at
+                another sampling frequency or with another cutoff.
+        """
+        filename = self.filename(entities, process_history)
+        with np.load(filename) as calibration:
+            if list(calibration["ch_names"]) != list(ch_names):
+                raise ValueError(
+                    f"The ASR calibration {filename.name} was fitted on "
+                    "other channels."
+                )
+            if float(calibration["sfreq"]) != float(asr.sfreq):
+                raise ValueError(
+                    f"The ASR calibration {filename.name} was fitted at "
+                    "another sampling frequency."
+                )
+            if float(calibration["cutoff"]) != float(asr.cutoff):
+                raise ValueError(
+                    f"The ASR calibration {filename.name} was fitted with "
+                    "another cutoff."
+                )
+            asr.M = calibration["M"]
+            asr.T = calibration["T"]
+        asr._fitted = True
+        return asr
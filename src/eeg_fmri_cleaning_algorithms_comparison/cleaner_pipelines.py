@@ -31,57 +31,443 @@ the homemade pipelines (called here CBIN-CLEANER). Once this first step is done,
 the data can be further cleaned by either using ASR and/or PyPrep algorithms.
 """
 
+import copy
+import fcntl
+import json
 import os
 import shutil
+import tempfile
+import threading
 from pathlib import Path
+from typing import Any
 
 import asrpy
 import bids
+import joblib
 import mne
 import numpy as np
+import pandas as pd
 import pyprep
-from decorators import pipe
+from asr_calibration import ASRCalibrationStore
+from asrpy.asr import asr_process
+from compressed_storage import write_raw_hdf5
+from decode_cache import DecodeCache
+from delta_storage import DELTA_SUFFIX, write_raw_delta
+from decorators import cached, instrumented, pipe
 from eeg_fmri_cleaning.main import clean_bcg, clean_gradient
 from eeg_fmri_cleaning.utils import read_raw_eeg
+from raw_writer import (
+    FSYNC_POLICIES,
+    WRITE_FORMATS,
+    AsyncRawWriter,
+    write_raw_atomic,
+)
+from recording_descriptor import (
+    RecordingDescriptor,
+    make_directories,
+)
 from simulated_data import simulate_eeg_data
+from step_cache import StepCache, file_digest
 
 
 
 
+SAVE_POLICIES = ("every_step", "final_only", "selected_steps")
+READ_MODES = ("preload", "lazy", "memmap")
+# Precision of the data held between the steps.
+PRECISIONS = ("double", "single")
+# Extension of the saved files of each output format.
+OUTPUT_FORMATS = {"fif": ".fif", "hdf5": ".h5"}
+
+
+def _read_only_view(data: np.ndarray) -> np.ndarray:
+    """Get a read-only view of the buffer of an array."""
+    view = data.view()
+    view.flags.writeable = False
+    return view
+
+
+class _DataShare:
+    """Count of the holders of a data buffer shared copy-on-write.
+
+    The holders are the pipelines holding a read-only view of the buffer and
+    the background writes of it that are not done yet. The count is only
+    increased by the pipeline thread but the writer thread decreases it, so
+    it is protected by a lock.
+    """
+    def __init__(self) -> None:
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    @property
+    def holders(self) -> int:
+        """The number of holders of the buffer."""
+        with self._lock:
+            return self._holders
+
+    def acquire(self) -> None:
+        """Add a holder."""
+        with self._lock:
+            self._holders += 1
+
+    def release(self) -> None:
+        """Remove a holder."""
+        with self._lock:
+            self._holders -= 1
+
+
 class CleanerPipelines:
     """Class to clean the EEG data using different algorithms."""
-    def __init__(self, BIDSFile: bids.layout.BIDSFile) -> None:  # noqa: D107
+    # Steps that never modify the data they receive in place. They read the
+    # data shared with the forks and with the pending background writes
+    # without copying it.
+    ASYNC_SAFE_STEPS = ("run_asr",)
+    # Step parameters that do not change the output of a step. They are left
+    # out of the step cache keys.
+    CACHE_IGNORED_PARAMETERS = ("n_jobs",)
+
+    def __init__(
+        self,
+        BIDSFile: bids.layout.BIDSFile | RecordingDescriptor,
+        step_cache: StepCache | None = None,
+        save_policy: str = "every_step",
+        saved_steps: list[str] | None = None,
+        async_save: bool = False,
+        read_mode: str = "preload",
+        decode_cache: DecodeCache | None = None,
+        write_format: str = "single",
+        fsync_policy: str = "none",
+        split_size: str | int = "2GB",
+        write_queue_size: int = 2,
+        output_format: str = "fif",
+        delta_storage: bool = False,
+        precision: str = "double",
+    ) -> None:
+        """Initialize the pipeline for a single file.
+
+        Args:
+            BIDSFile (bids.layout.BIDSFile | RecordingDescriptor): The file
+                to clean. Its entities and paths are resolved once in a
+                RecordingDescriptor.
+            step_cache (StepCache, optional): The cache of the steps outputs.
+            save_policy (str, optional): When the steps outputs are saved.
+                'every_step' saves after each step, 'final_only' only saves
+                when save_final is called at the end of a variant and
+                'selected_steps' saves after the steps listed in saved_steps.
+                Defaults to 'every_step'.
+            saved_steps (list[str], optional): The process labels (GRAD, BCG,
+                PREP, ASR...) after which the output is saved with the
+                'selected_steps' policy.
+            async_save (bool, optional): Write the FIF files in a background
+                thread. Call close to wait for the writes. Defaults to False.
+            read_mode (str, optional): How the recording is read, see
+                read_raw. Defaults to 'preload'.
+            decode_cache (DecodeCache, optional): The cache of the decoded
+                recordings. If None, the recording is parsed on every read in
+                the preload mode, and the lazy and memmap modes use the cache
+                of DERIVATIVES/decoded.
+            write_format (str, optional): The precision of the saved data,
+                'single' or 'double'. Defaults to 'single'.
+            fsync_policy (str, optional): When the saved files are flushed to
+                the storage, see raw_writer.write_raw_atomic.
+                Defaults to 'none'.
+            split_size (str | int, optional): The maximum size of each saved
+                FIF file. Defaults to '2GB'.
+            write_queue_size (int, optional): The maximum number of outputs
+                waiting to be written by the background thread.
+                Defaults to 2.
+            output_format (str, optional): 'fif' saves the outputs as FIF
+                files, 'hdf5' as compressed HDF5 files that can be read by
+                channel and time window (see compressed_storage).
+                Defaults to 'fif'.
+            delta_storage (bool, optional): Save the output of a step as its
+                changes to the last saved output of the variant, in a delta
+                file (see delta_storage). The first saved output uses the
+                output format. Defaults to False.
+            precision (str, optional): 'single' keeps the data in float32
+                between the steps, which halves the memory of the recordings
+                held by the pipeline (forks, outputs waiting to be written).
+                The steps whose algorithms need float64 work on a float64
+                copy, see _materialize. Defaults to 'double'.
+        """
+        if save_policy not in SAVE_POLICIES:
+            raise ValueError(
+                f"The save policy must be one of {', '.join(SAVE_POLICIES)}."
+            )
+        if read_mode not in READ_MODES:
+            raise ValueError(
+                f"The read mode must be one of {', '.join(READ_MODES)}."
+            )
+        if write_format not in WRITE_FORMATS:
+            raise ValueError(
+                f"The write format must be one of {', '.join(WRITE_FORMATS)}."
+            )
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(
+                f"The fsync policy must be one of {', '.join(FSYNC_POLICIES)}."
+            )
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"The output format must be one of {', '.join(OUTPUT_FORMATS)}."
+            )
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"The precision must be one of {', '.join(PRECISIONS)}."
+            )
+        if not isinstance(BIDSFile, RecordingDescriptor):
+            BIDSFile = RecordingDescriptor.from_bids_file(BIDSFile)
         self.BIDSFile = BIDSFile
-        self.entities = BIDSFile.get_entities()
-        self.rawdata_path = Path(BIDSFile.path)
+        self.step_cache = step_cache
+        self.save_policy = save_policy
+        self.saved_steps = list(saved_steps or [])
+        self.raw_writer = (
+            AsyncRawWriter(max_pending=write_queue_size) if async_save else None
+        )
+        self.write_format = write_format
+        self.fsync_policy = fsync_policy
+        self.split_size = split_size
+        self.output_format = output_format
+        self.delta_storage = delta_storage
+        self.precision = precision
+        self.read_mode = read_mode
+        self.decode_cache = decode_cache
+        self._saved_history = list()
+        # The read-only view of the data shared with the forks and the
+        # background writes, and the count of its holders, see _share_raw.
+        self._shared_data = None
+        self._data_share = None
+        self.step_metrics = list()
+        self.entities = BIDSFile.entities
+        self.rawdata_path = BIDSFile.path
         self.process_history = list()
+        # The step cache key of the last cached step, chained in the key of
+        # the next one (see decorators.cached).
+        self._step_cache_key = None
         self._make_derivatives_path()
+        if self.decode_cache is None and read_mode != "preload":
+            # The lazy and memmap modes read the decoded FIF copy, so the
+            # recording goes through read_raw_eeg as in the preload mode.
+            self.decode_cache = DecodeCache(
+                self.derivatives_path.joinpath("decoded")
+            )
+
+    def fork(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Create an independent copy of the pipeline at its current state.
+
+        It is used at the branch points of a pipeline tree so the steps shared
+        by several variants (e.g. reading and CBIN cleaning) run only once. The
+        child gets its own copy of the process history and of the raw object,
+        but the loaded data buffer is shared copy-on-write: the parent and the
+        child hold read-only views of it and it is only copied when one of
+        them runs a step that could modify it in place (see _own_data). The
+        child keeps the step cache key of the parent, so its keys chain the
+        lineage of the shared steps. The step metrics are shared so they are
+        exported once per file.
+
+        Returns:
+            CleanerPipelines: The forked pipeline.
+        """
+        self._release_shared_data()
+        child = copy.copy(self)
+        child.process_history = list(self.process_history)
+        child._step_cache_key = self._step_cache_key
+        child._data_share = child._shared_data = None
+        if hasattr(self, "raw"):
+            child.raw, child._shared_data = self._share_raw()
+            if child._shared_data is not None:
+                child._data_share = self._data_share
+        return child
+
+    def _share_raw(
+        self: "CleanerPipelines",
+    ) -> tuple[mne.io.BaseRaw, np.ndarray | None]:
+        """Copy the raw object without copying its data.
+
+        The data of the pipeline is replaced by a read-only view and the copy
+        gets another read-only view of the same buffer. Its holder (a fork or
+        a pending background write) is added to the share of the buffer. The
+        info, annotations and other attributes are copied as by raw.copy. The
+        data that is not loaded in an array is copied with the raw object.
+
+        Returns:
+            tuple[mne.io.BaseRaw, np.ndarray | None]: The copy and its view
+                of the data, None if the data was copied.
+        """
+        data = getattr(self.raw, "_data", None)
+        if not self.raw.preload or not isinstance(data, np.ndarray):
+            return self.raw.copy(), None
+        if self._data_share is None:
+            self._shared_data = self.raw._data = _read_only_view(data)
+            self._data_share = _DataShare()
+        shared_data = _read_only_view(self._shared_data)
+        raw = copy.deepcopy(self.raw, memo={id(self._shared_data): shared_data})
+        self._data_share.acquire()
+        return raw, shared_data
+
+    def _release_shared_data(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Stop holding the shared data once a step replaced it.
+
+        It is called after each step, so the other holders know when they
+        are the last ones holding the buffer.
+        """
+        data = getattr(getattr(self, "raw", None), "_data", None)
+        if self._data_share is not None and data is not self._shared_data:
+            self._data_share.release()
+            self._data_share = self._shared_data = None
+        return self
+
+    def _own_data(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Make the data writable before a step that could modify it.
+
+        The shared buffer is copied if a fork or a pending background write
+        still holds it, in a scratch array if it is disk backed. The last
+        holder makes it writable again without a copy. Other read-only data
+        is always copied.
+        """
+        self._release_shared_data()
+        data = getattr(getattr(self, "raw", None), "_data", None)
+        if not isinstance(data, np.ndarray) or data.flags.writeable:
+            return self
+        share = self._data_share
+        if (
+            share is not None
+            and share.holders == 1
+            and isinstance(data.base, np.ndarray)
+            and data.base.flags.writeable
+        ):
+            data.flags.writeable = True
+        elif isinstance(data, np.memmap):
+            owned_data = self._make_scratch_array(data.shape)
+            owned_data[:] = data
+            self.raw._data = owned_data
+        else:
+            self.raw._data = data.copy()
+        if share is not None:
+            share.release()
+            self._data_share = self._shared_data = None
+        return self
+
+    def _cache_context(
+        self: "CleanerPipelines",
+        step_name: str,
+        parameters: dict[str, Any],
+    ) -> dict[str, Any]:
+        """Get the state of the pipeline that changes the output of a step.
+
+        It is added to the step cache key: the precision of the data and, for
+        ASR with the session calibration, the digest of the stored
+        calibration (None until it is fitted).
+
+        Args:
+            step_name (str): The name of the step.
+            parameters (dict[str, Any]): The parameters of the step.
+
+        Returns:
+            dict[str, Any]: The state by name.
+        """
+        context = {"precision": self.precision}
+        if step_name == "run_asr" and parameters.get("calibration") == "session":
+            filename = ASRCalibrationStore(
+                self.derivatives_path.joinpath("asr_calibration")
+            ).filename(self.entities, self.process_history)
+            context["asr_calibration"] = (
+                file_digest(filename) if filename.is_file() else None
+            )
+        return context
 
     def _task_is(self, task_name: str) -> bool:
-        return self.BIDSFile.get_entities()["task"] == task_name
+        return self.entities["task"] == task_name
 
+    @instrumented
     def read_raw(self: "CleanerPipelines") -> "CleanerPipelines":
-        """Read the raw EEG data using MNE."""
+        """Read the raw EEG data using MNE.
+
+        With the 'preload' read mode the whole recording is loaded in memory.
+        The 'lazy' mode only reads the header: the samples are read from the
+        file by the steps that need them (see _materialize), and the windows
+        of the streaming ASR are read one at a time. The 'memmap' mode loads
+        the recording in a disk backed array of the scratch folder, so only
+        the pages accessed by a step are resident and they can be released
+        by the system.
+
+        The recording is always decoded by read_raw_eeg, so every mode gives
+        the same data. With a decode cache, the recording is read from its
+        FIF copy, which is created on the first read. The lazy and memmap
+        modes need that copy: without a decode cache they use the one of
+        DERIVATIVES/decoded. The loaded data is then converted to the
+        precision of the pipeline.
+        """
         try:
-            self.raw = read_raw_eeg(self.BIDSFile.path)
+            if self.read_mode == "memmap":
+                filename = self._make_scratch_filename()
+                self.raw = self._read_source(preload=filename)
+                os.remove(filename)
+            else:
+                self.raw = self._read_source(
+                    preload=self.read_mode == "preload"
+                )
+            self._apply_precision()
         except Exception as e:
             print(f"Error while reading the raw data: {e}")
         return self
 
+    def _read_source(
+        self: "CleanerPipelines",
+        preload: bool | str,
+    ) -> mne.io.BaseRaw:
+        """Read the recording with the preload argument of MNE."""
+        if self.decode_cache is not None:
+            return self.decode_cache.read(self.BIDSFile.path, preload=preload)
+        return read_raw_eeg(self.BIDSFile.path)
+
+    def _materialize(
+        self: "CleanerPipelines",
+        keep_precision: bool = False,
+    ) -> "CleanerPipelines":
+        """Load the samples of a lazily read recording in memory.
+
+        It is called by the steps that need the whole recording, after the
+        step cache was checked, so a cached step never reads the samples.
+        The data held in single precision is converted to float64 for the
+        algorithms that filter it with MNE (CBIN and PyPrep), unless
+        keep_precision is True.
+
+        Args:
+            keep_precision (bool, optional): Keep the data in the precision
+                of the pipeline. Defaults to False.
+        """
+        if not self.raw.preload:
+            self.raw.load_data()
+        if not keep_precision and self.raw._data.dtype != np.float64:
+            self.raw._data = self.raw._data.astype(np.float64)
+        return self
+
+    def _apply_precision(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Convert the loaded data to the precision of the pipeline.
+
+        It is called after the reading and after each step. The data that is
+        not loaded, or is loaded in a disk backed array (memmap read mode,
+        streaming ASR), is left as is since it does not use the memory.
+        """
+        raw = getattr(self, "raw", None)
+        if (
+            self.precision == "single"
+            and raw is not None
+            and raw.preload
+            and not isinstance(raw._data, np.memmap)
+            and raw._data.dtype != np.float32
+        ):
+            raw._data = raw._data.astype(np.float32)
+        return self
+
     def _make_derivatives_path(self: "CleanerPipelines") -> "CleanerPipelines":
         """Create the path to save the cleaned files in the BIDS format.
 
         It is a file specific path that is generated based on the BIDSFile
         object.
         """
-        path_parts = list(self.rawdata_path.parts)
-        rawdata_dirname = [
-            name for name in path_parts if "raw" in name.lower()
-            ][0]
-        path_parts[path_parts.index(rawdata_dirname)] = "DERIVATIVES"
-        derivatives_path_parts = path_parts[:path_parts.index("DERIVATIVES")+1]
-        self.derivatives_path = Path(*derivatives_path_parts)
-        self.derivatives_path.mkdir(parents=True, exist_ok=True)
+        self.derivatives_path = self.BIDSFile.derivatives_path
+        make_directories([self.derivatives_path])
         return self
     
     def _make_process_path(self: "CleanerPipelines") -> "CleanerPipelines":
@@ -94,13 +480,8 @@ class CleanerPipelines:
             added_folder (str, optional): The folder to be added after the 
                                           derivatives one.
         """
-        if len(self.process_history) > 1:
-            added_folder = "_".join(self.process_history)
-        else:
-                added_folder = self.process_history[0]
-        
-        self.process_path = self.derivatives_path.joinpath(added_folder)
-        self.process_path.mkdir(parents=True, exist_ok=True)
+        self.process_path = self.BIDSFile.process_path(self.process_history)
+        make_directories([self.process_path])
         return self
     
                 
@@ -115,11 +496,10 @@ class CleanerPipelines:
                                           derivatives one.
         """
         if self.process_path:
-            self.subject_session_path = self.process_path.joinpath(
-                f"sub-{self.entities["subject"]}",
-                f"ses-{self.entities["session"]}"
+            self.subject_session_path = self.BIDSFile.subject_session_path(
+                self.process_history
             )
-            self.subject_session_path.mkdir(parents=True, exist_ok=True)
+            make_directories([self.subject_session_path])
             return self
         else:
             raise ValueError(
@@ -139,8 +519,11 @@ class CleanerPipelines:
             modality (str, optional): The modality used (eeg, mri, etc.)
         """
         if self.subject_session_path:
-            self.modality_path = self.subject_session_path.joinpath(modality)
-            self.modality_path.mkdir(parents=True, exist_ok=True)
+            self.modality_path = self.BIDSFile.modality_path(
+                self.process_history,
+                modality,
+            )
+            make_directories([self.modality_path])
             return self
         else:
             raise ValueError(
@@ -155,14 +538,11 @@ class CleanerPipelines:
             BIDSFile (bids.layout.models.BIDSFile): The BIDSFile object.
             where_to_copy (str | os.PathLike): The folder to copy the sidecar file.
         """
-        base_filename, _ = os.path.splitext(self.BIDSFile.filename)
-        source_sidecar_path = self.rawdata_path.parent
-        source_json_filename = source_sidecar_path.joinpath(
-            base_filename).with_suffix(".json")
+        source_json_filename = self.BIDSFile.sidecar_path
         print(source_json_filename)
         
         destination_json_filename = self.modality_path.joinpath(
-            base_filename).with_suffix(".json")
+            source_json_filename.name)
 
         if source_json_filename.is_file():
             shutil.copyfile(source_json_filename,
@@ -175,44 +555,254 @@ class CleanerPipelines:
         """Save the cleaned raw EEG data in the BIDS format."""
 
        
-        base_filename, _ = os.path.splitext(self.BIDSFile.filename)
-        saving_filename = base_filename + ".fif"
+        # The parent is the last output saved along the variant, it is
+        # written before by the same (possibly background) writer.
+        parent_filename = (
+            self.last_saved_filename
+            if self.delta_storage and self._saved_history
+            else None
+        )
+        extension = (
+            DELTA_SUFFIX if parent_filename is not None
+            else OUTPUT_FORMATS[self.output_format]
+        )
+        saving_filename = self.BIDSFile.base_filename + extension
         destination_filename = self.modality_path.joinpath(saving_filename)
-        self.raw.save(destination_filename, overwrite=True)
+        self.last_saved_filename = destination_filename
+        # The metrics of the write are filed under the state of the pipeline
+        # at the time of the save, the background writer runs after the next
+        # steps changed it.
+        n_channels, n_samples = len(self.raw.ch_names), self.raw.n_times
+        metrics_context = {
+            "process_history": "_".join(self.process_history),
+            "n_channels_in": n_channels,
+            "n_samples_in": n_samples,
+            "n_channels_out": n_channels,
+            "n_samples_out": n_samples,
+        }
+        if self.raw_writer is not None:
+            # The writer gets its own raw object sharing the data, so the next
+            # steps run during the write and copy the data before modifying
+            # it (see _own_data).
+            raw, shared_data = self._share_raw()
+            share = self._data_share if shared_data is not None else None
+            self.raw_writer.submit(self._write_shared_raw,
+                                   share,
+                                   raw,
+                                   destination_filename,
+                                   parent_filename,
+                                   obj=raw,
+                                   metrics_context=metrics_context)
+        else:
+            self._write_raw(self.raw,
+                            destination_filename,
+                            parent_filename,
+                            metrics_context=metrics_context)
         return self
 
+    def _write_shared_raw(
+        self: "CleanerPipelines",
+        share: _DataShare | None,
+        raw: mne.io.BaseRaw,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        """Write the data in the background and release its share.
+
+        Args:
+            share (_DataShare | None): The share of the data held by the
+                write, None if the data was copied.
+            raw (mne.io.BaseRaw): The data to write.
+            *args: The other arguments of _write_raw.
+            **kwargs: The keyword arguments of _write_raw.
+        """
+        try:
+            self._write_raw(raw, *args, **kwargs)
+        finally:
+            if share is not None:
+                share.release()
+
+    @instrumented
+    def _write_raw(
+        self: "CleanerPipelines",
+        raw: mne.io.BaseRaw,
+        destination_filename: str | os.PathLike,
+        parent_filename: str | os.PathLike | None = None,
+    ) -> None:
+        """Write the data to a file of the output format atomically.
+
+        With a parent file, the data is written as its changes to the parent.
+        """
+        if parent_filename is not None:
+            write_raw_delta(raw,
+                            parent_filename,
+                            destination_filename,
+                            fmt=self.write_format,
+                            fsync=self.fsync_policy)
+            return
+        if self.output_format == "hdf5":
+            write_raw_hdf5(raw,
+                           destination_filename,
+                           fmt=self.write_format,
+                           fsync=self.fsync_policy)
+            return
+        write_raw_atomic(raw,
+                         destination_filename,
+                         fmt=self.write_format,
+                         split_size=self.split_size,
+                         fsync=self.fsync_policy)
+
+    def _step_must_be_saved(self: "CleanerPipelines") -> bool:
+        """Check if the save policy requires to save the last step output."""
+        if self.save_policy == "every_step":
+            return True
+        if self.save_policy == "selected_steps":
+            return self.process_history[-1] in self.saved_steps
+        return False
+
+    def save(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Save the data and its sidecar in the folder of the process history.
+
+        The folders are only created by the first save of the process, or
+        beforehand for the whole dataset by make_directories.
+        """
+        self.process_path = self.BIDSFile.process_path(self.process_history)
+        self.subject_session_path = self.BIDSFile.subject_session_path(
+            self.process_history
+        )
+        self.modality_path = self.BIDSFile.modality_path(self.process_history)
+        make_directories([self.modality_path])
+        self._save_raw()
+        self._copy_sidecar()
+        self._saved_history = list(self.process_history)
+        return self
+
+    def save_final(self: "CleanerPipelines") -> "CleanerPipelines":
+        """Save the output of a variant if it was not saved by the last step."""
+        if self.process_history and self.process_history != self._saved_history:
+            self.save()
+        return self
+
+    def export_step_metrics(self: "CleanerPipelines") -> Path:
+        """Append the step metrics to step_metrics.jsonl next to report.txt.
+
+        Returns:
+            Path: The path of the metrics file.
+        """
+        filename = self.derivatives_path.joinpath("step_metrics.jsonl")
+        lines = "".join(
+            json.dumps(record) + "\n" for record in self.step_metrics
+        )
+        with open(filename, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(lines)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.step_metrics.clear()
+        return filename
+
+    def close(self: "CleanerPipelines") -> None:
+        """Wait for the background writes to finish.
+
+        Raises:
+            RuntimeError: If a background write failed.
+        """
+        if self.raw_writer is not None:
+            self.raw_writer.close()
+
     @pipe
+    @cached
     def run_clean_gradient_and_bcg(self: "CleanerPipelines") -> "CleanerPipelines":
         """Clean the gradient and BCG artifacts from the EEG data."""
+        self._materialize()
         self.raw = clean_gradient(self.raw)
         self.raw = clean_bcg(self.raw)
         self.process_history += ["GRAD","BCG"]
         return self
     @pipe
+    @cached
     def run_clean_gradient(self: "CleanerPipelines") -> "CleanerPipelines":
         """Clean the gradient artifacts from the EEG data."""
+        self._materialize()
         self.raw = clean_gradient(self.raw)
         self.process_history.append("GRAD")
         return self
 
     @pipe
+    @cached
     def run_clean_bcg(self: "CleanerPipelines") -> "CleanerPipelines":
         """Clean the BCG artifacts from the EEG data."""
+        self._materialize()
         self.raw = clean_bcg(self.raw)
         self.process_history.append("BCG")
         return self
 
     @pipe
+    @cached
+    def run_preview_resampling(
+        self: "CleanerPipelines",
+        sfreq: float = 250.0,
+        n_jobs: int = 1,
+    ) -> "CleanerPipelines":
+        """Resample the data to a low rate for a quick preview of a recording.
+
+        It is run after the gradient and BCG cleaning, which need the full
+        sampling rate, so the following steps (PyPrep, ASR) process an order
+        of magnitude fewer samples. MNE resamples in the frequency domain:
+        the frequencies above the Nyquist frequency of the new rate are
+        removed, which is the anti-aliasing filter. The annotations keep
+        their times. The outputs are saved in the folders of the PREVIEW
+        label so they are not mistaken for the full rate ones.
+
+        Args:
+            sfreq (float, optional): The sampling frequency of the preview in
+                Hz. Defaults to 250.
+            n_jobs (int, optional): The number of jobs of the resampling.
+                Defaults to 1.
+
+        Returns:
+            CleanerPipelines: The pipeline with the resampled data.
+
+        Raises:
+            ValueError: If sfreq is not lower than the sampling frequency of
+                the recording.
+        """
+        if sfreq >= self.raw.info["sfreq"]:
+            raise ValueError(
+                "The preview sampling frequency must be lower than the "
+                "sampling frequency of the recording."
+            )
+        self._materialize()
+        self.raw.resample(sfreq, npad="auto", n_jobs=n_jobs)
+        self.process_history.append("PREVIEW")
+        return self
+
+    @pipe
+    @cached
     def run_pyprep(self: "CleanerPipelines",
-                   montage_name = "easycap-M1") -> "CleanerPipelines":
+                   montage_name = "easycap-M1",
+                   n_jobs: int = 1,
+                   random_state: int | None = None) -> "CleanerPipelines":
         """Clean the EEG data using the PyPrep algorithm.
 
+        The filtering done by PyPrep (detrending and line noise removal) goes
+        through MNE, which dispatches its channels to the joblib workers of
+        the active parallel configuration. RANSAC draws random channel
+        subsets so the result is only reproducible with a fixed random_state.
+
         Args:
-            raw (mne.io.Raw): The raw EEG data.
+            montage_name (str, optional): The name of the standard montage.
+                Defaults to "easycap-M1".
+            n_jobs (int, optional): The number of joblib workers, -1 uses all
+                the cores. Defaults to 1.
+            random_state (int, optional): The seed of RANSAC.
+                Defaults to None.
 
         Returns:
-            mne.io.Raw: The cleaned EEG data.
+            CleanerPipelines: The pipeline with the cleaned data.
         """
+        self._materialize()
         montage = mne.channels.make_standard_montage(montage_name)
         self.raw.set_montage(montage, on_missing="ignore")
         prep_params = {
@@ -225,28 +815,244 @@ class CleanerPipelines:
         prep = pyprep.PrepPipeline(self.raw, 
                                    prep_params,
                                    montage,
-                                   channel_wise=True)
+                                   channel_wise=True,
+                                   random_state=random_state)
         # Pyprep doesn't like emg channels. I will need to submit an issue to
         # see if we can add the montage parameters in the pyprep configuration.
         
-        prep.fit()
+        with joblib.parallel_config(n_jobs=n_jobs):
+            prep.fit()
         self.raw = prep.raw
         self.process_history.append("PREP")
         return self
 
+    def _make_scratch_filename(self: "CleanerPipelines") -> str:
+        """Create an empty file in the scratch folder of the derivatives."""
+        scratch_path = self.derivatives_path.joinpath(".scratch")
+        scratch_path.mkdir(parents=True, exist_ok=True)
+        file_descriptor, filename = tempfile.mkstemp(dir=scratch_path,
+                                                     suffix=".dat")
+        os.close(file_descriptor)
+        return filename
+
+    def _make_scratch_array(
+        self: "CleanerPipelines",
+        shape: tuple[int, int],
+    ) -> np.memmap:
+        """Create a disk backed array in the scratch folder of the derivatives.
+
+        The file is removed right after being mapped, its space is released
+        when the array is garbage collected.
+        """
+        filename = self._make_scratch_filename()
+        array = np.memmap(filename, dtype=np.float64, mode="w+", shape=shape)
+        os.remove(filename)
+        return array
+
+    def _transform_asr_in_windows(
+        self: "CleanerPipelines",
+        asr: asrpy.ASR,
+        window_duration: float,
+        lookahead: float = 0.25,
+        stepsize: int = 32,
+        maxdims: float = 0.66,
+    ) -> mne.io.RawArray:
+        """Apply a fitted ASR to the data window by window.
+
+        The windows are read with get_data so only the current one is loaded
+        when the data is not preloaded. The filter, covariance and lookahead
+        states of ASR are carried from one window to the next, which gives the
+        same output as processing the whole recording at once. The cleaned
+        data is written in a disk backed array so the memory used does not
+        depend on the duration of the recording.
+
+        Args:
+            asr (asrpy.ASR): The calibrated ASR object.
+            window_duration (float): The duration of the windows in seconds.
+            lookahead (float, optional): The lookahead of ASR in seconds.
+            stepsize (int, optional): The number of samples between the
+                updates of the reconstruction matrix.
+            maxdims (float, optional): The maximum fraction of dimensions
+                that can be reconstructed.
+
+        Returns:
+            mne.io.RawArray: The cleaned data.
+        """
+        sfreq = self.raw.info["sfreq"]
+        n_times = self.raw.n_times
+        # The same channels as asrpy (picks="eeg"), the bad ones included.
+        picks = mne.pick_types(self.raw.info, eeg=True, exclude=())
+        window_samples = max(int(window_duration * sfreq), 1)
+        lookahead_samples = int(sfreq * lookahead)
+        cleaned_data = self._make_scratch_array((len(self.raw.ch_names),
+                                                 n_times))
+        states = dict(R=asr.R, Zi=asr.Zi, cov=asr.cov, carry=asr.carry)
+        # ASR outputs the data delayed by the lookahead.
+        output_start = -lookahead_samples
+        for start in range(0, n_times, window_samples):
+            stop = min(start + window_samples, n_times)
+            data = self.raw.get_data(start=start, stop=stop)
+            cleaned_data[:, start:stop] = data
+            eeg_data = data[picks]
+            if stop == n_times:
+                eeg_data = np.concatenate(
+                    [eeg_data, np.zeros((len(picks), lookahead_samples))],
+                    axis=1,
+                )
+            cleaned_eeg, states = asr_process(
+                eeg_data,
+                sfreq,
+                asr.M,
+                asr.T,
+                windowlen=asr.win_len,
+                lookahead=lookahead,
+                stepsize=stepsize,
+                maxdims=maxdims,
+                ab=(asr.A, asr.B),
+                R=states["R"],
+                Zi=states["Zi"],
+                cov=states["cov"],
+                carry=states["carry"],
+                return_states=True,
+                method=asr.method,
+            )
+            skipped = max(0, -output_start)
+            output_stop = output_start + cleaned_eeg.shape[1]
+            cleaned_data[picks, output_start + skipped:output_stop] = (
+                cleaned_eeg[:, skipped:]
+            )
+            output_start = output_stop
+
+        raw = mne.io.RawArray(cleaned_data,
+                              self.raw.info,
+                              first_samp=self.raw.first_samp)
+        raw.set_annotations(self.raw.annotations)
+        return raw
+
+    def _fit_asr(
+        self: "CleanerPipelines",
+        asr: asrpy.ASR,
+        streaming: bool,
+        calibration_start: float,
+        calibration_duration: float,
+    ) -> asrpy.ASR:
+        """Fit ASR on the whole recording or on the calibration segment."""
+        if streaming:
+            start, stop = self.raw.time_as_index(
+                [calibration_start, calibration_start + calibration_duration]
+            )
+            asr.fit(self.raw, start=start, stop=min(stop, self.raw.n_times))
+        else:
+            asr.fit(self.raw)
+        return asr
+
+    def _calibrate_asr_for_session(
+        self: "CleanerPipelines",
+        asr: asrpy.ASR,
+        calibration_run: int | None,
+        **fit_kwargs: Any,
+    ) -> asrpy.ASR:
+        """Load the session calibration of ASR or fit and persist it.
+
+        Args:
+            asr (asrpy.ASR): The ASR object to calibrate.
+            calibration_run (int, optional): The run the calibration is fitted
+                on. If None, the first run processed fits the calibration.
+            **fit_kwargs: The arguments of _fit_asr.
+
+        Returns:
+            asrpy.ASR: The calibrated ASR object.
+
+        Raises:
+            ValueError: If the calibration run was not processed yet.
+        """
+        store = ASRCalibrationStore(
+            self.derivatives_path.joinpath("asr_calibration")
+        )
+        # The channels ASR is fitted on by asrpy (picks="eeg").
+        picks = mne.pick_types(self.raw.info, eeg=True, exclude=())
+        ch_names = [self.raw.ch_names[pick] for pick in picks]
+        is_calibration_run = (
+            calibration_run is None
+            or int(self.entities.get("run", -1)) == int(calibration_run)
+        )
+        # The variants share the store, their calibrations are told apart by
+        # the cleaning the data went through before ASR.
+        history = self.process_history
+        with store.lock(self.entities, history):
+            if store.exists(self.entities, history):
+                return store.load(self.entities, asr, ch_names, history)
+            if not is_calibration_run:
+                raise ValueError(
+                    f"The ASR calibration run {calibration_run} of "
+                    f"{store.filename(self.entities, history).name} was not "
+                    "processed yet."
+                )
+            self._fit_asr(asr, **fit_kwargs)
+            store.save(self.entities, asr, ch_names, history)
+        return asr
+
     @pipe
-    def run_asr(self) -> mne.io.Raw:
+    @cached
+    def run_asr(
+        self: "CleanerPipelines",
+        streaming: bool = False,
+        calibration_start: float = 0.0,
+        calibration_duration: float = 60.0,
+        window_duration: float = 30.0,
+        calibration: str = "file",
+        calibration_run: int | None = None,
+    ) -> "CleanerPipelines":
         """Clean the EEG data using the ASR algorithm.
 
+        By default ASR is calibrated and applied on the whole recording in
+        memory. The streaming mode bounds the memory used by ASR for long
+        recordings: the calibration is done on a segment of the recording and
+        the data is cleaned window by window.
+
+        The calibration can be shared by the runs of a subject-session. It is
+        then persisted in DERIVATIVES/asr_calibration and reused by the other
+        runs of the session that went through the same steps.
+
         Args:
-            raw (mne.io.Raw): The raw EEG data.
+            streaming (bool, optional): Use the streaming mode.
+                Defaults to False.
+            calibration_start (float, optional): The start of the calibration
+                segment in seconds for the streaming mode. Defaults to 0.
+            calibration_duration (float, optional): The duration of the
+                calibration segment in seconds for the streaming mode.
+                Defaults to 60.
+            window_duration (float, optional): The duration of the windows
+                cleaned at once in seconds for the streaming mode.
+                Defaults to 30.
+            calibration (str, optional): 'file' fits ASR on each recording,
+                'session' shares the calibration of the subject-session.
+                Defaults to 'file'.
+            calibration_run (int, optional): With the 'session' calibration,
+                the run the calibration is fitted on. The other runs of the
+                session fail until it has been processed. If None, the first
+                run processed is used. Defaults to None.
 
         Returns:
-            mne.io.Raw: The cleaned EEG data.
+            CleanerPipelines: The pipeline with the cleaned data.
         """
+        if calibration not in ("file", "session"):
+            raise ValueError("The calibration must be 'file' or 'session'.")
         asr = asrpy.ASR(sfreq=self.raw.info["sfreq"])
-        asr.fit(self.raw)
-        self.raw = asr.transform(self.raw)
+        fit_kwargs = dict(streaming=streaming,
+                          calibration_start=calibration_start,
+                          calibration_duration=calibration_duration)
+        if calibration == "session":
+            self._calibrate_asr_for_session(asr, calibration_run, **fit_kwargs)
+        else:
+            self._fit_asr(asr, **fit_kwargs)
+
+        if streaming:
+            self.raw = self._transform_asr_in_windows(asr, window_duration)
+        else:
+            # ASR only uses NumPy, it works on the data in single precision.
+            self._materialize(keep_precision=True)
+            self.raw = asr.transform(self.raw)
         self.process_history.append("ASR")
         return self
     
@@ -267,4 +1073,43 @@ class CleanerPipelines:
         filename = self.derivatives_path.joinpath("report.txt")
         with open(filename, "a") as f:
             f.write(message)
-            f.write("\n")
\ No newline at end of file
+            f.write("\n")
+
+
+def summarize_step_metrics(
+    derivatives_path: str | os.PathLike,
+) -> pd.DataFrame:
+    """Aggregate the step metrics of a dataset.
+
+    The records of step_metrics.jsonl are grouped by step and the summary is
+    saved as step_metrics_summary.csv in the same folder. The records are also
+    saved as a flat table in step_metrics.csv.
+
+    Args:
+        derivatives_path (str | os.PathLike): The DERIVATIVES folder.
+
+    Returns:
+        pd.DataFrame: The summary with one row per step.
+    """
+    derivatives_path = Path(derivatives_path)
+    metrics = pd.read_json(
+        derivatives_path.joinpath("step_metrics.jsonl"),
+        lines=True,
+    )
+    metrics.to_csv(derivatives_path.joinpath("step_metrics.csv"), index=False)
+    metrics["throughput"] = metrics["n_samples_in"] / metrics["wall_time"]
+    summary = metrics.groupby("step").agg(
+        count=("wall_time", "size"),
+        total_wall_time=("wall_time", "sum"),
+        mean_wall_time=("wall_time", "mean"),
+        max_wall_time=("wall_time", "max"),
+        total_cpu_time=("cpu_time", "sum"),
+        max_peak_rss_delta=("peak_rss_delta", "max"),
+        mean_throughput=("throughput", "mean"),
+    )
+    summary["wall_time_share"] = (
+        summary["total_wall_time"] / summary["total_wall_time"].sum()
+    )
+    summary = summary.sort_values("total_wall_time", ascending=False)
+    summary.to_csv(derivatives_path.joinpath("step_metrics_summary.csv"))
+    return summary
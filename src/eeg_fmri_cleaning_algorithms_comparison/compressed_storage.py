@@ -0,0 +1,367 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Compressed HDF5 storage of the cleaned EEG data.
+
+Every variant folder of the derivatives holds a copy of each recording, which
+makes the storage the main cost of the comparisons. This format stores the
+data as a chunked and compressed array in an HDF5 file, along with the MNE
+info and the annotations. The chunks span a few channels and a few seconds,
+so a reader only decompresses the chunks of the channels and time window it
+asks for.
+
+The blosc compressor with zstd is used when hdf5plugin is installed, gzip
+otherwise. h5py is needed to use this format.
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import mne
+import numpy as np
+from raw_writer import FSYNC_POLICIES, WRITE_FORMATS, fsync_path
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Version of the layout of the HDF5 files.
+FORMAT_VERSION = 1
+DTYPES = {"single": np.float32, "double": np.float64}
+
+
+def _require_h5py() -> None:
+    """Raise an explicit error if h5py is not installed."""
+    if h5py is None:
+        raise ImportError(
+            "The hdf5 output format requires h5py, install the hdf5 extra "
+            "(pip install eeg_fmri_cleaning_algorithms_comparison[hdf5])."
+        )
+
+
+def _check_write_options(fmt: str, fsync: str) -> None:
+    """Check that h5py is installed and the write options are supported."""
+    _require_h5py()
+    if fmt not in WRITE_FORMATS:
+        raise ValueError(
+            f"The write format must be one of {', '.join(WRITE_FORMATS)}."
+        )
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(
+            f"The fsync policy must be one of {', '.join(FSYNC_POLICIES)}."
+        )
+
+
+def _compression_options(compression_level: int) -> dict:
+    """Get the compression filter of the data set."""
+    if hdf5plugin is not None:
+        return dict(hdf5plugin.Blosc(cname="zstd",
+                                     clevel=compression_level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return dict(compression="gzip",
+                compression_opts=min(compression_level, 9),
+                shuffle=True)
+
+
+def _info_to_bytes(info: mne.Info) -> np.ndarray:
+    """Serialize an MNE info with the FIF writer of MNE."""
+    with tempfile.TemporaryDirectory() as temporary_path:
+        filename = Path(temporary_path).joinpath("info-info.fif")
+        mne.io.write_info(filename, info)
+        return np.frombuffer(filename.read_bytes(), dtype=np.uint8)
+
+
+def _info_from_bytes(content: np.ndarray) -> mne.Info:
+    """Deserialize an MNE info written by _info_to_bytes."""
+    with tempfile.TemporaryDirectory() as temporary_path:
+        filename = Path(temporary_path).joinpath("info-info.fif")
+        filename.write_bytes(content.tobytes())
+        return mne.io.read_info(filename, verbose=False)
+
+
+def write_raw_hdf5(
+    raw: mne.io.BaseRaw,
+    destination_filename: str | os.PathLike,
+    fmt: str = "single",
+    chunk_duration: float = 10.0,
+    channels_per_chunk: int = 8,
+    compression_level: int = 5,
+    fsync: str = "none",
+) -> Path:
+    """Write a recording to a compressed HDF5 file atomically.
+
+    The data is written block of chunks by block of chunks, so a lazily read
+    recording is never fully loaded. The file is written next to its
+    destination and renamed once complete.
+
+    Args:
+        raw (mne.io.BaseRaw): The recording.
+        destination_filename (str | os.PathLike): The HDF5 file to write.
+        fmt (str, optional): The precision of the data, 'single' or 'double'.
+            Defaults to 'single'.
+        chunk_duration (float, optional): The duration of a chunk in seconds.
+            Defaults to 10.
+        channels_per_chunk (int, optional): The number of channels of a chunk.
+            Defaults to 8.
+        compression_level (int, optional): The compression level.
+            Defaults to 5.
+        fsync (str, optional): The fsync policy, see
+            raw_writer.write_raw_atomic. Defaults to 'none'.
+
+    Returns:
+        Path: The destination file.
+
+    Raises:
+        ValueError: If the format or the fsync policy is not supported.
+    """
+    _check_write_options(fmt, fsync)
+    n_channels, n_times = len(raw.ch_names), raw.n_times
+    chunk_samples = max(min(int(chunk_duration * raw.info["sfreq"]), n_times), 1)
+    chunks = (max(min(channels_per_chunk, n_channels), 1), chunk_samples)
+
+    def write(h5_file: "h5py.File") -> None:
+        data = h5_file.create_dataset(
+            "data",
+            shape=(n_channels, n_times),
+            dtype=DTYPES[fmt],
+            chunks=chunks if n_times else None,
+            **_compression_options(compression_level),
+        )
+        for start in range(0, n_times, chunk_samples):
+            stop = min(start + chunk_samples, n_times)
+            data[:, start:stop] = raw.get_data(start=start, stop=stop)
+        _write_metadata(h5_file, raw)
+
+    return _write_atomically(destination_filename, write, fsync)
+
+
+def _write_metadata(h5_file: "h5py.File", raw: mne.io.BaseRaw) -> None:
+    """Write the info, the annotations and the first sample of a recording."""
+    h5_file.attrs["format_version"] = FORMAT_VERSION
+    h5_file.attrs["first_samp"] = raw.first_samp
+    h5_file.create_dataset("info", data=_info_to_bytes(raw.info))
+    annotations = h5_file.create_group("annotations")
+    annotations.create_dataset("onset", data=raw.annotations.onset)
+    annotations.create_dataset("duration", data=raw.annotations.duration)
+    annotations.create_dataset(
+        "description",
+        data=np.array(raw.annotations.description, dtype=object),
+        dtype=h5py.string_dtype(),
+    )
+    orig_time = raw.annotations.orig_time
+    annotations.attrs["orig_time"] = (
+        np.nan if orig_time is None else orig_time.timestamp()
+    )
+
+
+def _write_atomically(
+    destination_filename: str | os.PathLike,
+    write: Callable[["h5py.File"], None],
+    fsync: str = "none",
+) -> Path:
+    """Write an HDF5 file next to its destination and rename it once complete.
+
+    Args:
+        destination_filename (str | os.PathLike): The HDF5 file to write.
+        write (Callable): The function filling the open HDF5 file.
+        fsync (str, optional): The fsync policy, see
+            raw_writer.write_raw_atomic. Defaults to 'none'.
+
+    Returns:
+        Path: The destination file.
+    """
+    destination_filename = Path(destination_filename)
+    file_descriptor, temporary_filename = tempfile.mkstemp(
+        prefix=".tmp-", suffix=".h5", dir=destination_filename.parent
+    )
+    os.close(file_descriptor)
+    try:
+        with h5py.File(temporary_filename, "w") as h5_file:
+            write(h5_file)
+        if fsync != "none":
+            fsync_path(temporary_filename)
+        os.replace(temporary_filename, destination_filename)
+        if fsync == "directory":
+            fsync_path(destination_filename.parent)
+    finally:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+    return destination_filename
+
+
+class CompressedRawReader:
+    """Reader of the HDF5 files written by write_raw_hdf5.
+
+    The file stays open until close is called, or until the end of the with
+    block when used as a context manager. Only the chunks overlapping the
+    requested channels and samples are decompressed.
+    """
+    def __init__(self, filename: str | os.PathLike) -> None:
+        """Open a file and read its info and annotations.
+
+        Args:
+            filename (str | os.PathLike): The HDF5 file.
+        """
+        _require_h5py()
+        self.filename = Path(filename)
+        self._file = h5py.File(self.filename, "r")
+        # Only the files of write_raw_hdf5 hold the full data set.
+        self._data = self._file.get("data")
+        self.info = _info_from_bytes(self._file["info"][()])
+        self.first_samp = int(self._file.attrs["first_samp"])
+        annotations = self._file["annotations"]
+        orig_time = float(annotations.attrs["orig_time"])
+        self.annotations = mne.Annotations(
+            onset=annotations["onset"][()],
+            duration=annotations["duration"][()],
+            description=annotations["description"].asstr()[()],
+            orig_time=None if np.isnan(orig_time) else orig_time,
+        )
+
+    def __enter__(self) -> "CompressedRawReader":  # noqa: D105
+        return self
+
+    def __exit__(self, *args: object) -> None:  # noqa: D105
+        self.close()
+
+    @property
+    def ch_names(self) -> list[str]:
+        """The names of the channels."""
+        return self.info["ch_names"]
+
+    @property
+    def n_times(self) -> int:
+        """The number of samples."""
+        return self._data.shape[1]
+
+    def _channel_indices(self, picks: list[str] | list[int] | None) -> list[int]:
+        """Convert channel names or indices to indices."""
+        if picks is None:
+            return list(range(len(self.ch_names)))
+        return [
+            self.ch_names.index(pick) if isinstance(pick, str) else int(pick)
+            for pick in picks
+        ]
+
+    def get_data(
+        self,
+        picks: list[str] | list[int] | None = None,
+        start: int = 0,
+        stop: int | None = None,
+        tmin: float | None = None,
+        tmax: float | None = None,
+    ) -> np.ndarray:
+        """Read a block of channels and samples in float64.
+
+        Args:
+            picks (list[str] | list[int], optional): The names or indices of
+                the channels. All the channels if None.
+            start (int, optional): The first sample. Defaults to 0.
+            stop (int, optional): The sample after the last one. Defaults to
+                the end of the recording.
+            tmin (float, optional): The start in seconds, overrides start.
+            tmax (float, optional): The end in seconds, overrides stop.
+
+        Returns:
+            np.ndarray: The data, shape (n_picks, n_samples).
+        """
+        sfreq = self.info["sfreq"]
+        if tmin is not None:
+            start = int(round(tmin * sfreq))
+        if tmax is not None:
+            stop = int(round(tmax * sfreq))
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        indices = self._channel_indices(picks)
+        # h5py reads the channels in increasing order only.
+        sorted_indices, inverse = np.unique(indices, return_inverse=True)
+        block = self._data[sorted_indices.tolist(), start:stop]
+        return block[inverse].astype(np.float64)
+
+    def to_raw(
+        self,
+        picks: list[str] | list[int] | None = None,
+        start: int = 0,
+        stop: int | None = None,
+    ) -> mne.io.RawArray:
+        """Read a block of channels and samples as an MNE raw object.
+
+        Args:
+            picks (list[str] | list[int], optional): The names or indices of
+                the channels. All the channels if None.
+            start (int, optional): The first sample. Defaults to 0.
+            stop (int, optional): The sample after the last one. Defaults to
+                the end of the recording.
+
+        Returns:
+            mne.io.RawArray: The recording.
+        """
+        indices = self._channel_indices(picks)
+        info = mne.pick_info(self.info, indices)
+        raw = mne.io.RawArray(self.get_data(indices, start, stop),
+                              info,
+                              first_samp=self.first_samp + start,
+                              verbose=False)
+        annotations = self.annotations.copy()
+        if annotations.orig_time is None:
+            # The annotations are relative to the first sample of the data.
+            annotations.onset -= start / self.info["sfreq"]
+        raw.set_annotations(annotations,
+                            emit_warning=False,
+                            on_missing="ignore")
+        return raw
+
+    def close(self) -> None:
+        """Close the file."""
+        self._file.close()
+
+
+def read_raw_hdf5(
+    filename: str | os.PathLike,
+    picks: list[str] | list[int] | None = None,
+    start: int = 0,
+    stop: int | None = None,
+) -> mne.io.RawArray:
+    """Read a recording, or a block of it, from an HDF5 file.
+
+    Args:
+        filename (str | os.PathLike): The HDF5 file.
+        picks (list[str] | list[int], optional): The names or indices of the
+            channels. All the channels if None.
+        start (int, optional): The first sample. Defaults to 0.
+        stop (int, optional): The sample after the last one. Defaults to the
+            end of the recording.
+
+    Returns:
+        mne.io.RawArray: The recording.
+    """
+    with CompressedRawReader(filename) as reader:
+        return reader.to_raw(picks, start, stop)
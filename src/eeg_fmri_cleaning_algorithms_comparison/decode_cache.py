@@ -0,0 +1,255 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Cache of the raw recordings decoded to FIF.
+
+Parsing the EEGLAB and BrainVision files is slow for large recordings and was
+done again on every run. The recordings are decoded once and saved as FIF
+files, which MNE reads faster and can read lazily, channel by channel and
+segment by segment. A cached recording is used as long as its source files
+are unchanged.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import mne
+from eeg_fmri_cleaning.utils import read_raw_eeg
+from step_cache import companion_files, recording_digest
+
+# Extensions of the raw recordings that are decoded.
+DECODED_EXTENSIONS = (".set", ".vhdr")
+
+
+class DecodeCache:
+    """On-disk cache of the decoded raw recordings.
+
+    Each recording is saved as <name>.fif next to <name>.json, which
+    describes the source files it was decoded from: their size and
+    modification time, their digest and the version of MNE. The description
+    is written last, so a recording whose decoding was interrupted is never
+    used.
+    """
+    def __init__(self, root: str | os.PathLike) -> None:
+        """Initialize the cache.
+
+        Args:
+            root (str | os.PathLike): The directory of the decoded recordings.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _entry_paths(self, source_path: str | os.PathLike) -> tuple[Path, Path]:
+        """Get the FIF file and the description of a recording."""
+        stem = Path(source_path).stem
+        return (self.root.joinpath(f"{stem}.fif"),
+                self.root.joinpath(f"{stem}.json"))
+
+    @staticmethod
+    def _file_stats(source_path: str | os.PathLike) -> dict[str, list[int]]:
+        """Get the size and modification time of the source files."""
+        stats = dict()
+        for path in companion_files(source_path):
+            stat = path.stat()
+            stats[path.name] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def _write_description(self, filename: Path, description: dict) -> None:
+        """Write a description atomically."""
+        file_descriptor, temporary_filename = tempfile.mkstemp(
+            prefix=".tmp-", dir=self.root
+        )
+        with os.fdopen(file_descriptor, "w") as f:
+            json.dump(description, f)
+        os.replace(temporary_filename, filename)
+
+    def is_valid(self, source_path: str | os.PathLike) -> bool:
+        """Check that a cached recording was decoded from the current sources.
+
+        The sizes and modification times of the source files are compared
+        first. When they differ, the digests of the sources are compared so a
+        recording that was copied or touched without being modified is still
+        valid. Its description is then updated.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+
+        Returns:
+            bool: Whether the cached recording can be used.
+        """
+        fif_filename, description_filename = self._entry_paths(source_path)
+        if not (description_filename.is_file() and fif_filename.is_file()):
+            return False
+        with open(description_filename, "r") as f:
+            description = json.load(f)
+        if description["mne"] != mne.__version__:
+            return False
+        stats = self._file_stats(source_path)
+        if description["files"] == stats:
+            return True
+        if description["digest"] != recording_digest(source_path):
+            return False
+        description["files"] = stats
+        self._write_description(description_filename, description)
+        return True
+
+    def load(
+        self,
+        source_path: str | os.PathLike,
+        preload: bool | str = True,
+    ) -> mne.io.BaseRaw | None:
+        """Load a decoded recording.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+            preload (bool | str, optional): The preload argument of
+                mne.io.read_raw_fif. Defaults to True.
+
+        Returns:
+            mne.io.BaseRaw | None: The recording, or None if it is not cached
+                or its sources changed.
+        """
+        if not self.is_valid(source_path):
+            return None
+        fif_filename, _ = self._entry_paths(source_path)
+        return mne.io.read_raw_fif(fif_filename, preload=preload)
+
+    def store(
+        self,
+        source_path: str | os.PathLike,
+        raw: mne.io.BaseRaw,
+    ) -> Path:
+        """Store a decoded recording.
+
+        The data is saved in double precision so the cached recording is
+        identical to the decoded one.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+            raw (mne.io.BaseRaw): The decoded recording.
+
+        Returns:
+            Path: The FIF file of the recording.
+        """
+        fif_filename, description_filename = self._entry_paths(source_path)
+        description_filename.unlink(missing_ok=True)
+        # The sources are described before saving: if they change in the
+        # meantime the entry is invalidated on the next load.
+        description = {
+            "files": self._file_stats(source_path),
+            "digest": recording_digest(source_path),
+            "mne": mne.__version__,
+        }
+        raw.save(fif_filename, fmt="double", overwrite=True)
+        self._write_description(description_filename, description)
+        return fif_filename
+
+    def read(
+        self,
+        source_path: str | os.PathLike,
+        preload: bool | str = True,
+    ) -> mne.io.BaseRaw:
+        """Read a recording from the cache, decoding it if needed.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+            preload (bool | str, optional): The preload argument of
+                mne.io.read_raw_fif. Defaults to True.
+
+        Returns:
+            mne.io.BaseRaw: The recording.
+        """
+        raw = self.load(source_path, preload=preload)
+        if raw is None:
+            raw = read_raw_eeg(source_path)
+            self.store(source_path, raw)
+            if preload is not True:
+                raw = self.load(source_path, preload=preload)
+        return raw
+
+    def ingest(
+        self,
+        source_paths: list[str | os.PathLike],
+        n_jobs: int = 1,
+    ) -> list[Path]:
+        """Decode the recordings that are not cached yet.
+
+        Args:
+            source_paths (list[str | os.PathLike]): The raw recordings.
+            n_jobs (int, optional): The number of processes decoding the
+                recordings. Defaults to 1.
+
+        Returns:
+            list[Path]: The recordings that were decoded.
+        """
+        missing = [
+            Path(path) for path in source_paths if not self.is_valid(path)
+        ]
+        if n_jobs == 1:
+            for path in missing:
+                self.store(path, read_raw_eeg(path))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(_decode, [self.root] * len(missing), missing))
+        return missing
+
+
+def _decode(root: Path, source_path: Path) -> Path:
+    """Decode a recording in a worker process of DecodeCache.ingest."""
+    return DecodeCache(root).store(source_path, read_raw_eeg(source_path))
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Decode the recordings of a dataset from the command line."""
+    parser = argparse.ArgumentParser(description="Decode the raw recordings")
+    parser.add_argument("--path", type=str, help="Path to the BIDS dataset")
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory of the decoded recordings, e.g. DERIVATIVES/decoded.",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="Number of processes decoding the recordings.",
+    )
+    args = parser.parse_args(argv)
+
+    source_paths = [
+        path for path in sorted(Path(args.path).rglob("*_eeg.*"))
+        if path.suffix in DECODED_EXTENSIONS
+    ]
+    cache = DecodeCache(args.cache_dir)
+    decoded = cache.ingest(source_paths, n_jobs=args.n_jobs)
+    print(f"Decoded {len(decoded)} of {len(source_paths)} recordings in "
+          f"{cache.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Storage of a derived variant as the changes made to its parent output.
+
+The variants of a pipeline tree share their first steps: GRAD_BCG_ASR and
+GRAD_BCG_PREP_ASR both derive from the GRAD_BCG signal, and ASR only
+reconstructs the windows where it detected an artifact. A delta file stores
+such an output as a reference to the output of its parent step and the
+blocks of samples (one channel over block_duration seconds) that differ from
+it. The blocks are stored with their new values rather than as a residual,
+so the reconstruction involves no arithmetic.
+
+When the step changed most of the blocks (e.g. the re-referencing of PREP),
+the delta file holds all of them and no reference, so reading it does not
+involve the parent. The same happens when the parent has other channels or
+samples than the output.
+
+The parent can be a FIF, an HDF5 or another delta file. It must stay in
+place. The delta records the size, the modification time and the sha256
+digest of the parent: the reader checks the size and the time, and the
+digest when the time differs, so a parent written again with other data
+after the delta is detected. h5py is needed to use this format, it is
+installed with the hdf5 extra.
+"""
+
+import os
+from pathlib import Path
+
+import mne
+import numpy as np
+from compressed_storage import (
+    DTYPES,
+    CompressedRawReader,
+    _check_write_options,
+    _compression_options,
+    _write_atomically,
+    _write_metadata,
+)
+from step_cache import file_digest
+
+# Suffix of the delta files, they are HDF5 files.
+DELTA_SUFFIX = ".delta.h5"
+# Relative difference under which a block is considered unchanged. The parent
+# is read back from its file, so it carries the rounding of its precision.
+RELATIVE_TOLERANCES = {"single": 1e-6, "double": 1e-12}
+
+
+def open_raw_reader(
+    filename: str | os.PathLike,
+) -> CompressedRawReader | mne.io.BaseRaw:
+    """Open a saved output without loading its data.
+
+    Args:
+        filename (str | os.PathLike): A FIF, HDF5 or delta file.
+
+    Returns:
+        CompressedRawReader | mne.io.BaseRaw: An object with the ch_names,
+            n_times, get_data and close members of MNE raw objects.
+    """
+    filename = Path(filename)
+    if filename.name.endswith(DELTA_SUFFIX):
+        return DeltaRawReader(filename)
+    if filename.suffix == ".h5":
+        return CompressedRawReader(filename)
+    return mne.io.read_raw_fif(filename, preload=False, verbose=False)
+
+
+def _check_parent(filename: Path, attrs: dict) -> None:
+    """Check that a parent is the file a delta was written against.
+
+    The digest is only computed when the modification time differs, e.g.
+    after a copy of the derivatives.
+
+    Raises:
+        ValueError: If the parent has other content.
+    """
+    stat = filename.stat()
+    if stat.st_size == attrs.get("parent_size") and (
+        stat.st_mtime_ns == attrs.get("parent_mtime_ns")
+        or file_digest(filename) == attrs.get("parent_digest")
+    ):
+        return
+    raise ValueError(
+        f"The parent {filename} changed since the delta was written."
+    )
+
+
+def _changed_blocks(
+    raw: mne.io.BaseRaw,
+    parent: CompressedRawReader | mne.io.BaseRaw,
+    block_samples: int,
+    fmt: str,
+) -> list[np.ndarray]:
+    """Find the channels that differ from the parent in each time block.
+
+    The data is cast to the saved precision before the comparison, so the
+    rounding of the parent file is not taken for a change.
+
+    Returns:
+        list[np.ndarray]: The indices of the changed channels of each block.
+    """
+    tolerance = RELATIVE_TOLERANCES[fmt]
+    changed = list()
+    for start in range(0, raw.n_times, block_samples):
+        stop = min(start + block_samples, raw.n_times)
+        data = raw.get_data(start=start, stop=stop).astype(DTYPES[fmt])
+        reference = parent.get_data(start=start, stop=stop)
+        difference = np.abs(data - reference) > tolerance * np.abs(reference)
+        changed.append(np.flatnonzero(difference.any(axis=1)))
+    return changed
+
+
+def write_raw_delta(
+    raw: mne.io.BaseRaw,
+    parent_filename: str | os.PathLike,
+    destination_filename: str | os.PathLike,
+    fmt: str = "single",
+    block_duration: float = 1.0,
+    max_changed_fraction: float = 0.5,
+    compression_level: int = 5,
+    fsync: str = "none",
+) -> Path:
+    """Write a recording as its changes to a parent output, atomically.
+
+    The parent is read once, block by block, to find the changed blocks. The
+    path to the parent is stored relative to the delta file, so the
+    derivatives can be moved as a whole.
+
+    Args:
+        raw (mne.io.BaseRaw): The recording.
+        parent_filename (str | os.PathLike): The saved output the recording
+            derives from. It must be complete before the call.
+        destination_filename (str | os.PathLike): The delta file to write, its
+            name should end with DELTA_SUFFIX.
+        fmt (str, optional): The precision of the data, 'single' or 'double'.
+            Defaults to 'single'.
+        block_duration (float, optional): The duration of a block in seconds.
+            Defaults to 1.
+        max_changed_fraction (float, optional): The fraction of changed blocks
+            above which all the blocks are stored without reference to the
+            parent. Defaults to 0.5.
+        compression_level (int, optional): The compression level.
+            Defaults to 5.
+        fsync (str, optional): The fsync policy, see
+            raw_writer.write_raw_atomic. Defaults to 'none'.
+
+    Returns:
+        Path: The destination file.
+
+    Raises:
+        ValueError: If the format or the fsync policy is not supported.
+    """
+    _check_write_options(fmt, fsync)
+    destination_filename = Path(destination_filename)
+    parent_filename = Path(parent_filename)
+    n_channels, n_times = len(raw.ch_names), raw.n_times
+    block_samples = max(min(int(block_duration * raw.info["sfreq"]), n_times), 1)
+    n_blocks = -(-n_times // block_samples)
+
+    parent = open_raw_reader(parent_filename)
+    try:
+        if parent.ch_names == raw.ch_names and parent.n_times == n_times:
+            changed = _changed_blocks(raw, parent, block_samples, fmt)
+        else:
+            changed = None
+    finally:
+        parent.close()
+    n_changed = sum(map(len, changed)) if changed is not None else 0
+    standalone = (
+        changed is None
+        or n_changed > max_changed_fraction * n_channels * n_blocks
+    )
+    if standalone:
+        changed = [np.arange(n_channels)] * n_blocks
+        n_changed = n_channels * n_blocks
+
+    def write(h5_file: "h5py.File") -> None:  # noqa: F821
+        h5_file.attrs["n_times"] = n_times
+        h5_file.attrs["block_samples"] = block_samples
+        if standalone:
+            h5_file.attrs["parent"] = ""
+            h5_file.attrs["parent_size"] = 0
+        else:
+            parent_stat = parent_filename.stat()
+            h5_file.attrs["parent"] = os.path.relpath(
+                parent_filename, destination_filename.parent
+            )
+            h5_file.attrs["parent_size"] = parent_stat.st_size
+            h5_file.attrs["parent_mtime_ns"] = parent_stat.st_mtime_ns
+            h5_file.attrs["parent_digest"] = file_digest(parent_filename)
+        h5_file.create_dataset("blocks", data=np.array(
+            [(channel, block)
+             for block, channels in enumerate(changed)
+             for channel in channels],
+            dtype=np.int64,
+        ).reshape(n_changed, 2))
+        values = h5_file.create_dataset(
+            "values",
+            shape=(n_changed, block_samples),
+            dtype=DTYPES[fmt],
+            chunks=(min(n_changed, 8), block_samples) if n_changed else None,
+            **(_compression_options(compression_level) if n_changed else {}),
+        )
+        row = 0
+        for block, channels in enumerate(changed):
+            if not len(channels):
+                continue
+            start = block * block_samples
+            stop = min(start + block_samples, n_times)
+            data = raw.get_data(picks=channels, start=start, stop=stop)
+            # The last block is padded with zeros.
+            values[row:row + len(channels), :stop - start] = data
+            row += len(channels)
+        _write_metadata(h5_file, raw)
+
+    return _write_atomically(destination_filename, write, fsync)
+
+
+class DeltaRawReader(CompressedRawReader):
+    """Reader of the delta files written by write_raw_delta.
+
+    The parent is opened with the delta file and the samples are read
+    lazily: get_data reads the requested window from the parent and replaces
+    the changed blocks overlapping it.
+    """
+    def __init__(self, filename: str | os.PathLike) -> None:
+        """Open a delta file and its parent.
+
+        Args:
+            filename (str | os.PathLike): The delta file.
+
+        Raises:
+            ValueError: If the parent changed since the delta was written.
+        """
+        super().__init__(filename)
+        attrs = self._file.attrs
+        self._n_times = int(attrs["n_times"])
+        self.block_samples = int(attrs["block_samples"])
+        self._blocks = self._file["blocks"][()]
+        self._values = self._file["values"]
+        self.parent_filename = None
+        self._parent = None
+        if attrs["parent"]:
+            self.parent_filename = self.filename.parent.joinpath(
+                attrs["parent"]
+            )
+            try:
+                _check_parent(self.parent_filename, dict(attrs))
+            except (OSError, ValueError):
+                self.close()
+                raise
+            self._parent = open_raw_reader(self.parent_filename)
+
+    @property
+    def n_times(self) -> int:
+        """The number of samples."""
+        return self._n_times
+
+    def get_data(
+        self,
+        picks: list[str] | list[int] | None = None,
+        start: int = 0,
+        stop: int | None = None,
+        tmin: float | None = None,
+        tmax: float | None = None,
+    ) -> np.ndarray:
+        """Read a block of channels and samples in float64.
+
+        Args:
+            picks (list[str] | list[int], optional): The names or indices of
+                the channels. All the channels if None.
+            start (int, optional): The first sample. Defaults to 0.
+            stop (int, optional): The sample after the last one. Defaults to
+                the end of the recording.
+            tmin (float, optional): The start in seconds, overrides start.
+            tmax (float, optional): The end in seconds, overrides stop.
+
+        Returns:
+            np.ndarray: The data, shape (n_picks, n_samples).
+        """
+        sfreq = self.info["sfreq"]
+        if tmin is not None:
+            start = int(round(tmin * sfreq))
+        if tmax is not None:
+            stop = int(round(tmax * sfreq))
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        indices = np.array(self._channel_indices(picks), dtype=np.int64)
+        if self._parent is None:
+            data = np.zeros((len(indices), max(stop - start, 0)))
+        else:
+            sorted_indices, inverse = np.unique(indices, return_inverse=True)
+            data = self._parent.get_data(picks=sorted_indices.tolist(),
+                                         start=start,
+                                         stop=stop)[inverse]
+        if stop <= start:
+            return data
+
+        channels, blocks = self._blocks[:, 0], self._blocks[:, 1]
+        rows = np.flatnonzero(
+            np.isin(channels, indices)
+            & (blocks >= start // self.block_samples)
+            & (blocks <= (stop - 1) // self.block_samples)
+        )
+        if not rows.size:
+            return data
+        # The rows are increasing, as h5py requires.
+        values = self._values[rows.tolist()]
+        for (channel, block), block_values in zip(self._blocks[rows], values):
+            block_start = block * self.block_samples
+            first = max(block_start, start)
+            last = min(block_start + self.block_samples, stop)
+            data[indices == channel, first - start:last - start] = (
+                block_values[first - block_start:last - block_start]
+            )
+        return data
+
+    def close(self) -> None:
+        """Close the file and its parent."""
+        if self._parent is not None:
+            self._parent.close()
+            self._parent = None
+        super().close()
+
+
+def read_raw_delta(
+    filename: str | os.PathLike,
+    picks: list[str] | list[int] | None = None,
+    start: int = 0,
+    stop: int | None = None,
+) -> mne.io.RawArray:
+    """Reconstruct a recording, or a block of it, from a delta file.
+
+    Args:
+        filename (str | os.PathLike): The delta file.
+        picks (list[str] | list[int], optional): The names or indices of the
+            channels. All the channels if None.
+        start (int, optional): The first sample. Defaults to 0.
+        stop (int, optional): The sample after the last one. Defaults to the
+            end of the recording.
+
+    Returns:
+        mne.io.RawArray: The recording.
+    """
+    with DeltaRawReader(filename) as reader:
+        return reader.to_raw(picks, start, stop)
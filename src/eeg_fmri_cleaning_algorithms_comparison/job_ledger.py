@@ -0,0 +1,177 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+
+"""Persistent ledger of the cleaning jobs.
+
+Each line of the ledger is a JSON record of the state of one variant of one
+file: pending, running, done or failed. The ledger is append only, the last
+record of a job gives its current state. It lives in the DERIVATIVES folder
+so an interrupted batch run can be resumed by skipping the jobs already done.
+"""
+
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+from step_cache import file_digest
+
+STATES = ("pending", "running", "done", "failed")
+
+
+class JobLedger:
+    """Append only JSONL ledger of the jobs states.
+
+    Writes are serialized with an exclusive lock on the ledger file so the
+    worker processes of a batch run can share it.
+    """
+    def __init__(self, path: str | os.PathLike) -> None:
+        """Initialize the ledger.
+
+        Args:
+            path (str | os.PathLike): The path of the JSONL file.
+        """
+        self.path = Path(path)
+
+    def record(
+        self,
+        filename: str,
+        variant: str,
+        state: str,
+        **fields: Any,
+    ) -> dict[str, Any]:
+        """Append the state of a job to the ledger.
+
+        Args:
+            filename (str): The name of the raw file.
+            variant (str): The name of the pipeline variant.
+            state (str): The state of the job, one of STATES.
+            **fields: Additional information stored in the record (timing,
+                outputs, error...).
+
+        Returns:
+            dict[str, Any]: The record written.
+        """
+        if state not in STATES:
+            raise ValueError(f"The state must be one of {', '.join(STATES)}.")
+        record = {
+            "file": filename,
+            "variant": variant,
+            "state": state,
+            "time": time.time(),
+            **fields,
+        }
+        line = json.dumps(record, default=str) + "\n"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return record
+
+    def read(self) -> dict[tuple[str, str], dict[str, Any]]:
+        """Read the last record of every job.
+
+        Truncated lines left by a killed process are ignored.
+
+        Returns:
+            dict[tuple[str, str], dict[str, Any]]: The last record indexed by
+                (file, variant).
+        """
+        records = dict()
+        if not self.path.is_file():
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[(record["file"], record["variant"])] = record
+        return records
+
+    @staticmethod
+    def describe_output(path: str | os.PathLike) -> dict[str, Any]:
+        """Describe an output file to be able to check it later."""
+        stat = os.stat(path)
+        return {
+            "path": str(path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_digest(path),
+        }
+
+    @staticmethod
+    def output_is_valid(output: dict[str, Any]) -> bool:
+        """Check an output file against its description.
+
+        The checksum is only recomputed when the modification time changed.
+        """
+        try:
+            stat = os.stat(output["path"])
+        except OSError:
+            return False
+        if stat.st_size != output["size"]:
+            return False
+        if stat.st_mtime_ns == output["mtime_ns"]:
+            return True
+        return file_digest(output["path"]) == output["sha256"]
+
+    def is_done(self, record: dict[str, Any] | None) -> bool:
+        """Check if a job is done and its outputs are intact."""
+        if record is None or record["state"] != "done":
+            return False
+        return all(
+            self.output_is_valid(output) for output in record.get("outputs", [])
+        )
+
+    def completed_variants(
+        self,
+        filename: str,
+        variants: list[str],
+        records: dict[tuple[str, str], dict[str, Any]] | None = None,
+    ) -> list[str]:
+        """Get the variants of a file that do not need to be run again.
+
+        Args:
+            filename (str): The name of the raw file.
+            variants (list[str]): The variants to check.
+            records (dict, optional): The records returned by read. The ledger
+                is read if None.
+
+        Returns:
+            list[str]: The variants done with intact outputs.
+        """
+        if records is None:
+            records = self.read()
+        return [
+            variant for variant in variants
+            if self.is_done(records.get((filename, variant)))
+        ]
@@ -0,0 +1,129 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Persisted index of the BIDS datasets.
+
+Indexing a dataset of thousands of files with pybids takes minutes, and it
+was done on every run. The index is saved
+in a SQLite database by pybids and reused as long as the folders of the
+dataset are unchanged. Validation and the indexing of the json sidecars are
+skipped because the pipelines only use the entities parsed from the file
+names.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import bids
+
+# Name of the file holding the fingerprint of the indexed dataset.
+FINGERPRINT_FILENAME = "fingerprint.txt"
+# Folders of the dataset root that are not indexed by pybids by default. They
+# are compared regardless of the case, so DERIVATIVES is skipped as well.
+IGNORED_DIRECTORIES = ("code", "derivatives", "models", "sourcedata", "stimuli")
+
+
+def directory_fingerprint(
+    root: str | os.PathLike,
+    excluded: list[str | os.PathLike] | None = None,
+) -> str:
+    """Hash the modification times of the folders of a dataset.
+
+    The modification time of a folder changes when a file is added, removed
+    or renamed in it, which is what makes an index outdated. The hidden
+    folders and the IGNORED_DIRECTORIES of the root are skipped like pybids
+    does, so the outputs written in a derivatives folder of the dataset do
+    not invalidate its index.
+
+    Args:
+        root (str | os.PathLike): The root of the dataset.
+        excluded (list[str | os.PathLike], optional): Other folders to skip,
+            e.g. the database of the index.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    root = Path(root)
+    excluded_paths = {Path(path).resolve() for path in excluded or []}
+    digest = hashlib.sha256()
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        digest.update(str(directory.relative_to(root)).encode())
+        digest.update(str(directory.stat().st_mtime_ns).encode())
+        with os.scandir(directory) as entries:
+            directories += sorted(
+                (Path(entry.path) for entry in entries
+                 if entry.is_dir(follow_symlinks=False)
+                 and not entry.name.startswith(".")
+                 and not (directory == root
+                          and entry.name.lower() in IGNORED_DIRECTORIES)
+                 and Path(entry.path).resolve() not in excluded_paths),
+                reverse=True,
+            )
+    return digest.hexdigest()
+
+
+def load_layout(
+    root: str | os.PathLike,
+    database_path: str | os.PathLike,
+    refresh: bool = True,
+    reset: bool = False,
+) -> bids.BIDSLayout:
+    """Load the layout of a dataset from its database, indexing it if needed.
+
+    Args:
+        root (str | os.PathLike): The root of the dataset.
+        database_path (str | os.PathLike): The folder of the database.
+        refresh (bool, optional): Index the dataset again when its folders
+            changed since the database was built. Without it the database is
+            used as is, e.g. by processes that must not rebuild a database
+            read by others. Defaults to True.
+        reset (bool, optional): Always index the dataset again.
+            Defaults to False.
+
+    Returns:
+        bids.BIDSLayout: The layout of the dataset.
+    """
+    database_path = Path(database_path)
+    database_path.mkdir(parents=True, exist_ok=True)
+    fingerprint_filename = database_path.joinpath(FINGERPRINT_FILENAME)
+    fingerprint = None
+    if refresh or reset:
+        fingerprint = directory_fingerprint(root, excluded=[database_path])
+        reset = reset or not (
+            fingerprint_filename.is_file()
+            and fingerprint_filename.read_text() == fingerprint
+        )
+    if reset:
+        fingerprint_filename.unlink(missing_ok=True)
+    layout = bids.BIDSLayout(root,
+                             validate=False,
+                             index_metadata=False,
+                             database_path=database_path,
+                             reset_database=reset)
+    if reset:
+        fingerprint_filename.write_text(fingerprint)
+    return layout
@@ -22,16 +22,234 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 # ===============================================================================
+import copy
 import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Any, Callable
 import argparse
 
 import bids
+import numpy as np
+import pandas as pd
 
-from cleaner_pipelines import CleanerPipelines
-parser = argparse.ArgumentParser(description="Run the cleaning pipelines")
-parser.add_argument("--path", type=str, help="Path to the BIDS dataset")
-args = parser.parse_args()
+from cleaner_pipelines import (
+    OUTPUT_FORMATS,
+    PRECISIONS,
+    READ_MODES,
+    SAVE_POLICIES,
+    CleanerPipelines,
+    summarize_step_metrics,
+)
+from decode_cache import DecodeCache
+from job_ledger import JobLedger
+from metrics_store import METRICS_DATABASE, MetricsStore
+from pipeline_variants import (
+    PIPELINE_VARIANTS,
+    list_recordings,
+    preview_variants,
+    step_labels,
+)
+from quality_metrics import update_metrics_store
+from raw_writer import FSYNC_POLICIES, WRITE_FORMATS
+from recording_descriptor import (
+    RecordingDescriptor,
+    forget_created_directories,
+    make_directories,
+)
+from step_cache import StepCache
+
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command line arguments of the runner."""
+    parser = argparse.ArgumentParser(description="Run the cleaning pipelines")
+    parser.add_argument("--path", type=str, help="Path to the BIDS dataset")
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes. 1 runs the files serially.",
+    )
+    parser.add_argument(
+        "--max-memory-per-worker",
+        type=int,
+        default=None,
+        help="Memory ceiling of each worker process in MB, on top of the "
+        "memory mapped when it starts. It caps the virtual memory (address "
+        "space) of the worker, not its resident memory: the memory mapped "
+        "files and the thread arenas of BLAS count against it, so leave a "
+        "margin.",
+    )
+    parser.add_argument(
+        "--max-files-per-worker",
+        type=int,
+        default=None,
+        help="Number of files after which a worker process is recycled.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory of the step cache. The steps are not cached if unset.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=None,
+        help="Maximum size of the step cache in MB.",
+    )
+    parser.add_argument(
+        "--save-policy",
+        choices=SAVE_POLICIES,
+        default="every_step",
+        help="Which steps outputs are saved.",
+    )
+    parser.add_argument(
+        "--saved-steps",
+        nargs="+",
+        default=None,
+        help="Process labels (GRAD, BCG, PREP, ASR) saved by selected_steps.",
+    )
+    parser.add_argument(
+        "--async-save",
+        action="store_true",
+        help="Write the FIF files in a background thread.",
+    )
+    parser.add_argument(
+        "--read-mode",
+        choices=READ_MODES,
+        default="preload",
+        help="Load the recordings in memory, read them lazily or memory "
+        "map them.",
+    )
+    parser.add_argument(
+        "--decode-cache",
+        action="store_true",
+        help="Decode the recordings once to FIF in DERIVATIVES/decoded.",
+    )
+    parser.add_argument(
+        "--layout-database",
+        type=str,
+        default=None,
+        help="Folder of the index of the dataset. Defaults to "
+        "DERIVATIVES/bids_layout.",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Index the dataset again even if its folders did not change.",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=list(OUTPUT_FORMATS),
+        default="fif",
+        help="Save the outputs as FIF or as compressed HDF5 files (requires "
+        "the hdf5 extra).",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="double",
+        help="Keep the data in double or single precision between the steps.",
+    )
+    parser.add_argument(
+        "--validate-precision",
+        action="store_true",
+        help="Report the deviation of the single precision results instead "
+        "of cleaning the files.",
+    )
+    parser.add_argument(
+        "--metrics-store",
+        action="store_true",
+        help="Update the quality metrics of each file in "
+        "DERIVATIVES/quality_metrics.sqlite once it is cleaned.",
+    )
+    parser.add_argument(
+        "--delta-storage",
+        action="store_true",
+        help="Save the output of each step after the first saved one as its "
+        "changes to the previous saved output (requires the hdf5 extra).",
+    )
+    parser.add_argument(
+        "--write-format",
+        choices=WRITE_FORMATS,
+        default="single",
+        help="Precision of the saved FIF files.",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="none",
+        help="Flush the saved files (file) and their renaming (directory) to "
+        "the storage.",
+    )
+    parser.add_argument(
+        "--split-size",
+        type=str,
+        default="2GB",
+        help="Maximum size of each saved FIF file.",
+    )
+    parser.add_argument(
+        "--write-queue-size",
+        type=int,
+        default=2,
+        help="Maximum number of outputs waiting for the background writer.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the variants already done according to the job ledger.",
+    )
+    parser.add_argument(
+        "--streaming-asr",
+        action="store_true",
+        help="Calibrate ASR on a segment and clean the data window by window.",
+    )
+    parser.add_argument(
+        "--asr-window-duration",
+        type=float,
+        default=30.0,
+        help="Duration in seconds of the windows of the streaming ASR.",
+    )
+    parser.add_argument(
+        "--asr-calibration",
+        choices=("file", "session"),
+        default="file",
+        help="Fit ASR on each file or once per subject-session.",
+    )
+    parser.add_argument(
+        "--asr-calibration-run",
+        type=int,
+        default=None,
+        help="Run on which the session ASR calibration is fitted.",
+    )
+    parser.add_argument(
+        "--pyprep-n-jobs",
+        type=int,
+        default=1,
+        help="Number of parallel jobs of PyPrep, -1 uses all the cores.",
+    )
+    parser.add_argument(
+        "--pyprep-random-state",
+        type=int,
+        default=None,
+        help="Seed of the PyPrep RANSAC for reproducible results.",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="Resample the data after the gradient and BCG cleaning for a "
+        "quick preview. The outputs are saved in the PREVIEW folders.",
+    )
+    parser.add_argument(
+        "--preview-sfreq",
+        type=float,
+        default=250.0,
+        help="Sampling frequency in Hz of the preview.",
+    )
+    return parser.parse_args(argv)
 
 def run_cbin_cleaner(cleaner: CleanerPipelines) -> CleanerPipelines:
     cleaner.read_raw()
@@ -53,30 +271,683 @@ def run_cbin_cleaner_pyprep_asr(cleaner: CleanerPipelines) -> CleanerPipelines:
     cleaner.run_pyprep()
     cleaner.run_asr()
     return cleaner
-    
-def main(reading_path):
-   
-    layout = bids.BIDSLayout(reading_path)
-    file_list = layout.get(extension=".set")
 
+
+def run_pyprep(cleaner: CleanerPipelines, **kwargs: Any) -> CleanerPipelines:
+    """Run PyPrep on a pipeline.
+
+    Args:
+        cleaner (CleanerPipelines): The pipeline.
+        **kwargs: The arguments of CleanerPipelines.run_pyprep.
+
+    Returns:
+        CleanerPipelines: The pipeline with the cleaned data.
+    """
+    cleaner.run_pyprep(**kwargs)
+    return cleaner
+
+
+def run_asr(cleaner: CleanerPipelines, **kwargs: Any) -> CleanerPipelines:
+    """Run ASR on a pipeline.
+
+    Args:
+        cleaner (CleanerPipelines): The pipeline.
+        **kwargs: The arguments of CleanerPipelines.run_asr.
+
+    Returns:
+        CleanerPipelines: The pipeline with the cleaned data.
+    """
+    cleaner.run_asr(**kwargs)
+    return cleaner
+
+
+def run_preview(cleaner: CleanerPipelines, **kwargs: Any) -> CleanerPipelines:
+    """Resample the data of a pipeline for the preview mode.
+
+    Args:
+        cleaner (CleanerPipelines): The pipeline.
+        **kwargs: The arguments of CleanerPipelines.run_preview_resampling.
+
+    Returns:
+        CleanerPipelines: The pipeline with the resampled data.
+    """
+    cleaner.run_preview_resampling(**kwargs)
+    return cleaner
+
+
+# Each step takes a CleanerPipelines object and returns it once processed.
+# The keyword arguments given for a step in step_kwargs are passed to it.
+PIPELINE_STEPS = {
+    "cbin": run_cbin_cleaner,
+    "pyprep": run_pyprep,
+    "asr": run_asr,
+    "preview": run_preview,
+}
+
+
+def build_pipeline_tree(variants: dict[str, tuple[str, ...]]) -> dict:
+    """Merge the variants' step sequences into a prefix tree.
+
+    Each node is a dictionary holding the name of the variants ending at this
+    node and the children nodes indexed by step name.
+
+    Args:
+        variants (dict[str, tuple[str, ...]]): The step sequence of each variant.
+
+    Returns:
+        dict: The root node of the tree.
+    """
+    root = {"variants": [], "children": {}}
+    for variant_name, steps in variants.items():
+        node = root
+        for step in steps:
+            node = node["children"].setdefault(
+                step, {"variants": [], "children": {}}
+            )
+        node["variants"].append(variant_name)
+    return root
+
+
+def list_tree_variants(node: dict) -> list[str]:
+    """List the variants of a pipeline tree."""
+    variants = list(node["variants"])
+    for child_node in node["children"].values():
+        variants += list_tree_variants(child_node)
+    return variants
+
+
+def planned_output_directories(
+    descriptor: RecordingDescriptor,
+    node: dict,
+    save_policy: str = "every_step",
+    saved_steps: list[str] | None = None,
+    process_history: tuple[str, ...] = (),
+) -> list:
+    """List the folders a pipeline tree will save a recording in.
+
+    Args:
+        descriptor (RecordingDescriptor): The recording.
+        node (dict): The node of the tree built by build_pipeline_tree.
+        save_policy (str, optional): The save policy of the pipeline.
+        saved_steps (list[str], optional): The process labels saved with the
+            'selected_steps' policy.
+        process_history (tuple[str, ...], optional): The process history at
+            the node.
+
+    Returns:
+        list[Path]: The output folders.
+    """
+    saved = bool(node["variants"]) or save_policy == "every_step" or (
+        save_policy == "selected_steps"
+        and bool(process_history)
+        and process_history[-1] in (saved_steps or [])
+    )
+    directories = list()
+    if process_history and saved:
+        directories.append(descriptor.modality_path(list(process_history)))
+    for step_name, child_node in node["children"].items():
+        directories += planned_output_directories(
+            descriptor,
+            child_node,
+            save_policy,
+            saved_steps,
+            process_history + step_labels(step_name, descriptor),
+        )
+    return directories
+
+
+def run_pipeline_tree(
+    cleaner: CleanerPipelines,
+    node: dict,
+    steps: dict = PIPELINE_STEPS,
+    on_completed: Callable[[CleanerPipelines, list[str]], None] | None = None,
+    step_kwargs: dict[str, dict] | None = None,
+) -> list[str]:
+    """Run a pipeline tree depth first on a single file.
+
+    The pipeline is forked at every branch point so each child continues from
+    the same state. The forks share the data of the parent until a step
+    modifies it (see CleanerPipelines.fork). The last child reuses the parent
+    object, which gets the buffer back without a copy once the other children
+    are done.
+    The output of a variant is saved when its last step is reached if the save
+    policy did not already do it.
+
+    Args:
+        cleaner (CleanerPipelines): The pipeline at the state of the node.
+        node (dict): The node of the tree built by build_pipeline_tree.
+        steps (dict, optional): The callable to run for each step name.
+        on_completed (Callable, optional): Called with the pipeline and the
+            name of the variants ending at a node once their output is saved.
+        step_kwargs (dict[str, dict], optional): The keyword arguments of the
+            steps indexed by step name.
+
+    Returns:
+        list[str]: The name of the variants that were completed.
+    """
+    completed = list(node["variants"])
+    if completed:
+        cleaner.save_final()
+        if on_completed is not None:
+            on_completed(cleaner, completed)
+    children = list(node["children"].items())
+    for index, (step_name, child_node) in enumerate(children):
+        if index < len(children) - 1:
+            branch = cleaner.fork()
+        else:
+            branch = cleaner
+        branch = steps[step_name](branch,
+                                  **(step_kwargs or {}).get(step_name, {}))
+        completed += run_pipeline_tree(branch,
+                                       child_node,
+                                       steps,
+                                       on_completed,
+                                       step_kwargs)
+    return completed
+
+
+def process_file(
+    BIDSFile_object: bids.layout.BIDSFile | RecordingDescriptor,
+    pipeline_tree: dict,
+    cleaner_kwargs: dict | None = None,
+    ledger: JobLedger | None = None,
+    step_kwargs: dict[str, dict] | None = None,
+    metrics_store: MetricsStore | None = None,
+    compared_variants: dict[str, tuple[str, ...]] | None = None,
+) -> str | None:
+    """Run all the variants of the pipeline tree on a single file.
+
+    With a metrics store, the quality metrics of the file are updated once
+    its variants are done. An error of the metrics is printed, it does not
+    fail the file.
+
+    Args:
+        BIDSFile_object (bids.layout.BIDSFile | RecordingDescriptor): The
+            file to clean.
+        pipeline_tree (dict): The tree built by build_pipeline_tree.
+        cleaner_kwargs (dict, optional): The keyword arguments passed to
+            CleanerPipelines.
+        ledger (JobLedger, optional): The ledger where the state of each
+            variant is recorded.
+        step_kwargs (dict[str, dict], optional): The keyword arguments of the
+            steps indexed by step name.
+        metrics_store (MetricsStore, optional): The store of the quality
+            metrics. The metrics are not computed if None.
+        compared_variants (dict[str, tuple[str, ...]], optional): The step
+            sequence of the variants compared in the metrics store.
+            Defaults to PIPELINE_VARIANTS.
+
+    Returns:
+        str | None: The error message to report if the processing failed.
+    """
+    filename = BIDSFile_object.filename
+    variants = list_tree_variants(pipeline_tree)
+    started = time.time()
+    done = list()
+
+    def record_completed(
+        cleaner: CleanerPipelines,
+        completed: list[str],
+    ) -> None:
+        done.extend(completed)
+        if ledger is None:
+            return
+        # The checksum must be computed on the complete file.
+        if cleaner.raw_writer is not None:
+            cleaner.raw_writer.flush()
+        outputs = [JobLedger.describe_output(cleaner.last_saved_filename)]
+        for variant in completed:
+            ledger.record(filename,
+                          variant,
+                          "done",
+                          started=started,
+                          duration=time.time() - started,
+                          outputs=outputs)
+
+    if ledger is not None:
+        for variant in variants:
+            ledger.record(filename, variant, "running", started=started)
+    try:
+        cleaner = CleanerPipelines(BIDSFile_object, **(cleaner_kwargs or {}))
+        try:
+            run_pipeline_tree(cleaner,
+                              pipeline_tree,
+                              on_completed=record_completed,
+                              step_kwargs=step_kwargs)
+        finally:
+            cleaner.close()
+            cleaner.export_step_metrics()
+    except Exception as e:
+        if ledger is not None:
+            for variant in variants:
+                if variant not in done:
+                    ledger.record(filename,
+                                  variant,
+                                  "failed",
+                                  started=started,
+                                  duration=time.time() - started,
+                                  error=str(e))
+        message = f"""filename: {str(filename)}
+        error:{str(e)}
+
+        """
+        return message
+    if metrics_store is not None:
+        try:
+            update_metrics_store(metrics_store,
+                                 cleaner.BIDSFile,
+                                 compared_variants or PIPELINE_VARIANTS)
+        except Exception as e:
+            print(f"Error while updating the quality metrics: {e}")
+    return None
+
+
+def validate_precision(
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    cleaner_kwargs: dict | None = None,
+    step_kwargs: dict[str, dict] | None = None,
+) -> pd.DataFrame:
+    """Measure the deviation of the single precision results on a file.
+
+    Each variant is run by two pipelines in lockstep, in single and double
+    precision, and their data is compared after each step. Nothing is saved
+    and the step cache is not used, so both pipelines compute every step.
+
+    Args:
+        descriptor (RecordingDescriptor): The recording.
+        variants (dict, optional): The step sequence of each variant.
+        cleaner_kwargs (dict, optional): The keyword arguments passed to
+            CleanerPipelines.
+        step_kwargs (dict[str, dict], optional): The keyword arguments of the
+            steps indexed by step name.
+
+    Returns:
+        pd.DataFrame: The maximum absolute deviation and the maximum
+            deviation relative to the largest absolute value of the double
+            precision data, for each variant and step.
+    """
+    step_kwargs = copy.deepcopy(step_kwargs or {})
+    # RANSAC draws random channels, both pipelines need the same draws.
+    pyprep_kwargs = step_kwargs.setdefault("pyprep", {})
+    if pyprep_kwargs.get("random_state") is None:
+        pyprep_kwargs["random_state"] = 0
+    cleaner_kwargs = {
+        **(cleaner_kwargs or {}),
+        "step_cache": None,
+        "save_policy": "selected_steps",
+        "saved_steps": [],
+        "async_save": False,
+    }
+    records = list()
+    for variant, steps in variants.items():
+        cleaners = {
+            precision: CleanerPipelines(descriptor,
+                                        **{**cleaner_kwargs,
+                                           "precision": precision})
+            for precision in PRECISIONS
+        }
+        for step in steps:
+            for precision, cleaner in cleaners.items():
+                cleaners[precision] = PIPELINE_STEPS[step](
+                    cleaner, **step_kwargs.get(step, {})
+                )
+            double = cleaners["double"].raw.get_data()
+            single = cleaners["single"].raw.get_data()
+            record = dict(
+                file=descriptor.filename,
+                variant=variant,
+                step=step,
+                process_history="_".join(cleaners["double"].process_history),
+                max_abs_deviation=np.nan,
+                max_relative_deviation=np.nan,
+            )
+            if double.shape == single.shape:
+                deviation = np.abs(single - double).max(initial=0)
+                scale = np.abs(double).max(initial=0)
+                record["max_abs_deviation"] = deviation
+                record["max_relative_deviation"] = (
+                    deviation / scale if scale else np.nan
+                )
+            records.append(record)
+            del double, single
+    return pd.DataFrame.from_records(records)
+
+
+def _validate_precision_in_worker(
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]],
+    cleaner_kwargs: dict,
+    step_kwargs: dict[str, dict] | None,
+) -> pd.DataFrame:
+    """Validate the precision on a file, reporting its errors (pool worker)."""
+    try:
+        return validate_precision(descriptor,
+                                  variants,
+                                  cleaner_kwargs,
+                                  step_kwargs)
+    except Exception as e:
+        print(f"Error while validating {descriptor.filename}: {e}")
+        return pd.DataFrame()
+
+
+def _address_space_size() -> int:
+    """Get the size of the address space of the process in bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _init_worker(max_memory_per_worker: int | None) -> None:
+    """Cap the memory of a worker process.
+
+    The ceiling is applied on the address space of the process (RLIMIT_AS)
+    because Linux does not enforce RLIMIT_RSS. The address space counts
+    virtual memory that is not resident (the libraries, the reserved thread
+    arenas of BLAS, the memory mapped files), so the ceiling is added to the
+    address space already mapped when the worker starts. The memory mapped
+    later (e.g. the memmap read mode) still counts against it. An allocation
+    above it raises a MemoryError that is reported like any other processing
+    error.
+    """
+    if max_memory_per_worker is not None:
+        limit = _address_space_size() + max_memory_per_worker * 1024**2
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _process_file_in_worker(
+    descriptor: RecordingDescriptor,
+    pipeline_tree: dict,
+    cleaner_kwargs: dict | None = None,
+    ledger: JobLedger | None = None,
+    step_kwargs: dict[str, dict] | None = None,
+    metrics_store: MetricsStore | None = None,
+    compared_variants: dict[str, tuple[str, ...]] | None = None,
+) -> str | None:
+    """Process a file in a worker process.
+
+    The recording is sent as a RecordingDescriptor, so the workers never
+    need the layout of the dataset.
+    """
+    try:
+        return process_file(descriptor,
+                            pipeline_tree,
+                            cleaner_kwargs,
+                            ledger,
+                            step_kwargs,
+                            metrics_store,
+                            compared_variants)
+    except MemoryError:
+        return f"""filename: {descriptor.filename}
+        error:the worker exceeded its memory ceiling
+
+        """
+
+
+def main(
+    reading_path,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    n_jobs: int = 1,
+    max_memory_per_worker: int | None = None,
+    max_files_per_worker: int | None = None,
+    cache_dir: str | os.PathLike | None = None,
+    cache_max_size: int | None = None,
+    save_policy: str = "every_step",
+    saved_steps: list[str] | None = None,
+    async_save: bool = False,
+    read_mode: str = "preload",
+    decode_cache: bool = False,
+    resume: bool = False,
+    step_kwargs: dict[str, dict] | None = None,
+    layout_database: str | os.PathLike | None = None,
+    reindex: bool = False,
+    write_format: str = "single",
+    fsync_policy: str = "none",
+    split_size: str | int = "2GB",
+    write_queue_size: int = 2,
+    output_format: str = "fif",
+    delta_storage: bool = False,
+    metrics_store: bool = False,
+    precision: str = "double",
+    validate: bool = False,
+    preview: bool = False,
+):
+    """Run the pipeline variants on every EEGLAB file of a BIDS dataset.
+
+    The state of every file and variant is recorded in the job ledger
+    (job_ledger.jsonl in the DERIVATIVES folder). The resources used by each
+    step are appended to step_metrics.jsonl and summarized per step in
+    step_metrics_summary.csv.
+
+    Args:
+        reading_path (str | os.PathLike): The path to the BIDS dataset.
+        variants (dict, optional): The step sequence of each variant.
+        n_jobs (int, optional): The number of worker processes. With 1 the
+            files are processed serially in the current process.
+        max_memory_per_worker (int, optional): The memory ceiling of each
+            worker process in MB, on top of the memory mapped when it
+            starts. It applies to the virtual memory, see _init_worker.
+        max_files_per_worker (int, optional): The number of files after which
+            a worker process is replaced by a fresh one to release the memory
+            accumulated by MNE and pyprep.
+        cache_dir (str | os.PathLike, optional): The directory of the step
+            cache. The steps are always recomputed if None.
+        cache_max_size (int, optional): The maximum size of the step cache in
+            MB.
+        save_policy (str, optional): When the steps outputs are saved, see
+            CleanerPipelines.
+        saved_steps (list[str], optional): The process labels saved with the
+            'selected_steps' policy.
+        async_save (bool, optional): Write the FIF files in a background
+            thread of each process.
+        read_mode (str, optional): How the recordings are read, see
+            CleanerPipelines.read_raw. Defaults to 'preload'.
+        decode_cache (bool, optional): Read the recordings from their FIF
+            copy in DERIVATIVES/decoded, decoding them on their first read.
+            Defaults to False.
+        resume (bool, optional): Skip the variants recorded as done in the
+            ledger whose outputs are intact. Defaults to False.
+        step_kwargs (dict[str, dict], optional): The keyword arguments of the
+            steps indexed by step name, e.g. {"asr": {"streaming": True}}.
+        layout_database (str | os.PathLike, optional): The folder of the
+            persisted index of the dataset. Defaults to
+            DERIVATIVES/bids_layout. The dataset is only indexed again when
+            its folders changed.
+        reindex (bool, optional): Index the dataset again even if its
+            folders did not change. Defaults to False.
+        write_format (str, optional): The precision of the saved data,
+            'single' or 'double'. Defaults to 'single'.
+        fsync_policy (str, optional): When the saved files are flushed to the
+            storage, see raw_writer.write_raw_atomic. Defaults to 'none'.
+        split_size (str | int, optional): The maximum size of each saved FIF
+            file. Defaults to '2GB'.
+        write_queue_size (int, optional): The maximum number of outputs
+            waiting for the background writer. Defaults to 2.
+        output_format (str, optional): 'fif' or 'hdf5', see CleanerPipelines.
+            Defaults to 'fif'.
+        delta_storage (bool, optional): Save the derived outputs as their
+            changes to their parent output, see CleanerPipelines.
+            Defaults to False.
+        metrics_store (bool, optional): Update the quality metrics of each
+            file in DERIVATIVES/quality_metrics.sqlite once its variants are
+            done (see quality_metrics). Defaults to False.
+        precision (str, optional): The precision of the data between the
+            steps, 'double' or 'single', see CleanerPipelines.
+            Defaults to 'double'.
+        validate (bool, optional): Instead of cleaning the files, run every
+            variant in both precisions and save the maximum deviation of the
+            single precision after each step in
+            DERIVATIVES/precision_validation.csv (see validate_precision).
+            Defaults to False.
+        preview (bool, optional): Run the preview version of the variants
+            (see pipeline_variants.preview_variants): the data is resampled
+            after the gradient and BCG cleaning, at the rate given by
+            step_kwargs["preview"]["sfreq"] (250 Hz by default), and the
+            outputs are saved in the folders of the PREVIEW label.
+            Defaults to False.
+
+    The entities and paths of the recordings are resolved once and all the
+    output folders are created before the files are processed.
+    """
+    # The folders of a previous run of the process may have been removed.
+    forget_created_directories()
+    file_list = list_recordings(reading_path, layout_database, reindex)
+    if not file_list:
+        return
+    if preview:
+        variants = preview_variants(variants)
+    cleaner_kwargs = dict(
+        save_policy=save_policy,
+        saved_steps=saved_steps,
+        async_save=async_save,
+        read_mode=read_mode,
+        write_format=write_format,
+        fsync_policy=fsync_policy,
+        split_size=split_size,
+        write_queue_size=write_queue_size,
+        output_format=output_format,
+        delta_storage=delta_storage,
+        precision=precision,
+    )
+    if cache_dir is not None:
+        cleaner_kwargs["step_cache"] = StepCache(
+            cache_dir,
+            max_size=cache_max_size * 1024**2 if cache_max_size else None,
+        )
+
+    derivatives_path = file_list[0].derivatives_path
+    if decode_cache:
+        cleaner_kwargs["decode_cache"] = DecodeCache(
+            derivatives_path.joinpath("decoded")
+        )
+    if validate:
+        if n_jobs == 1:
+            reports = [
+                _validate_precision_in_worker(descriptor,
+                                              variants,
+                                              cleaner_kwargs,
+                                              step_kwargs)
+                for descriptor in file_list
+            ]
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=(max_memory_per_worker,),
+            ) as executor:
+                reports = list(executor.map(
+                    _validate_precision_in_worker,
+                    file_list,
+                    [variants] * len(file_list),
+                    [cleaner_kwargs] * len(file_list),
+                    [step_kwargs] * len(file_list),
+                ))
+        report = pd.concat(reports, ignore_index=True)
+        report.to_csv(derivatives_path.joinpath("precision_validation.csv"),
+                      index=False)
+        print(report.to_string(index=False))
+        return
+    ledger = JobLedger(derivatives_path.joinpath("job_ledger.jsonl"))
+    store = (
+        MetricsStore(derivatives_path.joinpath(METRICS_DATABASE))
+        if metrics_store else None
+    )
+    records = ledger.read() if resume else dict()
+    jobs = list()
     for BIDSFile_object in file_list:
-        #Totally sub-optimal need to fix it
-        cleaner_cbin = CleanerPipelines(BIDSFile_object)
-        cleaner_cbin_asr = CleanerPipelines(BIDSFile_object)
-        cleaner_cbin_pyprepr_asr = CleanerPipelines(BIDSFile_object)
-        if any([BIDSFile_object.task == "checker",
-                BIDSFile_object.task == "checkeroff"]):
-            try:
-                run_cbin_cleaner(cleaner_cbin)
-                run_cbin_cleaner_asr(cleaner_cbin_asr)
-                run_cbin_cleaner_pyprep_asr(cleaner_cbin_pyprepr_asr)
-
-            except Exception as e:
-                message = f"""filename: {str(BIDSFile_object.filename)}
-                error:{str(e)}
-
-                """
-                cleaner_cbin.write_report(message)
+        file_variants = dict(variants)
+        if resume:
+            for variant in ledger.completed_variants(BIDSFile_object.filename,
+                                                     list(variants),
+                                                     records):
+                file_variants.pop(variant)
+        if not file_variants:
+            continue
+        for variant in file_variants:
+            ledger.record(BIDSFile_object.filename, variant, "pending")
+        jobs.append((BIDSFile_object, build_pipeline_tree(file_variants)))
+    make_directories([derivatives_path] + [
+        directory
+        for BIDSFile_object, pipeline_tree in jobs
+        for directory in planned_output_directories(BIDSFile_object,
+                                                    pipeline_tree,
+                                                    save_policy,
+                                                    saved_steps)
+    ])
+
+    if n_jobs == 1:
+        messages = [
+            process_file(BIDSFile_object,
+                         pipeline_tree,
+                         cleaner_kwargs,
+                         ledger,
+                         step_kwargs,
+                         store,
+                         variants)
+            for BIDSFile_object, pipeline_tree in jobs
+        ]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_worker,
+            initargs=(max_memory_per_worker,),
+            max_tasks_per_child=max_files_per_worker,
+        ) as executor:
+            messages = list(executor.map(
+                _process_file_in_worker,
+                [BIDSFile_object for BIDSFile_object, _ in jobs],
+                [pipeline_tree for _, pipeline_tree in jobs],
+                [cleaner_kwargs] * len(jobs),
+                [ledger] * len(jobs),
+                [step_kwargs] * len(jobs),
+                [store] * len(jobs),
+                [variants] * len(jobs),
+            ))
+
+    for (BIDSFile_object, _), message in zip(jobs, messages):
+        if message:
+            CleanerPipelines(BIDSFile_object).write_report(message)
+    if derivatives_path.joinpath("step_metrics.jsonl").is_file():
+        summarize_step_metrics(derivatives_path)
 
 if __name__ == "__main__":
-    main(args.path)
\ No newline at end of file
+    args = parse_arguments()
+    step_kwargs = dict(
+        asr=dict(calibration=args.asr_calibration,
+                 calibration_run=args.asr_calibration_run),
+        pyprep=dict(n_jobs=args.pyprep_n_jobs,
+                    random_state=args.pyprep_random_state),
+        preview=dict(sfreq=args.preview_sfreq),
+    )
+    if args.streaming_asr:
+        step_kwargs["asr"].update(streaming=True,
+                                  window_duration=args.asr_window_duration)
+    main(
+        args.path,
+        n_jobs=args.n_jobs,
+        max_memory_per_worker=args.max_memory_per_worker,
+        max_files_per_worker=args.max_files_per_worker,
+        cache_dir=args.cache_dir,
+        cache_max_size=args.cache_max_size,
+        save_policy=args.save_policy,
+        saved_steps=args.saved_steps,
+        async_save=args.async_save,
+        read_mode=args.read_mode,
+        decode_cache=args.decode_cache,
+        resume=args.resume,
+        step_kwargs=step_kwargs,
+        layout_database=args.layout_database,
+        reindex=args.reindex,
+        write_format=args.write_format,
+        fsync_policy=args.fsync,
+        split_size=args.split_size,
+        write_queue_size=args.write_queue_size,
+        output_format=args.output_format,
+        delta_storage=args.delta_storage,
+        metrics_store=args.metrics_store,
+        precision=args.precision,
+        validate=args.validate_precision,
+        preview=args.preview,
+    )
\ No newline at end of file
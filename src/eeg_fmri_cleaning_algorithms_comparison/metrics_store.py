@@ -0,0 +1,276 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Persistent store of the quality metrics of every recording.
+
+The metrics computed by quality_metrics are stored per file in an SQLite
+database of the DERIVATIVES folder, with their average over the channels.
+When a recording is cleaned again, only its rows are replaced, so the
+dataset level aggregates (group means, rankings of the variants) are
+computed from the stored summaries by SQLite without reading any output.
+
+Each file is stored with a signature of the outputs it was computed from,
+so an unchanged file is not compared again. The database uses the WAL
+journal, so the worker processes can update it concurrently.
+"""
+
+import contextlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+
+# Name of the database in the DERIVATIVES folder.
+METRICS_DATABASE = "quality_metrics.sqlite"
+ENTITY_COLUMNS = ("subject", "session", "task", "run")
+# Metrics whose best variant has the highest value, the others are ranked
+# from the lowest value.
+HIGHER_IS_BETTER = ("snr", "variance_explained")
+CHANNEL_COLUMNS = ("file", *ENTITY_COLUMNS, "variant", "process_history",
+                   "channel", "metric", "value")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    signature TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channel_metrics (
+    file TEXT NOT NULL,
+    subject TEXT,
+    session TEXT,
+    task TEXT,
+    run INTEGER,
+    variant TEXT NOT NULL,
+    process_history TEXT,
+    channel TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (file, variant, channel, metric)
+);
+CREATE TABLE IF NOT EXISTS file_metrics (
+    file TEXT NOT NULL,
+    subject TEXT,
+    session TEXT,
+    task TEXT,
+    run INTEGER,
+    variant TEXT NOT NULL,
+    process_history TEXT,
+    metric TEXT NOT NULL,
+    value REAL,
+    n_channels INTEGER,
+    PRIMARY KEY (file, variant, metric)
+);
+CREATE INDEX IF NOT EXISTS file_metrics_metric
+    ON file_metrics (metric, variant);
+"""
+
+
+class MetricsStore:
+    """SQLite store of the quality metrics of the recordings.
+
+    Only the path of the database is held, a connection is opened by each
+    operation. The store can be sent to the worker processes.
+    """
+    def __init__(self, database_path: str | os.PathLike) -> None:
+        """Create the database if it does not exist.
+
+        Args:
+            database_path (str | os.PathLike): The SQLite file.
+        """
+        self.database_path = Path(database_path)
+        self.database_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Open a connection, committed on success and always closed."""
+        connection = sqlite3.connect(self.database_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _query(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        """Read the result of a query."""
+        with self._transaction() as connection:
+            return pd.read_sql_query(sql, connection, params=params)
+
+    def signature(self, filename: str) -> str | None:
+        """Get the signature of the outputs a file was last compared with."""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT signature FROM files WHERE file = ?", (filename,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def update_file(
+        self,
+        filename: str,
+        metrics: pd.DataFrame,
+        signature: str = "",
+    ) -> None:
+        """Replace the metrics of a file and its channel averages.
+
+        Args:
+            filename (str): The name of the recording.
+            metrics (pd.DataFrame): The table of quality_metrics.compare_file
+                for this file.
+            signature (str, optional): The signature of the outputs the
+                metrics were computed from.
+        """
+        table = metrics.reindex(columns=list(CHANNEL_COLUMNS)).astype(object)
+        # The NumPy scalars and NaN are converted to SQLite values.
+        rows = table.where(table.notna(), None).values.tolist()
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM channel_metrics WHERE file = ?",
+                               (filename,))
+            connection.execute("DELETE FROM file_metrics WHERE file = ?",
+                               (filename,))
+            connection.executemany(
+                f"INSERT INTO channel_metrics ({', '.join(CHANNEL_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(CHANNEL_COLUMNS))})",
+                rows,
+            )
+            # AVG and COUNT skip the NULL values (the NaN of the metrics).
+            connection.execute(
+                """
+                INSERT INTO file_metrics
+                SELECT file, subject, session, task, run, variant,
+                       process_history, metric, AVG(value), COUNT(value)
+                FROM channel_metrics WHERE file = ?
+                GROUP BY variant, metric
+                """,
+                (filename,),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                (filename, signature, time.time()),
+            )
+
+    def remove_file(self, filename: str) -> None:
+        """Remove the metrics of a file."""
+        with self._transaction() as connection:
+            for table in ("channel_metrics", "file_metrics", "files"):
+                connection.execute(f"DELETE FROM {table} WHERE file = ?",
+                                   (filename,))
+
+    def channel_metrics(self) -> pd.DataFrame:
+        """Get the metrics of every channel of every file."""
+        return self._query(
+            f"SELECT {', '.join(CHANNEL_COLUMNS)} FROM channel_metrics "
+            "ORDER BY file, variant, channel, metric"
+        )
+
+    def file_summaries(self) -> pd.DataFrame:
+        """Get the metrics of every file averaged over the channels."""
+        return self._query(
+            "SELECT * FROM file_metrics ORDER BY file, variant, metric"
+        )
+
+    def group_means(self, by: tuple[str, ...] = ("variant",)) -> pd.DataFrame:
+        """Average the file summaries by group and metric.
+
+        Args:
+            by (tuple[str, ...], optional): The grouping columns, among the
+                entities, 'variant' and 'process_history'.
+                Defaults to ('variant',).
+
+        Returns:
+            pd.DataFrame: The mean, standard deviation and number of files of
+                every group and metric.
+
+        Raises:
+            ValueError: If a grouping column is not supported.
+        """
+        allowed = (*ENTITY_COLUMNS, "variant", "process_history")
+        if not set(by) <= set(allowed):
+            raise ValueError(
+                f"The grouping columns must be among {', '.join(allowed)}."
+            )
+        columns = ", ".join(by)
+        means = self._query(
+            f"""
+            SELECT {columns}, metric,
+                   AVG(value) AS mean,
+                   AVG(value * value) - AVG(value) * AVG(value) AS variance,
+                   COUNT(value) AS n_files
+            FROM file_metrics
+            GROUP BY {columns}, metric
+            ORDER BY metric, {columns}
+            """
+        )
+        means["std"] = means.pop("variance").clip(lower=0) ** 0.5
+        return means
+
+    def rank_variants(
+        self,
+        metric: str,
+        higher_is_better: bool | None = None,
+        exclude: tuple[str, ...] = ("raw",),
+    ) -> pd.DataFrame:
+        """Rank the variants on a metric.
+
+        The variants are ranked within each file, then by their mean rank
+        over the files.
+
+        Args:
+            metric (str): The metric.
+            higher_is_better (bool, optional): The direction of the ranking.
+                True for the metrics of HIGHER_IS_BETTER if None.
+            exclude (tuple[str, ...], optional): The variants left out.
+                Defaults to ('raw',).
+
+        Returns:
+            pd.DataFrame: The mean rank, mean value and number of files of
+                every variant, best first.
+        """
+        if higher_is_better is None:
+            higher_is_better = metric in HIGHER_IS_BETTER
+        order = "DESC" if higher_is_better else "ASC"
+        excluded = ", ".join("?" * len(exclude)) or "NULL"
+        return self._query(
+            f"""
+            SELECT variant,
+                   AVG(rank) AS mean_rank,
+                   AVG(value) AS mean,
+                   COUNT(*) AS n_files
+            FROM (
+                SELECT variant, value,
+                       RANK() OVER (PARTITION BY file
+                                    ORDER BY value {order}) AS rank
+                FROM file_metrics
+                WHERE metric = ? AND value IS NOT NULL
+                      AND variant NOT IN ({excluded})
+            )
+            GROUP BY variant
+            ORDER BY mean_rank
+            """,
+            (metric, *exclude),
+        )
@@ -0,0 +1,144 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Declaration of the pipeline variants and of the recordings they clean.
+
+The process labels of the steps tell where the output of every variant is
+saved in the derivatives. They are kept apart from main_cleaner_pipelines so
+the modules reading the outputs (see quality_metrics) do not depend on the
+runner.
+"""
+
+import os
+
+from layout_cache import load_layout
+from recording_descriptor import RecordingDescriptor, derivatives_root
+
+# Only the recordings of these tasks are cleaned.
+CLEANED_TASKS = ("checker", "checkeroff")
+
+# Process labels added to the history by each step. The labels of the CBIN
+# step depend on the task of the recording (see
+# main_cleaner_pipelines.run_cbin_cleaner).
+CBIN_TASK_LABELS = {
+    "checker": ("GRAD", "BCG"),
+    "checkeroff": ("BCG",),
+}
+STEP_LABELS = {
+    "pyprep": ("PREP",),
+    "asr": ("ASR",),
+    "preview": ("PREVIEW",),
+}
+
+# Variants are declared as sequences of steps. Variants sharing a prefix
+# (read -> GRAD -> BCG) compute it only once per file.
+PIPELINE_VARIANTS = {
+    "cbin": ("cbin",),
+    "cbin_asr": ("cbin", "asr"),
+    "cbin_pyprep_asr": ("cbin", "pyprep", "asr"),
+}
+
+# The steps that need the full sampling rate of the recordings. In the preview
+# mode, the data is resampled once they are done (see preview_variants).
+FULL_RATE_STEPS = ("cbin",)
+PREVIEW_STEP = "preview"
+
+
+def step_labels(
+    step_name: str,
+    descriptor: RecordingDescriptor,
+) -> tuple[str, ...]:
+    """Get the process labels added by a step on a recording."""
+    if step_name == "cbin":
+        return CBIN_TASK_LABELS.get(descriptor.entities.get("task"), ())
+    return STEP_LABELS.get(step_name, ())
+
+
+def preview_variants(
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+) -> dict[str, tuple[str, ...]]:
+    """Get the preview version of the variants.
+
+    The preview step is inserted after the leading full rate steps of each
+    variant, e.g. ('cbin', 'asr') becomes ('cbin', 'preview', 'asr'), and
+    the variants are renamed with a '_preview' suffix.
+
+    Args:
+        variants (dict[str, tuple[str, ...]], optional): The step sequence of
+            each variant. Defaults to PIPELINE_VARIANTS.
+
+    Returns:
+        dict[str, tuple[str, ...]]: The step sequence of each preview variant.
+    """
+    previews = dict()
+    for variant, steps in variants.items():
+        n_full_rate = 0
+        while n_full_rate < len(steps) and steps[n_full_rate] in FULL_RATE_STEPS:
+            n_full_rate += 1
+        previews[f"{variant}_{PREVIEW_STEP}"] = (
+            steps[:n_full_rate] + (PREVIEW_STEP,) + steps[n_full_rate:]
+        )
+    return previews
+
+
+def variant_histories(
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+) -> dict[str, list[str]]:
+    """Get the process history of the output of each variant."""
+    return {
+        variant: [label for step in steps
+                  for label in step_labels(step, descriptor)]
+        for variant, steps in variants.items()
+    }
+
+
+def list_recordings(
+    reading_path: str | os.PathLike,
+    layout_database: str | os.PathLike | None = None,
+    reindex: bool = False,
+) -> list[RecordingDescriptor]:
+    """List the EEGLAB recordings of the cleaned tasks of a BIDS dataset.
+
+    Args:
+        reading_path (str | os.PathLike): The path to the BIDS dataset.
+        layout_database (str | os.PathLike, optional): The folder of the
+            persisted index of the dataset. Defaults to
+            DERIVATIVES/bids_layout.
+        reindex (bool, optional): Index the dataset again even if its
+            folders did not change. Defaults to False.
+
+    Returns:
+        list[RecordingDescriptor]: The recordings.
+    """
+    if layout_database is None:
+        layout_database = derivatives_root(reading_path).joinpath(
+            "bids_layout"
+        )
+    layout = load_layout(reading_path, layout_database, reset=reindex)
+    return [
+        descriptor for descriptor in map(RecordingDescriptor.from_bids_file,
+                                         layout.get(extension=".set"))
+        if descriptor.entities.get("task") in CLEANED_TASKS
+    ]
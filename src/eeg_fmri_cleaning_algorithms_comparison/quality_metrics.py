@@ -0,0 +1,554 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Quality metrics to compare the outputs of the cleaning variants.
+
+The outputs of all the variants of a recording, and the raw recording
+itself, are read together in aligned chunks of samples. Each chunk is
+stacked in a single array (variant, channel, sample) so every metric is
+computed for all the variants at once with NumPy:
+
+- gradient_residual_power: the power at the slice frequency and its
+  harmonics, left by the gradient artifact.
+- bcg_residual: the RMS of the average of the signal locked to the R peaks
+  of the ECG, left by the BCG artifact.
+- <band>_power: the power in each band of BANDS.
+- snr: the ratio in dB of the power in SIGNAL_BAND to the power in
+  NOISE_BAND.
+- variance_explained: the share of the variance of the reference variant
+  (the first one, e.g. GRAD_BCG) kept by each variant.
+
+The metrics of every channel are returned as a tidy table with one row per
+file, variant, channel and metric. compare_dataset computes them for every
+recording of a dataset in parallel, stores them in the metrics store of the
+DERIVATIVES folder (see metrics_store) and saves the table as
+quality_metrics.csv. The files whose outputs did not change since they were
+stored are not compared again::
+
+    python quality_metrics.py --path /data/BIDS --n-jobs 4
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import mne
+import numpy as np
+import pandas as pd
+from compressed_storage import CompressedRawReader
+from delta_storage import DELTA_SUFFIX, open_raw_reader
+from metrics_store import ENTITY_COLUMNS, METRICS_DATABASE, MetricsStore
+from pipeline_variants import (
+    PIPELINE_VARIANTS,
+    list_recordings,
+    variant_histories,
+)
+from recording_descriptor import RecordingDescriptor
+from scipy.signal import welch
+
+# Frequency bands of the band power metrics in Hz.
+BANDS = {
+    "delta": (1.0, 4.0),
+    "theta": (4.0, 8.0),
+    "alpha": (8.0, 13.0),
+    "beta": (13.0, 30.0),
+    "gamma": (30.0, 45.0),
+}
+SIGNAL_BAND = (1.0, 30.0)
+NOISE_BAND = (70.0, 100.0)
+# Window of the R peak locked average in seconds.
+BCG_WINDOW = (0.0, 0.6)
+# Range of the slice frequency searched when it is not given.
+SLICE_FREQUENCY_RANGE = (5.0, 100.0)
+# Extensions of the saved outputs, in the order they are searched.
+OUTPUT_EXTENSIONS = (DELTA_SUFFIX, ".h5", ".fif")
+RAW_VARIANT = "raw"
+
+Reader = CompressedRawReader | mne.io.BaseRaw
+
+
+def find_output(
+    descriptor: RecordingDescriptor,
+    process_history: list[str],
+) -> Path | None:
+    """Find the saved output of a process history, in any output format."""
+    modality_path = descriptor.modality_path(process_history)
+    for extension in OUTPUT_EXTENSIONS:
+        filename = modality_path.joinpath(descriptor.base_filename + extension)
+        if filename.is_file():
+            return filename
+    return None
+
+
+def volume_frequency(
+    annotations: mne.Annotations,
+    events_name: str = "R128",
+) -> float | None:
+    """Get the volume frequency (1/TR) from the volume markers."""
+    onsets = np.sort(annotations.onset[
+        np.asarray(annotations.description) == events_name
+    ])
+    if len(onsets) < 2:
+        return None
+    return 1 / np.median(np.diff(onsets))
+
+
+def estimate_slice_frequency(
+    freqs: np.ndarray,
+    psd: np.ndarray,
+    volume_frequency: float,
+) -> float | None:
+    """Estimate the slice frequency from the spectrum of the raw recording.
+
+    The slice frequency is a harmonic of the volume frequency. The lowest
+    harmonic of SLICE_FREQUENCY_RANGE whose power, averaged over the
+    channels, reaches half of the maximum of the range is taken, so a
+    harmonic of the slice frequency is not mistaken for it.
+
+    Args:
+        freqs (np.ndarray): The frequencies of the spectrum.
+        psd (np.ndarray): The spectrum, shape (n_channels, n_freqs).
+        volume_frequency (float): The volume frequency in Hz.
+
+    Returns:
+        float | None: The slice frequency, None if no harmonic is in range.
+    """
+    low, high = SLICE_FREQUENCY_RANGE
+    candidates = volume_frequency * np.arange(
+        np.ceil(low / volume_frequency), np.floor(high / volume_frequency) + 1
+    )
+    candidates = candidates[candidates < freqs[-1]]
+    if not len(candidates):
+        return None
+    resolution = freqs[1] - freqs[0]
+    power = psd.mean(axis=0)[np.round(candidates / resolution).astype(int)]
+    return float(candidates[np.flatnonzero(power >= power.max() / 2)[0]])
+
+
+def detect_r_peaks(ecg: np.ndarray, sfreq: float) -> np.ndarray:
+    """Detect the R peaks of an ECG signal with MNE.
+
+    Returns:
+        np.ndarray: The samples of the R peaks.
+    """
+    info = mne.create_info(["ECG"], sfreq, ch_types="ecg")
+    raw = mne.io.RawArray(ecg[np.newaxis], info, verbose=False)
+    events = mne.preprocessing.find_ecg_events(raw,
+                                               ch_name="ECG",
+                                               verbose=False)[0]
+    return np.sort(events[:, 0] - raw.first_samp)
+
+
+def _ecg_channel(info: mne.Info) -> str | None:
+    """Find the ECG channel by type, or by name when it is typed misc."""
+    picks = mne.pick_types(info, ecg=True)
+    if len(picks):
+        return info["ch_names"][picks[0]]
+    for name in info["ch_names"]:
+        if "ecg" in name.lower():
+            return name
+    return None
+
+
+def _band_power(
+    freqs: np.ndarray,
+    psd: np.ndarray,
+    band: tuple[float, float],
+) -> np.ndarray:
+    """Integrate the spectra over a band, NaN if it exceeds the Nyquist."""
+    low, high = band
+    if high > freqs[-1]:
+        return np.full(psd.shape[:-1], np.nan)
+    mask = (freqs >= low) & (freqs < high)
+    return psd[..., mask].sum(axis=-1) * (freqs[1] - freqs[0])
+
+
+def _comb_power(
+    freqs: np.ndarray,
+    psd: np.ndarray,
+    fundamental: float,
+) -> np.ndarray:
+    """Integrate the spectra on the bins around the harmonics of a frequency.
+
+    The bin of each harmonic and its two neighbours are summed, which
+    covers the spread of a harmonic between bins.
+    """
+    resolution = freqs[1] - freqs[0]
+    harmonics = fundamental * np.arange(1, int(freqs[-1] // fundamental) + 1)
+    bins = np.round(harmonics / resolution).astype(int)
+    bins = np.unique(np.clip(bins[:, np.newaxis] + [-1, 0, 1],
+                             0,
+                             len(freqs) - 1))
+    return psd[..., bins].sum(axis=-1) * resolution
+
+
+def compare_outputs(
+    readers: dict[str, Reader],
+    chunk_duration: float = 20.0,
+    segment_duration: float = 4.0,
+    slice_frequency: float | None = None,
+    events_name: str = "R128",
+) -> pd.DataFrame:
+    """Compute the quality metrics of the outputs of a recording.
+
+    The first reader is the reference: the R peaks are detected on its ECG
+    channel, the volume markers are taken from its annotations and the
+    variance explained is computed against it. The EEG channels found in
+    all the readers are compared, over the samples found in all of them.
+    The readers with another sampling frequency than the reference are
+    left out.
+
+    Args:
+        readers (dict[str, Reader]): The opened outputs by variant name. A
+            reader is an MNE raw object or a reader of open_raw_reader.
+        chunk_duration (float, optional): The duration of the chunks read at
+            once in seconds. Defaults to 20.
+        segment_duration (float, optional): The duration of the Welch
+            segments in seconds, which sets the frequency resolution.
+            Defaults to 4.
+        slice_frequency (float, optional): The slice frequency of the fMRI
+            sequence in Hz. It is estimated from the spectrum of the 'raw'
+            reader (the reference otherwise) if None.
+        events_name (str, optional): The description of the volume markers.
+            Defaults to 'R128'.
+
+    Returns:
+        pd.DataFrame: The columns variant, channel, metric and value.
+    """
+    reference_name, reference = next(iter(readers.items()))
+    sfreq = reference.info["sfreq"]
+    skipped = [name for name, reader in readers.items()
+               if reader.info["sfreq"] != sfreq]
+    for name in skipped:
+        print(f"The variant {name} is not compared: its sampling frequency "
+              f"differs from {reference_name}.")
+    names = [name for name in readers if name not in skipped]
+    eeg_names = [reference.ch_names[pick]
+                 for pick in mne.pick_types(reference.info, eeg=True)]
+    channels = [name for name in eeg_names
+                if all(name in readers[variant].ch_names for variant in names)]
+    n_times = min(readers[name].n_times for name in names)
+    n_per_segment = int(segment_duration * sfreq)
+    if n_times < n_per_segment:
+        raise ValueError(
+            "The recording is shorter than a segment of the spectra."
+        )
+
+    ecg_name = _ecg_channel(reference.info)
+    peaks = (
+        detect_r_peaks(reference.get_data(picks=[ecg_name],
+                                          stop=n_times)[0], sfreq)
+        if ecg_name is not None else np.array([], dtype=int)
+    )
+    offsets = np.arange(int(BCG_WINDOW[0] * sfreq), int(BCG_WINDOW[1] * sfreq))
+    peaks = peaks[(peaks + offsets[0] >= 0) & (peaks + offsets[-1] < n_times)]
+
+    chunk_samples = max(int(chunk_duration // segment_duration), 1) * (
+        n_per_segment
+    )
+    shape = (len(names), len(channels))
+    psd_sum, psd_weight = 0, 0
+    reference_sum, reference_squares = np.zeros(shape[1]), np.zeros(shape[1])
+    difference_sum, difference_squares = np.zeros(shape), np.zeros(shape)
+    bcg_sum, n_epochs = np.zeros(shape + (len(offsets),)), 0
+    for start in range(0, n_times, chunk_samples):
+        stop = min(start + chunk_samples, n_times)
+        # The chunk is extended to read the epochs starting at its end.
+        read_stop = min(stop + offsets[-1] + 1, n_times)
+        data = np.stack([
+            readers[name].get_data(picks=channels, start=start, stop=read_stop)
+            for name in names
+        ])
+        chunk = data[..., :stop - start]
+        if chunk.shape[-1] >= n_per_segment:
+            freqs, psd = welch(chunk, fs=sfreq, nperseg=n_per_segment, axis=-1)
+            psd_sum = psd_sum + psd * chunk.shape[-1]
+            psd_weight += chunk.shape[-1]
+        reference_sum += chunk[0].sum(axis=-1)
+        reference_squares += np.square(chunk[0]).sum(axis=-1)
+        difference = chunk - chunk[0]
+        difference_sum += difference.sum(axis=-1)
+        difference_squares += np.square(difference).sum(axis=-1)
+
+        chunk_peaks = peaks[(peaks >= start) & (peaks < stop)]
+        if len(chunk_peaks):
+            epochs = data[..., chunk_peaks[:, np.newaxis] - start + offsets]
+            bcg_sum += epochs.sum(axis=2)
+            n_epochs += len(chunk_peaks)
+
+    psd = psd_sum / psd_weight
+    metrics = dict()
+
+    if slice_frequency is None:
+        frequency = volume_frequency(reference.annotations, events_name)
+        spectrum = psd[names.index(RAW_VARIANT) if RAW_VARIANT in names else 0]
+        if frequency is not None:
+            slice_frequency = estimate_slice_frequency(freqs,
+                                                       spectrum,
+                                                       frequency)
+    metrics["gradient_residual_power"] = (
+        _comb_power(freqs, psd, slice_frequency)
+        if slice_frequency is not None else np.full(shape, np.nan)
+    )
+
+    if n_epochs:
+        evoked = bcg_sum / n_epochs
+        evoked -= evoked.mean(axis=-1, keepdims=True)
+        metrics["bcg_residual"] = np.sqrt(np.square(evoked).mean(axis=-1))
+    else:
+        metrics["bcg_residual"] = np.full(shape, np.nan)
+
+    for band_name, band in BANDS.items():
+        metrics[f"{band_name}_power"] = _band_power(freqs, psd, band)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["snr"] = 10 * np.log10(_band_power(freqs, psd, SIGNAL_BAND)
+                                       / _band_power(freqs, psd, NOISE_BAND))
+
+    reference_variance = (reference_squares / n_times
+                          - np.square(reference_sum / n_times))
+    difference_variance = (difference_squares / n_times
+                           - np.square(difference_sum / n_times))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["variance_explained"] = (
+            1 - difference_variance / reference_variance
+        )
+
+    return pd.DataFrame({
+        "variant": np.repeat(names, len(channels) * len(metrics)),
+        "channel": np.tile(np.repeat(channels, len(metrics)), len(names)),
+        "metric": np.tile(list(metrics), len(names) * len(channels)),
+        "value": np.stack(list(metrics.values()), axis=-1).ravel(),
+    })
+
+
+def compare_file(
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    include_raw: bool = True,
+    **kwargs: Any,
+) -> pd.DataFrame:
+    """Compute the quality metrics of the variants of a recording.
+
+    The variants are compared in their order, so the first one found is the
+    reference of compare_outputs. The variants without output are left out.
+
+    Args:
+        descriptor (RecordingDescriptor): The recording.
+        variants (dict, optional): The step sequence of each variant.
+        include_raw (bool, optional): Compare the raw recording too, as the
+            'raw' variant. Defaults to True.
+        **kwargs: The keyword arguments of compare_outputs.
+
+    Returns:
+        pd.DataFrame: The metrics with the file and its entities, the process
+            history of the variants and the columns of compare_outputs.
+    """
+    histories = dict()
+    readers = dict()
+    try:
+        for variant, history in variant_histories(descriptor,
+                                                  variants).items():
+            filename = find_output(descriptor, history)
+            if filename is not None:
+                readers[variant] = open_raw_reader(filename)
+                histories[variant] = "_".join(history)
+        if not readers:
+            return pd.DataFrame()
+        if include_raw:
+            readers[RAW_VARIANT] = mne.io.read_raw(descriptor.path,
+                                                   preload=False,
+                                                   verbose=False)
+            histories[RAW_VARIANT] = ""
+        metrics = compare_outputs(readers, **kwargs)
+    finally:
+        for reader in readers.values():
+            reader.close()
+    metrics.insert(0, "process_history", metrics["variant"].map(histories))
+    for column in reversed(ENTITY_COLUMNS):
+        metrics.insert(0, column, descriptor.entities.get(column))
+    metrics.insert(0, "file", descriptor.filename)
+    return metrics
+
+
+def outputs_signature(
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    **kwargs: Any,
+) -> str:
+    """Describe the outputs of a recording and the options of the comparison.
+
+    The signature changes when an output is written again, so the stored
+    metrics of the recording are outdated.
+    """
+    outputs = list()
+    for variant, history in variant_histories(descriptor, variants).items():
+        filename = find_output(descriptor, history)
+        if filename is not None:
+            stat = filename.stat()
+            outputs.append(
+                [variant, str(filename), stat.st_size, stat.st_mtime_ns]
+            )
+    return json.dumps({"outputs": outputs, "options": kwargs},
+                      sort_keys=True,
+                      default=str)
+
+
+def update_metrics_store(
+    store: MetricsStore,
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    force: bool = False,
+    **kwargs: Any,
+) -> bool:
+    """Compute the metrics of a recording and store them if they changed.
+
+    Args:
+        store (MetricsStore): The store.
+        descriptor (RecordingDescriptor): The recording.
+        variants (dict, optional): The step sequence of each variant.
+        force (bool, optional): Compute the metrics even if the outputs did
+            not change. Defaults to False.
+        **kwargs: The keyword arguments of compare_file.
+
+    Returns:
+        bool: True if the metrics were computed.
+    """
+    signature = outputs_signature(descriptor, variants, **kwargs)
+    if not force and store.signature(descriptor.filename) == signature:
+        return False
+    store.update_file(descriptor.filename,
+                      compare_file(descriptor, variants, **kwargs),
+                      signature)
+    return True
+
+
+def _update_file_in_worker(
+    store: MetricsStore,
+    descriptor: RecordingDescriptor,
+    variants: dict[str, tuple[str, ...]],
+    force: bool,
+    kwargs: dict,
+) -> None:
+    """Update the metrics of a file, reporting its errors (pool worker)."""
+    try:
+        update_metrics_store(store, descriptor, variants, force, **kwargs)
+    except Exception as e:
+        print(f"Error while comparing {descriptor.filename}: {e}")
+
+
+def compare_dataset(
+    reading_path: str | os.PathLike,
+    variants: dict[str, tuple[str, ...]] = PIPELINE_VARIANTS,
+    n_jobs: int = 1,
+    layout_database: str | os.PathLike | None = None,
+    force: bool = False,
+    **kwargs: Any,
+) -> pd.DataFrame:
+    """Compute the quality metrics of every recording of a dataset.
+
+    The files are compared in parallel by n_jobs processes and their
+    metrics are kept in the metrics store of the DERIVATIVES folder. The
+    table of all the files is saved as quality_metrics.csv next to it.
+
+    Args:
+        reading_path (str | os.PathLike): The path to the BIDS dataset.
+        variants (dict, optional): The step sequence of each variant.
+        n_jobs (int, optional): The number of worker processes. With 1 the
+            files are compared serially in the current process.
+        layout_database (str | os.PathLike, optional): The folder of the
+            persisted index of the dataset, see main_cleaner_pipelines.main.
+        force (bool, optional): Compare the files whose outputs did not
+            change too. Defaults to False.
+        **kwargs: The keyword arguments of compare_file.
+
+    Returns:
+        pd.DataFrame: The metrics of all the files.
+    """
+    file_list = list_recordings(reading_path, layout_database)
+    if not file_list:
+        return pd.DataFrame()
+    derivatives_path = file_list[0].derivatives_path
+    store = MetricsStore(derivatives_path.joinpath(METRICS_DATABASE))
+    arguments = [(store, descriptor, variants, force, kwargs)
+                 for descriptor in file_list]
+    if n_jobs == 1:
+        for argument in arguments:
+            _update_file_in_worker(*argument)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_update_file_in_worker, *zip(*arguments)))
+    metrics = store.channel_metrics()
+    # The store can hold files removed from the dataset since.
+    metrics = metrics[metrics["file"].isin(
+        [descriptor.filename for descriptor in file_list]
+    )]
+    metrics.to_csv(derivatives_path.joinpath("quality_metrics.csv"),
+                   index=False)
+    return metrics
+
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command line arguments of the comparison."""
+    parser = argparse.ArgumentParser(
+        description="Compute the quality metrics of the cleaning variants."
+    )
+    parser.add_argument("--path", type=str, help="Path to the BIDS dataset")
+    parser.add_argument("--n-jobs", type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--variants", nargs="+",
+                        choices=list(PIPELINE_VARIANTS),
+                        default=list(PIPELINE_VARIANTS),
+                        help="The variants to compare, the first one is the "
+                        "reference.")
+    parser.add_argument("--no-raw", action="store_true",
+                        help="Do not compare the raw recordings.")
+    parser.add_argument("--chunk-duration", type=float, default=20.0,
+                        help="Duration of the chunks read at once in seconds.")
+    parser.add_argument("--slice-frequency", type=float, default=None,
+                        help="Slice frequency of the fMRI sequence in Hz. "
+                        "Estimated from the raw recordings if unset.")
+    parser.add_argument("--layout-database", type=str, default=None,
+                        help="Folder of the index of the dataset.")
+    parser.add_argument("--force", action="store_true",
+                        help="Compare again the files whose outputs did not "
+                        "change.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    compare_dataset(
+        args.path,
+        variants={variant: PIPELINE_VARIANTS[variant]
+                  for variant in args.variants},
+        n_jobs=args.n_jobs,
+        layout_database=args.layout_database,
+        force=args.force,
+        include_raw=not args.no_raw,
+        chunk_duration=args.chunk_duration,
+        slice_frequency=args.slice_frequency,
+    )
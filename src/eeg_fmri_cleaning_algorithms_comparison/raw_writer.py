@@ -0,0 +1,224 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+
+"""Writer of the cleaned EEG data.
+
+Serializing a full resolution recording to FIF takes a significant share of
+the pipelines wall time. The writer runs the saving jobs in a background
+thread so the next cleaning step can start while the previous output is
+written to disk.
+
+The FIF files are written in a temporary folder and renamed to their
+destination once complete, so an interrupted job never leaves a truncated
+file where a valid output is expected.
+"""
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+import mne
+
+# Precisions of the FIF data. FIF has no half precision format so float16
+# cannot be written.
+WRITE_FORMATS = ("single", "double")
+# 'none' leaves the flushing to the system, 'file' flushes the files before
+# renaming them and 'directory' also flushes the renaming.
+FSYNC_POLICIES = ("none", "file", "directory")
+
+
+def fsync_path(path: str | os.PathLike) -> None:
+    """Flush a file or a folder to the storage."""
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+def write_raw_atomic(
+    raw: mne.io.BaseRaw,
+    destination_filename: str | os.PathLike,
+    fmt: str = "single",
+    split_size: str | int = "2GB",
+    fsync: str = "none",
+) -> Path:
+    """Write a recording to a FIF file atomically.
+
+    The recording is saved in a temporary folder next to the destination. MNE
+    splits the recordings larger than split_size in several files
+    (name.fif, name-1.fif...). They are renamed to the destination in reverse
+    order, the first file last, so the destination is only readable once all
+    its parts are in place. The parts of a previous larger output that are
+    not overwritten are removed.
+
+    Args:
+        raw (mne.io.BaseRaw): The recording.
+        destination_filename (str | os.PathLike): The FIF file to write.
+        fmt (str, optional): The precision of the data, 'single' or 'double'.
+            Defaults to 'single'.
+        split_size (str | int, optional): The maximum size of each file.
+            Defaults to '2GB'.
+        fsync (str, optional): The fsync policy, one of FSYNC_POLICIES.
+            Defaults to 'none'.
+
+    Returns:
+        Path: The destination file.
+
+    Raises:
+        ValueError: If the format or the fsync policy is not supported.
+    """
+    if fmt not in WRITE_FORMATS:
+        raise ValueError(
+            f"The write format must be one of {', '.join(WRITE_FORMATS)}. "
+            "FIF files cannot hold half precision data."
+        )
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(
+            f"The fsync policy must be one of {', '.join(FSYNC_POLICIES)}."
+        )
+    destination_filename = Path(destination_filename)
+    directory = destination_filename.parent
+    temporary_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=directory))
+    try:
+        raw.save(temporary_path.joinpath(destination_filename.name),
+                 fmt=fmt,
+                 split_size=split_size,
+                 split_naming="neuromag",
+                 overwrite=True)
+        parts = sorted(temporary_path.iterdir(),
+                       key=lambda path: (len(path.name), path.name))
+        if fsync != "none":
+            for part in parts:
+                fsync_path(part)
+        for part in reversed(parts):
+            os.replace(part, directory.joinpath(part.name))
+        part_names = {part.name for part in parts}
+        for stale_part in directory.glob(f"{destination_filename.stem}-*.fif"):
+            if (stale_part.name not in part_names
+                    and stale_part.stem.rsplit("-", 1)[-1].isdigit()):
+                stale_part.unlink()
+        if fsync == "directory":
+            fsync_path(directory)
+    finally:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return destination_filename
+
+
+class AsyncRawWriter:
+    """Run saving jobs in a single background thread.
+
+    The jobs are run in submission order. An error raised by a job does not
+    stop the thread, it is raised by the next call to flush or close.
+    """
+    def __init__(self, max_pending: int = 2) -> None:
+        """Start the background thread.
+
+        Args:
+            max_pending (int, optional): The maximum number of jobs waiting in
+                the queue. Each job holds a recording in memory, submit blocks
+                when the queue is full until a job is done. 0 does not limit
+                the queue. Defaults to 2.
+        """
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = list()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            function, args, kwargs, obj = job
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                with self._lock:
+                    self._pending[id(obj)] -= 1
+                    if not self._pending[id(obj)]:
+                        del self._pending[id(obj)]
+                self._queue.task_done()
+
+    def submit(
+        self,
+        function: Callable[..., Any],
+        *args: Any,
+        obj: object = None,
+        **kwargs: Any,
+    ) -> None:
+        """Add a saving job to the queue.
+
+        It blocks while the queue holds max_pending jobs.
+
+        Args:
+            function (Callable): The function doing the saving.
+            *args: The positional arguments of the function.
+            obj (object, optional): The object being saved, used by is_pending.
+            **kwargs: The keyword arguments of the function.
+        """
+        with self._lock:
+            self._pending[id(obj)] = self._pending.get(id(obj), 0) + 1
+        self._queue.put((function, args, kwargs, obj))
+
+    def is_pending(self, obj: object) -> bool:
+        """Check if an object is still waiting to be saved."""
+        with self._lock:
+            return id(obj) in self._pending
+
+    def wait_for(self, obj: object) -> None:
+        """Block until an object is no longer waiting to be saved."""
+        if self.is_pending(obj):
+            self._queue.join()
+
+    def flush(self) -> None:
+        """Block until every submitted job is done.
+
+        Raises:
+            RuntimeError: If a job failed. The original error is chained.
+        """
+        self._queue.join()
+        if self._errors:
+            error = self._errors.pop(0)
+            self._errors.clear()
+            raise RuntimeError(f"Error while saving: {error}") from error
+
+    def close(self) -> None:
+        """Wait for the submitted jobs and stop the thread."""
+        try:
+            self.flush()
+        finally:
+            if self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
@@ -0,0 +1,194 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+"""Entities and output paths of the recordings, resolved once.
+
+The pipelines used to query pybids for the entities of a file and to create
+the output folders on every step. A RecordingDescriptor resolves them once
+when the file is listed. It is small and picklable, so it is sent to the
+worker processes instead of the pybids objects.
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Iterable
+
+# BIDS entities parsed from the file names, by key.
+ENTITY_KEYS = {
+    "sub": "subject",
+    "ses": "session",
+    "task": "task",
+    "acq": "acquisition",
+    "run": "run",
+}
+
+# Folders created by this process, so each one is only created once. It is
+# cleared at the start of each run (see forget_created_directories).
+_CREATED_DIRECTORIES = set()
+
+
+def derivatives_root(path: str | os.PathLike) -> Path:
+    """Get the DERIVATIVES folder matching a path of the raw dataset.
+
+    The first folder of the path whose name contains 'raw' is replaced by
+    DERIVATIVES and the rest of the path is dropped.
+
+    Args:
+        path (str | os.PathLike): A path in the raw dataset, or its root.
+
+    Returns:
+        Path: The DERIVATIVES folder.
+    """
+    path_parts = list(Path(path).parts)
+    rawdata_dirname = [
+        name for name in path_parts if "raw" in name.lower()
+        ][0]
+    path_parts[path_parts.index(rawdata_dirname)] = "DERIVATIVES"
+    return Path(*path_parts[:path_parts.index("DERIVATIVES")+1])
+
+
+def make_directories(directories: Iterable[str | os.PathLike]) -> None:
+    """Create folders in one pass, skipping those created before.
+
+    The folders are created from the shallowest to the deepest and their
+    parents are remembered too, so a folder tree costs one system call per
+    folder for the whole process.
+
+    Args:
+        directories (Iterable[str | os.PathLike]): The folders to create.
+    """
+    missing = sorted(
+        {Path(directory) for directory in directories} - _CREATED_DIRECTORIES,
+        key=lambda directory: (len(directory.parts), directory),
+    )
+    for directory in missing:
+        if directory in _CREATED_DIRECTORIES:
+            continue
+        directory.mkdir(parents=True, exist_ok=True)
+        _CREATED_DIRECTORIES.update([directory, *directory.parents])
+
+
+def forget_created_directories() -> None:
+    """Forget the folders created before, so make_directories checks them.
+
+    The folders can be removed between two runs of a long lived process
+    (tests, notebooks), it is called at the start of each run.
+    """
+    _CREATED_DIRECTORIES.clear()
+
+
+class RecordingDescriptor:
+    """The entities and paths of a raw recording."""
+    __slots__ = (
+        "path",
+        "filename",
+        "base_filename",
+        "entities",
+        "derivatives_path",
+        "sidecar_path",
+    )
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        entities: dict[str, Any],
+    ) -> None:
+        """Resolve the paths of a recording.
+
+        Args:
+            path (str | os.PathLike): The path of the raw recording.
+            entities (dict[str, Any]): The BIDS entities of the recording.
+        """
+        self.path = Path(path)
+        self.filename = self.path.name
+        self.base_filename, _ = os.path.splitext(self.filename)
+        self.entities = dict(entities)
+        self.derivatives_path = derivatives_root(self.path)
+        self.sidecar_path = self.path.parent.joinpath(
+            f"{self.base_filename}.json"
+        )
+
+    @classmethod
+    def from_bids_file(cls, BIDSFile: Any) -> "RecordingDescriptor":
+        """Describe a file of a pybids layout.
+
+        Args:
+            BIDSFile (bids.layout.BIDSFile): The file.
+
+        Returns:
+            RecordingDescriptor: The descriptor of the file.
+        """
+        return cls(BIDSFile.path, BIDSFile.get_entities())
+
+    @classmethod
+    def from_path(cls, path: str | os.PathLike) -> "RecordingDescriptor":
+        """Describe a file from its BIDS name, without a pybids layout.
+
+        Only the entities of ENTITY_KEYS, the suffix and the extension are
+        parsed.
+
+        Args:
+            path (str | os.PathLike): The path of the raw recording.
+
+        Returns:
+            RecordingDescriptor: The descriptor of the file.
+        """
+        path = Path(path)
+        base_filename, extension = os.path.splitext(path.name)
+        *pairs, suffix = base_filename.split("_")
+        entities = {"suffix": suffix, "extension": extension}
+        for pair in pairs:
+            key, _, value = pair.partition("-")
+            if key in ENTITY_KEYS:
+                entities[ENTITY_KEYS[key]] = int(value) if key == "run" else value
+        return cls(path, entities)
+
+    def __repr__(self) -> str:
+        """Represent the descriptor by its path."""
+        return f"RecordingDescriptor({str(self.path)!r})"
+
+    def process_path(self, process_history: list[str]) -> Path:
+        """Get the folder of the outputs of a process history."""
+        return self.derivatives_path.joinpath("_".join(process_history))
+
+    def subject_session_path(self, process_history: list[str]) -> Path:
+        """Get the subject-session folder of the outputs of a process history."""
+        return self.process_path(process_history).joinpath(
+            f"sub-{self.entities['subject']}",
+            f"ses-{self.entities['session']}",
+        )
+
+    def modality_path(
+        self,
+        process_history: list[str],
+        modality: str = "eeg",
+    ) -> Path:
+        """Get the folder of the output of a process history."""
+        return self.subject_session_path(process_history).joinpath(modality)
+
+    def output_filename(self, process_history: list[str]) -> Path:
+        """Get the FIF file of the output of a process history."""
+        return self.modality_path(process_history).joinpath(
+            f"{self.base_filename}.fif"
+        )
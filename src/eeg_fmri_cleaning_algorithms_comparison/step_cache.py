@@ -0,0 +1,355 @@
+#!/usr/bin/env -S  python  #
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# Author: Dr. Samuel Louviot, PhD
+# Institution: Nathan Kline Institute
+#              Child Mind Institute
+# Address: 140 Old Orangeburg Rd, Orangeburg, NY 10962, USA
+#          215 E 50th St, New York, NY 10022
+# Date: 2024-04-04
+# email: samuel DOT louviot AT nki DOT rfmh DOT org
+# ===============================================================================
+# LICENCE GNU GPLv3:
+# Copyright (C) 2024  Dr. Samuel Louviot, PhD
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# ===============================================================================
+
+"""Content-addressed cache of the cleaning steps outputs.
+
+The output of a step only depends on the raw recording, on the steps that
+were applied before it and their parameters, on its own parameters and on the
+version of the libraries doing the work. The cache stores the output of each
+step under a hash of these elements so reruns (after a crash or after adding
+a new variant) load the FIF file instead of recomputing it. The key of the
+previous step is part of the key, so a key covers the whole lineage of the
+output.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+import mne
+
+# Libraries whose version changes the output of the cleaning steps.
+VERSIONED_PACKAGES = [
+    "eeg_fmri_cleaning",
+    "mne",
+    "numpy",
+    "scipy",
+    "asrpy",
+    "pyprep",
+]
+
+
+def file_digest(path: str | os.PathLike, chunk_size: int = 2**20) -> str:
+    """Compute the sha256 digest of a file without loading it in memory.
+
+    Args:
+        path (str | os.PathLike): The file to hash.
+        chunk_size (int, optional): The number of bytes read at once.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def companion_files(source_path: str | os.PathLike) -> list[Path]:
+    """List the files holding a raw recording.
+
+    EEGLAB (.set/.fdt) and BrainVision (.vhdr/.vmrk/.eeg) recordings are
+    split across several files sharing the same name. The json sidecar is not
+    part of the recording.
+
+    Args:
+        source_path (str | os.PathLike): The path of the raw recording.
+
+    Returns:
+        list[Path]: The files of the recording sorted by name.
+    """
+    source_path = Path(source_path)
+    return sorted(
+        path for path in source_path.parent.glob(f"{source_path.stem}.*")
+        if path.suffix != ".json"
+    )
+
+
+def recording_digest(source_path: str | os.PathLike) -> str:
+    """Hash a raw recording and its companion files.
+
+    Args:
+        source_path (str | os.PathLike): The path of the raw recording.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    for path in companion_files(source_path):
+        digest.update(path.suffix.encode())
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+def package_versions() -> dict[str, str | None]:
+    """Get the installed version of the packages in VERSIONED_PACKAGES."""
+    versions = dict()
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class StepCache:
+    """On-disk cache of the pipeline steps outputs.
+
+    Each entry is a directory named after the key holding the cleaned data
+    (raw.fif) and the process history after the step (history.json). The
+    modification time of history.json is refreshed on every hit and is used
+    to evict the least recently used entries when the cache exceeds max_size.
+    """
+    def __init__(
+        self,
+        root: str | os.PathLike,
+        max_size: int | None = None,
+    ) -> None:
+        """Initialize the cache.
+
+        Args:
+            root (str | os.PathLike): The directory holding the cache entries.
+            max_size (int, optional): The maximum size of the cache in bytes.
+                No eviction is done if None. Defaults to None.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._source_digests = dict()
+        self._versions = package_versions()
+
+    def source_digest(self, source_path: str | os.PathLike) -> str:
+        """Hash a raw recording and its companion files.
+
+        The digest (see recording_digest) is computed once per path and per
+        cache object.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+
+        Returns:
+            str: The hexadecimal digest.
+        """
+        source_path = Path(source_path)
+        if source_path not in self._source_digests:
+            self._source_digests[source_path] = recording_digest(source_path)
+        return self._source_digests[source_path]
+
+    def make_key(
+        self,
+        source_path: str | os.PathLike,
+        process_history: list[str],
+        step_name: str,
+        parameters: dict[str, Any],
+        parent_key: str | None = None,
+    ) -> str:
+        """Build the key of a step output.
+
+        Args:
+            source_path (str | os.PathLike): The path of the raw recording.
+            process_history (list[str]): The steps applied before this one.
+            step_name (str): The name of the step.
+            parameters (dict[str, Any]): The parameters of the step.
+            parent_key (str, optional): The key of the previous step output,
+                which covers the parameters of the steps applied before this
+                one. None for the first cached step. Defaults to None.
+
+        Returns:
+            str: The key of the entry.
+        """
+        content = {
+            "source": self.source_digest(source_path),
+            "process_history": list(process_history),
+            "parent": parent_key,
+            "step": step_name,
+            "parameters": parameters,
+            "versions": self._versions,
+        }
+        serialized = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root.joinpath(key[:2], key)
+
+    def load(self, key: str) -> tuple[mne.io.BaseRaw, list[str]] | None:
+        """Load a cached step output.
+
+        Args:
+            key (str): The key of the entry.
+
+        Returns:
+            tuple[mne.io.BaseRaw, list[str]] | None: The cleaned data and the
+                process history after the step, or None if the entry does not
+                exist.
+        """
+        entry_path = self._entry_path(key)
+        history_filename = entry_path.joinpath("history.json")
+        if not history_filename.is_file():
+            return None
+        with open(history_filename, "r") as f:
+            process_history = json.load(f)
+        raw = mne.io.read_raw_fif(entry_path.joinpath("raw.fif"), preload=True)
+        os.utime(history_filename)
+        return raw, process_history
+
+    def store(
+        self,
+        key: str,
+        raw: mne.io.BaseRaw,
+        process_history: list[str],
+    ) -> None:
+        """Store a step output.
+
+        The entry is written in a temporary directory and renamed once
+        complete so an interrupted write never leaves a partial entry.
+
+        Args:
+            key (str): The key of the entry.
+            raw (mne.io.BaseRaw): The cleaned data.
+            process_history (list[str]): The process history after the step.
+        """
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = Path(tempfile.mkdtemp(prefix=".tmp-",
+                                               dir=entry_path.parent))
+        try:
+            raw.save(temporary_path.joinpath("raw.fif"),
+                     fmt="double",
+                     overwrite=True)
+            with open(temporary_path.joinpath("history.json"), "w") as f:
+                json.dump(list(process_history), f)
+            os.replace(temporary_path, entry_path)
+        except OSError:
+            # Another process stored the same entry in the meantime.
+            if not entry_path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+        if self.max_size is not None:
+            self.evict()
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        """List the entries with their last access time and size."""
+        entries = list()
+        for history_filename in self.root.glob("*/*/history.json"):
+            entry_path = history_filename.parent
+            size = sum(
+                path.stat().st_size for path in entry_path.iterdir()
+            )
+            entries.append((history_filename.stat().st_mtime, size, entry_path))
+        return entries
+
+    def size(self) -> int:
+        """Get the total size of the cache entries in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_size: int | None = None) -> list[Path]:
+        """Remove the least recently used entries above a size.
+
+        Args:
+            max_size (int, optional): The size in bytes to shrink the cache
+                to. Defaults to the max_size of the cache.
+
+        Returns:
+            list[Path]: The removed entries.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return list()
+        entries = sorted(self._entries())
+        total_size = sum(size for _, size, _ in entries)
+        removed = list()
+        for _, size, entry_path in entries:
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+            removed.append(entry_path)
+        return removed
+
+    def clear(self, older_than: float | None = None) -> list[Path]:
+        """Remove cache entries.
+
+        Args:
+            older_than (float, optional): Only remove the entries that were
+                not used during this number of days. Defaults to None which
+                removes every entry.
+
+        Returns:
+            list[Path]: The removed entries.
+        """
+        removed = list()
+        now = time.time()
+        for last_access, _, entry_path in self._entries():
+            if older_than is None or now - last_access > older_than * 86400:
+                shutil.rmtree(entry_path, ignore_errors=True)
+                removed.append(entry_path)
+        return removed
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Invalidate or shrink a step cache from the command line."""
+    parser = argparse.ArgumentParser(description="Manage the step cache")
+    parser.add_argument("--path", type=str, help="Path to the cache directory")
+    parser.add_argument(
+        "--clear",
+        action="store_true",
+        help="Remove the cache entries.",
+    )
+    parser.add_argument(
+        "--older-than",
+        type=float,
+        default=None,
+        help="With --clear, only remove the entries unused for this many days.",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=None,
+        help="Evict the least recently used entries above this size in MB.",
+    )
+    args = parser.parse_args(argv)
+
+    cache = StepCache(args.path)
+    removed = list()
+    if args.clear:
+        removed += cache.clear(older_than=args.older_than)
+    if args.max_size is not None:
+        removed += cache.evict(max_size=args.max_size * 1024**2)
+    print(f"Removed {len(removed)} entries from {cache.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import shutil
+
+import mne
+import numpy as np
 import pytest
 import simulated_data
 import eeg_fmri_cleaning_algorithms_comparison.main_cleaner_pipelines as mcp
@@ -131,4 +135,115 @@ class TestMain:
                                                    'report.txt')
         mcp.main(dataset.bids_path)
         assert report_path.exists()
-    
\ No newline at end of file
+    
+class TestPipelineTree:
+    def test_build_pipeline_tree_shares_prefix(self):
+        tree = mcp.build_pipeline_tree(mcp.PIPELINE_VARIANTS)
+        assert list(tree['children'].keys()) == ['cbin']
+        cbin_node = tree['children']['cbin']
+        assert cbin_node['variants'] == ['cbin']
+        assert set(cbin_node['children'].keys()) == {'asr', 'pyprep'}
+        pyprep_node = cbin_node['children']['pyprep']
+        assert pyprep_node['children']['asr']['variants'] == ['cbin_pyprep_asr']
+
+    def test_run_pipeline_tree_runs_shared_steps_once(self):
+        calls = list()
+
+        class FakeCleaner:
+            def fork(self):
+                return FakeCleaner()
+
+            def save_final(self):
+                calls.append('save')
+
+        def make_step(name):
+            def step(cleaner):
+                calls.append(name)
+                return cleaner
+            return step
+
+        steps = {name: make_step(name) for name in ['cbin', 'pyprep', 'asr']}
+        tree = mcp.build_pipeline_tree(mcp.PIPELINE_VARIANTS)
+        completed = mcp.run_pipeline_tree(FakeCleaner(), tree, steps)
+        assert calls.count('cbin') == 1
+        assert calls.count('asr') == 2
+        assert calls.count('save') == 3
+        assert sorted(completed) == sorted(mcp.PIPELINE_VARIANTS.keys())
+
+    def test_planned_output_directories(self):
+        descriptor = mcp.RecordingDescriptor.from_path(
+            '/data/RAW/sub-001/ses-001/eeg/'
+            'sub-001_ses-001_task-checker_run-001_eeg.set'
+        )
+        tree = mcp.build_pipeline_tree(mcp.PIPELINE_VARIANTS)
+        every_step = mcp.planned_output_directories(descriptor, tree)
+        assert {directory.parts[3] for directory in every_step} == {
+            'GRAD_BCG', 'GRAD_BCG_ASR', 'GRAD_BCG_PREP', 'GRAD_BCG_PREP_ASR'
+        }
+        final_only = mcp.planned_output_directories(descriptor,
+                                                    tree,
+                                                    'final_only')
+        assert {directory.parts[3] for directory in final_only} == {
+            'GRAD_BCG', 'GRAD_BCG_ASR', 'GRAD_BCG_PREP_ASR'
+        }
+
+    def test_planned_preview_output_directories(self):
+        descriptor = mcp.RecordingDescriptor.from_path(
+            '/data/RAW/sub-001/ses-001/eeg/'
+            'sub-001_ses-001_task-checker_run-001_eeg.set'
+        )
+        variants = mcp.preview_variants(mcp.PIPELINE_VARIANTS)
+        assert variants['cbin_asr_preview'] == ('cbin', 'preview', 'asr')
+        tree = mcp.build_pipeline_tree(variants)
+        final_only = mcp.planned_output_directories(descriptor,
+                                                    tree,
+                                                    'final_only')
+        assert {directory.parts[3] for directory in final_only} == {
+            'GRAD_BCG_PREVIEW',
+            'GRAD_BCG_PREVIEW_ASR',
+            'GRAD_BCG_PREVIEW_PREP_ASR',
+        }
+
+class TestParallelMain:
+    def test_parse_arguments(self):
+        args = mcp.parse_arguments(['--path', 'dataset',
+                                    '--n-jobs', '4',
+                                    '--max-memory-per-worker', '2048',
+                                    '--max-files-per-worker', '10'])
+        assert args.path == 'dataset'
+        assert args.n_jobs == 4
+        assert args.max_memory_per_worker == 2048
+        assert args.max_files_per_worker == 10
+
+    def test_serial_and_parallel_outputs_are_identical(self, dataset):
+        derivatives_path = dataset.root.joinpath('DERIVATIVES')
+        step_kwargs = {'pyprep': {'random_state': 0}}
+        outputs = list()
+        for n_jobs in (1, 2):
+            shutil.rmtree(derivatives_path, ignore_errors=True)
+            mcp.main(dataset.bids_path, n_jobs=n_jobs, step_kwargs=step_kwargs)
+            outputs.append({
+                path.relative_to(derivatives_path): mne.io.read_raw_fif(
+                    path, preload=True
+                ).get_data()
+                for path in derivatives_path.rglob('*_eeg.fif')
+            })
+        serial, parallel = outputs
+        assert serial
+        assert serial.keys() == parallel.keys()
+        for path, data in serial.items():
+            assert np.array_equal(data, parallel[path])
+
+    def test_main_parallel_derivatives_exist(self, dataset):
+        mcp.main(dataset.bids_path, n_jobs=2, max_files_per_worker=1)
+        derivatives_path = dataset.root.joinpath('DERIVATIVES')
+        for subject in dataset.subjects:
+            for session in dataset.sessions:
+                for run in dataset.runs:
+                    assert derivatives_path.joinpath(
+                        'GRAD_BCG_ASR',
+                        subject,
+                        session,
+                        'eeg',
+                        f'{subject}_{session}_task-checker_{run}_eeg.fif'
+                    ).exists()
@@ -0,0 +1,77 @@
+import asrpy
+import numpy as np
+import pytest
+import simulated_data
+
+from asr_calibration import ASRCalibrationStore
+
+
+@pytest.fixture
+def fitted_asr():
+    raw = simulated_data.simulate_light_eeg_data(duration=20)
+    asr = asrpy.ASR(sfreq=raw.info['sfreq'])
+    asr.fit(raw)
+    return asr, raw.ch_names
+
+@pytest.fixture
+def store(tmp_path):
+    return ASRCalibrationStore(tmp_path.joinpath('asr_calibration'))
+
+def test_filename_uses_subject_and_session(store):
+    entities = {'subject': '001', 'session': '002', 'run': 3, 'task': 'checker'}
+    assert store.filename(entities).name == 'sub-001_ses-002_asr.npz'
+
+def test_filename_uses_process_history(store):
+    entities = {'subject': '001', 'session': '002'}
+    assert store.filename(entities, ['GRAD', 'BCG', 'PREP']).name == (
+        'sub-001_ses-002_desc-GradBcgPrep_asr.npz'
+    )
+
+def test_process_histories_have_separate_calibrations(store):
+    entities = {'subject': '001', 'session': '001', 'run': 1}
+    calibrations = dict()
+    for history, random_state in ((['GRAD', 'BCG'], 1),
+                                  (['GRAD', 'BCG', 'PREP'], 2)):
+        raw = simulated_data.simulate_light_eeg_data(duration=20,
+                                                     random_state=random_state)
+        asr = asrpy.ASR(sfreq=raw.info['sfreq'])
+        asr.fit(raw)
+        store.save(entities, asr, raw.ch_names, history)
+        calibrations[tuple(history)] = (asr, raw.ch_names)
+    assert not store.exists(entities)
+    for history, (asr, ch_names) in calibrations.items():
+        assert store.exists(entities, history)
+        loaded_asr = store.load(entities,
+                                asrpy.ASR(sfreq=asr.sfreq),
+                                ch_names,
+                                history)
+        assert np.allclose(loaded_asr.M, asr.M)
+    assert not np.allclose(
+        calibrations[('GRAD', 'BCG')][0].M,
+        calibrations[('GRAD', 'BCG', 'PREP')][0].M,
+    )
+
+def test_save_and_load(store, fitted_asr):
+    asr, ch_names = fitted_asr
+    entities = {'subject': '001', 'session': '001', 'run': 1}
+    assert not store.exists(entities)
+    store.save(entities, asr, ch_names)
+    other_run = {'subject': '001', 'session': '001', 'run': 2}
+    assert store.exists(other_run)
+    loaded_asr = store.load(other_run, asrpy.ASR(sfreq=asr.sfreq), ch_names)
+    assert np.allclose(loaded_asr.M, asr.M)
+    assert np.allclose(loaded_asr.T, asr.T)
+
+def test_load_with_other_channels(store, fitted_asr):
+    asr, ch_names = fitted_asr
+    entities = {'subject': '001', 'session': '001'}
+    store.save(entities, asr, ch_names)
+    with pytest.raises(ValueError):
+        store.load(entities, asrpy.ASR(sfreq=asr.sfreq), ch_names[:-1])
+
+def test_load_with_other_sampling_frequency(store, fitted_asr):
+    asr, ch_names = fitted_asr
+    entities = {'subject': '001', 'session': '001'}
+    store.save(entities, asr, ch_names)
+    with pytest.raises(ValueError):
+        store.load(entities, asrpy.ASR(sfreq=asr.sfreq * 2), ch_names)
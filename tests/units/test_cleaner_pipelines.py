@@ -267,6 +267,315 @@ def test_decorator_pipe(light_dataset):
     assert os.path.isfile(expected_eeg_filename)
     assert os.path.isfile(expected_json_filename)
 
+def test_save_policy_final_only(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], save_policy='final_only')
+    cleaner.function_testing_decorator()
+    expected_eeg_filename = bids_path.parent.joinpath(
+        'DERIVATIVES',
+        'TEST_PIPE',
+        'sub-001',
+        'ses-001',
+        'eeg',
+        'sub-001_ses-001_task-test_run-001_eeg.fif'
+    )
+    assert not expected_eeg_filename.exists()
+    cleaner.save_final()
+    assert expected_eeg_filename.is_file()
+
+def test_save_policy_selected_steps(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0],
+                                  save_policy='selected_steps',
+                                  saved_steps=['TEST_PIPE'])
+    cleaner.function_testing_decorator()
+    expected_saving_path = bids_path.parent.joinpath(
+        'DERIVATIVES',
+        'TEST_PIPE',
+        'sub-001',
+        'ses-001',
+        'eeg'
+    )
+    assert expected_saving_path.joinpath(
+        'sub-001_ses-001_task-test_run-001_eeg.fif').is_file()
+
+def test_wrong_save_policy(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    with pytest.raises(ValueError):
+        cp.CleanerPipelines(bids_files[0], save_policy='never')
+
+def test_async_save(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], async_save=True)
+    cleaner.function_testing_decorator()
+    cleaner.close()
+    expected_eeg_filename = bids_path.parent.joinpath(
+        'DERIVATIVES',
+        'TEST_PIPE',
+        'sub-001',
+        'ses-001',
+        'eeg',
+        'sub-001_ses-001_task-test_run-001_eeg.fif'
+    )
+    assert expected_eeg_filename.is_file()
+
+def test_async_save_shares_the_data(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], async_save=True)
+    cleaner.raw = simulated_data.simulate_light_eeg_data()
+    cleaner.function_testing_decorator()
+    expected = cleaner.raw.get_data()
+    # The pipeline does not wait for the write, it holds a read-only view.
+    assert not cleaner.raw._data.flags.writeable
+    cleaner.close()
+    assert cleaner._data_share.holders == 1
+    shared_data = cleaner.raw._data
+    cleaner._own_data()
+    assert cleaner.raw._data is shared_data
+    assert cleaner.raw._data.flags.writeable
+    saved_raw = mne.io.read_raw_fif(cleaner.last_saved_filename)
+    assert np.allclose(saved_raw.get_data(), expected, atol=1e-6)
+
+def test_step_metrics(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0])
+    cleaner.raw = simulated_data.simulate_light_eeg_data()
+    cleaner.function_testing_decorator()
+    steps = [record['step'] for record in cleaner.step_metrics]
+    assert steps == ['function_testing_decorator', '_write_raw']
+    for record in cleaner.step_metrics:
+        assert record['wall_time'] >= 0
+        assert record['n_channels_out'] == len(cleaner.raw.ch_names)
+    metrics_filename = cleaner.export_step_metrics()
+    assert metrics_filename.is_file()
+    assert not cleaner.step_metrics
+    summary = cp.summarize_step_metrics(cleaner.derivatives_path)
+    assert set(summary.index) == {'function_testing_decorator', '_write_raw'}
+    assert cleaner.derivatives_path.joinpath(
+        'step_metrics_summary.csv').is_file()
+
+def test_async_save_metrics_use_submitted_state(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], async_save=True)
+    cleaner.raw = simulated_data.simulate_light_eeg_data()
+    cleaner.function_testing_decorator()
+    n_samples = cleaner.raw.n_times
+    # The next step changes the pipeline before the write is done.
+    cleaner.process_history.append('NEXT')
+    cleaner.raw = cleaner.raw.copy().crop(0, 1)
+    cleaner.close()
+    record, = [record for record in cleaner.step_metrics
+               if record['step'] == '_write_raw']
+    assert record['process_history'] == 'TEST_PIPE'
+    assert record['n_samples_in'] == record['n_samples_out'] == n_samples
+
+def test_streaming_asr_matches_full_transform(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0])
+    cleaner.raw = simulated_data.simulate_light_eeg_data(duration=20)
+    asr = cp.asrpy.ASR(sfreq=cleaner.raw.info['sfreq'])
+    asr.fit(cleaner.raw)
+    expected = asr.transform(cleaner.raw).get_data()
+    streamed = cleaner._transform_asr_in_windows(asr, window_duration=3.3)
+    assert streamed.get_data().shape == expected.shape
+    assert np.allclose(streamed.get_data(), expected)
+
+    # asrpy keeps the bad channels, the streaming mode must do the same.
+    cleaner.raw.info['bads'] = cleaner.raw.ch_names[:2]
+    expected = asr.transform(cleaner.raw).get_data()
+    streamed = cleaner._transform_asr_in_windows(asr, window_duration=3.3)
+    assert np.allclose(streamed.get_data(), expected)
+
+def test_read_raw_lazy(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], read_mode='lazy')
+    cleaner.read_raw()
+    assert not cleaner.raw.preload
+    cleaner._materialize()
+    assert cleaner.raw.preload
+    expected = cp.CleanerPipelines(bids_files[0]).read_raw().raw
+    assert cleaner.raw.ch_names == expected.ch_names
+    assert cleaner.raw.get_channel_types() == expected.get_channel_types()
+    assert np.array_equal(cleaner.raw.get_data(), expected.get_data())
+
+def test_read_raw_memmap(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], read_mode='memmap')
+    cleaner.read_raw()
+    assert isinstance(cleaner.raw._data, np.memmap)
+    assert not any(cleaner.derivatives_path.joinpath('.scratch').iterdir())
+    expected = cp.CleanerPipelines(bids_files[0]).read_raw().raw
+    assert cleaner.raw.ch_names == expected.ch_names
+    assert cleaner.raw.get_channel_types() == expected.get_channel_types()
+    assert np.array_equal(cleaner.raw.get_data(), expected.get_data())
+
+def test_wrong_read_mode(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    with pytest.raises(ValueError):
+        cp.CleanerPipelines(bids_files[0], read_mode='wrong')
+
+def test_single_precision(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0], precision='single')
+    cleaner.read_raw()
+    assert cleaner.raw._data.dtype == np.float32
+    expected = mne.io.read_raw(bids_files[0].path, preload=True)
+    assert np.allclose(cleaner.raw.get_data(), expected.get_data(), rtol=1e-6)
+    cleaner._materialize()
+    assert cleaner.raw._data.dtype == np.float64
+    cleaner.function_testing_decorator()
+    assert cleaner.raw._data.dtype == np.float32
+
+def test_wrong_precision(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    with pytest.raises(ValueError):
+        cp.CleanerPipelines(bids_files[0], precision='half')
+
+def test_step_cache_key(light_dataset, tmp_path):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0],
+                                  step_cache=cp.StepCache(tmp_path),
+                                  precision='single')
+    cleaner.read_raw()
+    keys = list()
+    make_key = cleaner.step_cache.make_key
+
+    def recording_make_key(*args, **kwargs):
+        keys.append(args[3])
+        return make_key(*args, **kwargs)
+
+    cleaner.step_cache.make_key = recording_make_key
+    cleaner.run_preview_resampling(sfreq=cleaner.raw.info['sfreq'] / 2,
+                                   n_jobs=2)
+    assert 'n_jobs' not in keys[0]
+    assert keys[0]['pipeline_state'] == {'precision': 'single'}
+
+    context = cleaner._cache_context('run_asr', {'calibration': 'session'})
+    assert context['asr_calibration'] is None
+    store = cp.ASRCalibrationStore(
+        cleaner.derivatives_path.joinpath('asr_calibration')
+    )
+    store.filename(cleaner.entities,
+                   cleaner.process_history).write_bytes(b'calibration')
+    context = cleaner._cache_context('run_asr', {'calibration': 'session'})
+    assert context['asr_calibration'] is not None
+
+def test_step_cache_key_chains_lineage(light_dataset, tmp_path):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0],
+                                  step_cache=cp.StepCache(tmp_path))
+    cleaner.read_raw()
+    sfreq = cleaner.raw.info['sfreq']
+    asr_keys = list()
+    for preview_sfreq in [sfreq / 2, sfreq / 4]:
+        child = cleaner.fork()
+        child.run_preview_resampling(sfreq=preview_sfreq)
+        assert child.process_history == ['PREVIEW']
+        asr_keys.append(child.step_cache.make_key(
+            child.rawdata_path,
+            child.process_history,
+            'run_asr',
+            {},
+            parent_key=child._step_cache_key,
+        ))
+    assert asr_keys[0] != asr_keys[1]
+
+    # A cache hit restores the key of the step for the next one.
+    child = cleaner.fork()
+    child.run_preview_resampling(sfreq=sfreq / 4)
+    assert child.step_cache.make_key(
+        child.rawdata_path,
+        child.process_history,
+        'run_asr',
+        {},
+        parent_key=child._step_cache_key,
+    ) == asr_keys[1]
+
+def test_fork_copy_on_write(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0])
+    cleaner.read_raw()
+    expected = cleaner.raw.get_data()
+    child = cleaner.fork()
+    assert np.shares_memory(child.raw._data, cleaner.raw._data)
+    assert not child.raw._data.flags.writeable
+    assert child.raw.info is not cleaner.raw.info
+    child._own_data()
+    assert child.raw._data.flags.writeable
+    assert not np.shares_memory(child.raw._data, cleaner.raw._data)
+    child.raw._data[:] = 0
+    assert np.array_equal(cleaner.raw.get_data(), expected)
+    # The child released the buffer, the parent gets it back without a copy.
+    shared_data = cleaner.raw._data
+    cleaner._own_data()
+    assert cleaner.raw._data is shared_data
+    assert cleaner.raw._data.flags.writeable
+    assert np.array_equal(cleaner.raw.get_data(), expected)
+
+def test_fork_releases_replaced_data(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0],
+                                  save_policy='selected_steps')
+    cleaner.read_raw()
+    children = [cleaner.fork(), cleaner.fork()]
+    assert cleaner._data_share.holders == 3
+    for child in children:
+        child.run_preview_resampling(sfreq=child.raw.info['sfreq'] / 2)
+    assert cleaner._data_share.holders == 1
+    shared_data = cleaner.raw._data
+    cleaner._own_data()
+    assert cleaner.raw._data is shared_data
+
+def test_run_preview_resampling(light_dataset):
+    bids_path = light_dataset.bids_path
+    bids_layout = bids.layout.BIDSLayout(bids_path)
+    bids_files = bids_layout.get(extension = '.set')
+    cleaner = cp.CleanerPipelines(bids_files[0])
+    cleaner.read_raw()
+    sfreq = cleaner.raw.info['sfreq']
+    duration = cleaner.raw.times[-1]
+    cleaner.run_preview_resampling(sfreq=sfreq / 4)
+    assert cleaner.raw.info['sfreq'] == sfreq / 4
+    assert np.isclose(cleaner.raw.times[-1], duration, atol=4 / sfreq)
+    assert cleaner.process_history == ['PREVIEW']
+    assert cleaner.derivatives_path.joinpath('PREVIEW').exists()
+    with pytest.raises(ValueError):
+        cleaner.run_preview_resampling(sfreq=sfreq)
+
 class TestRunsCleanerPipelines:
     def test_run_clean_gradient(self, heavy_dataset):
         heavy_dataset.run_clean_gradient()
@@ -334,6 +643,19 @@ class TestRunsCleanerPipelines:
         assert len(heavy_dataset.raw.annotations.description) == 10
         assert isinstance(heavy_dataset, cp.CleanerPipelines)
 
+    def test_run_pyprep_parallel_is_deterministic(self, heavy_dataset):
+        raw = heavy_dataset.raw.copy()
+        process_history = list(heavy_dataset.process_history)
+        results = list()
+        for n_jobs in [1, 2]:
+            heavy_dataset.raw = raw.copy()
+            heavy_dataset.process_history = list(process_history)
+            heavy_dataset.run_pyprep(montage_name='biosemi16',
+                                     n_jobs=n_jobs,
+                                     random_state=42)
+            results.append(heavy_dataset.raw.get_data())
+        assert np.allclose(results[0], results[1])
+
     def test_run_asr(self, heavy_dataset):
         heavy_dataset.run_asr()
         cwd = Path.cwd()
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import simulated_data
+from compressed_storage import (
+    CompressedRawReader,
+    read_raw_hdf5,
+    write_raw_hdf5,
+)
+
+
+@pytest.fixture
+def raw():
+    return simulated_data.simulate_eeg_data(n_channels=16,
+                                            duration=4,
+                                            sampling_frequency=256,
+                                            random_state=0)
+
+def test_round_trip_double(raw, tmp_path):
+    filename = write_raw_hdf5(raw, tmp_path.joinpath('raw.h5'), fmt='double')
+    loaded = read_raw_hdf5(filename)
+    assert np.array_equal(loaded.get_data(), raw.get_data())
+    assert loaded.ch_names == raw.ch_names
+    assert loaded.info['sfreq'] == raw.info['sfreq']
+    assert list(loaded.annotations.description) == list(
+        raw.annotations.description
+    )
+    assert [path.name for path in tmp_path.iterdir()] == ['raw.h5']
+
+def test_single_precision(raw, tmp_path):
+    filename = write_raw_hdf5(raw, tmp_path.joinpath('raw.h5'))
+    loaded = read_raw_hdf5(filename)
+    assert np.allclose(loaded.get_data(), raw.get_data(), rtol=1e-6)
+
+def test_read_channels_and_window(raw, tmp_path):
+    filename = write_raw_hdf5(raw,
+                              tmp_path.joinpath('raw.h5'),
+                              fmt='double',
+                              chunk_duration=1,
+                              channels_per_chunk=4)
+    picks = [raw.ch_names[5], raw.ch_names[2]]
+    with CompressedRawReader(filename) as reader:
+        block = reader.get_data(picks, start=300, stop=700)
+        window = reader.get_data([1], tmin=1, tmax=2)
+    expected = raw.get_data(picks=picks, start=300, stop=700)
+    assert np.array_equal(block, expected)
+    assert np.array_equal(window, raw.get_data(picks=[1], start=256, stop=512))
+
+def test_wrong_format(raw, tmp_path):
+    with pytest.raises(ValueError):
+        write_raw_hdf5(raw, tmp_path.joinpath('raw.h5'), fmt='float16')
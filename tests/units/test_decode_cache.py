@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import pytest
+import simulated_data
+
+from decode_cache import DecodeCache
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    eeg_path = tmp_path.joinpath('RAW', 'sub-001', 'ses-001', 'eeg')
+    eeg_path.mkdir(parents=True)
+    filename = eeg_path.joinpath('sub-001_ses-001_task-test_run-001_eeg.set')
+    filename.write_bytes(b'header')
+    eeg_path.joinpath(filename.stem + '.fdt').write_bytes(b'data')
+    return filename
+
+@pytest.fixture
+def cache(tmp_path):
+    return DecodeCache(tmp_path.joinpath('DERIVATIVES', 'decoded'))
+
+def test_store_and_load(cache, source_file):
+    raw = simulated_data.simulate_light_eeg_data(random_state=0)
+    assert cache.load(source_file) is None
+    cache.store(source_file, raw)
+    loaded = cache.load(source_file)
+    assert np.array_equal(loaded.get_data(), raw.get_data())
+    assert not cache.load(source_file, preload=False).preload
+
+def test_modified_source_invalidates(cache, source_file):
+    cache.store(source_file, simulated_data.simulate_light_eeg_data())
+    source_file.with_suffix('.fdt').write_bytes(b'other data')
+    assert not cache.is_valid(source_file)
+    assert cache.load(source_file) is None
+
+def test_touched_source_stays_valid(cache, source_file):
+    cache.store(source_file, simulated_data.simulate_light_eeg_data())
+    stat = source_file.stat()
+    os.utime(source_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.is_valid(source_file)
+    description = cache._entry_paths(source_file)[1].read_text()
+    assert str(stat.st_mtime_ns + 10**9) in description
+
+def test_interrupted_store_is_ignored(cache, source_file):
+    fif_filename, description_filename = cache._entry_paths(source_file)
+    simulated_data.simulate_light_eeg_data().save(fif_filename)
+    assert not description_filename.exists()
+    assert cache.load(source_file) is None
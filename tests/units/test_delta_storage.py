@@ -0,0 +1,124 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+import simulated_data
+from compressed_storage import write_raw_hdf5
+from delta_storage import (
+    DeltaRawReader,
+    open_raw_reader,
+    read_raw_delta,
+    write_raw_delta,
+)
+
+
+@pytest.fixture
+def raw():
+    return simulated_data.simulate_eeg_data(n_channels=16,
+                                            duration=4,
+                                            sampling_frequency=256,
+                                            random_state=0)
+
+@pytest.fixture
+def parent_filename(raw, tmp_path):
+    return write_raw_hdf5(raw, tmp_path.joinpath('parent.h5'), fmt='double')
+
+def modify_window(raw):
+    derived = raw.copy()
+    derived._data[3, 300:400] = 0
+    derived._data[7, 600:620] *= 2
+    return derived
+
+def test_round_trip(raw, parent_filename, tmp_path):
+    derived = modify_window(raw)
+    filename = write_raw_delta(derived,
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'),
+                               fmt='double')
+    loaded = read_raw_delta(filename)
+    assert np.array_equal(loaded.get_data(), derived.get_data())
+    assert loaded.ch_names == derived.ch_names
+    with h5py.File(filename, 'r') as h5_file:
+        assert h5_file.attrs['parent'] == 'parent.h5'
+        assert sorted(map(tuple, h5_file['blocks'][()])) == [(3, 1), (7, 2)]
+
+def test_read_channels_and_window(raw, parent_filename, tmp_path):
+    derived = modify_window(raw)
+    filename = write_raw_delta(derived,
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'),
+                               fmt='double',
+                               block_duration=0.5)
+    picks = [derived.ch_names[7], 3, 3, 0]
+    with DeltaRawReader(filename) as reader:
+        block = reader.get_data(picks, start=250, stop=650)
+    expected = derived.get_data(picks=[7, 3, 3, 0], start=250, stop=650)
+    assert np.array_equal(block, expected)
+
+def test_standalone_when_most_blocks_change(raw, parent_filename, tmp_path):
+    derived = raw.copy()
+    derived._data *= 2
+    filename = write_raw_delta(derived,
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'),
+                               fmt='double')
+    parent_filename.unlink()
+    assert np.array_equal(read_raw_delta(filename).get_data(),
+                          derived.get_data())
+
+def test_chained_deltas(raw, parent_filename, tmp_path):
+    derived = modify_window(raw)
+    first = write_raw_delta(derived,
+                            parent_filename,
+                            tmp_path.joinpath('first.delta.h5'),
+                            fmt='double')
+    derived._data[10, 900:1000] = 1e-6
+    second = write_raw_delta(derived,
+                             first,
+                             tmp_path.joinpath('second.delta.h5'),
+                             fmt='double')
+    with open_raw_reader(second) as reader:
+        assert isinstance(reader, DeltaRawReader)
+        assert np.array_equal(reader.get_data(), derived.get_data())
+
+def test_single_precision_fif_parent(raw, tmp_path):
+    parent_filename = tmp_path.joinpath('parent_eeg.fif')
+    raw.save(parent_filename)
+    derived = modify_window(raw)
+    filename = write_raw_delta(derived,
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'))
+    with h5py.File(filename, 'r') as h5_file:
+        assert len(h5_file['blocks']) == 2
+    assert np.allclose(read_raw_delta(filename).get_data(),
+                       derived.get_data(),
+                       rtol=1e-5)
+
+def test_changed_parent(raw, parent_filename, tmp_path):
+    filename = write_raw_delta(modify_window(raw),
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'))
+    write_raw_hdf5(raw.copy().crop(tmax=2), parent_filename)
+    with pytest.raises(ValueError):
+        DeltaRawReader(filename)
+
+def test_parent_rewritten_with_same_size(raw, parent_filename, tmp_path):
+    filename = write_raw_delta(modify_window(raw),
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'))
+    other = raw.copy()
+    other._data = other._data[::-1].copy()
+    write_raw_hdf5(other, parent_filename, fmt='double')
+    with pytest.raises(ValueError):
+        DeltaRawReader(filename)
+
+def test_parent_touched_with_same_content(raw, parent_filename, tmp_path):
+    filename = write_raw_delta(modify_window(raw),
+                               parent_filename,
+                               tmp_path.joinpath('derived.delta.h5'))
+    stat = parent_filename.stat()
+    os.utime(parent_filename,
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert np.allclose(read_raw_delta(filename).get_data(),
+                       modify_window(raw).get_data())
@@ -0,0 +1,49 @@
+import pytest
+
+from job_ledger import JobLedger
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return JobLedger(tmp_path.joinpath('DERIVATIVES', 'job_ledger.jsonl'))
+
+@pytest.fixture
+def output_file(tmp_path):
+    filename = tmp_path.joinpath('sub-001_ses-001_task-checker_run-001_eeg.fif')
+    filename.write_bytes(b'cleaned data')
+    return filename
+
+def test_last_record_wins(ledger):
+    ledger.record('file.set', 'cbin', 'pending')
+    ledger.record('file.set', 'cbin', 'running')
+    records = ledger.read()
+    assert records[('file.set', 'cbin')]['state'] == 'running'
+
+def test_wrong_state(ledger):
+    with pytest.raises(ValueError):
+        ledger.record('file.set', 'cbin', 'unknown')
+
+def test_truncated_line_is_ignored(ledger):
+    ledger.record('file.set', 'cbin', 'done')
+    with open(ledger.path, 'a') as f:
+        f.write('{"file": "file.set", "vari')
+    assert ledger.read()[('file.set', 'cbin')]['state'] == 'done'
+
+def test_completed_variants(ledger, output_file):
+    outputs = [JobLedger.describe_output(output_file)]
+    ledger.record('file.set', 'cbin', 'done', outputs=outputs)
+    ledger.record('file.set', 'cbin_asr', 'failed', error='error')
+    completed = ledger.completed_variants('file.set', ['cbin', 'cbin_asr'])
+    assert completed == ['cbin']
+
+def test_modified_output_is_not_done(ledger, output_file):
+    outputs = [JobLedger.describe_output(output_file)]
+    ledger.record('file.set', 'cbin', 'done', outputs=outputs)
+    output_file.write_bytes(b'truncated')
+    assert ledger.completed_variants('file.set', ['cbin']) == []
+
+def test_removed_output_is_not_done(ledger, output_file):
+    outputs = [JobLedger.describe_output(output_file)]
+    ledger.record('file.set', 'cbin', 'done', outputs=outputs)
+    output_file.unlink()
+    assert ledger.completed_variants('file.set', ['cbin']) == []
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+import simulated_data
+
+from layout_cache import FINGERPRINT_FILENAME, directory_fingerprint, load_layout
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    dataset_object = simulated_data.DummyDataset(root=tmp_path,
+                                                 task='checker',
+                                                 flush=False)
+    dataset_object.create_eeg_dataset(light=True, fmt='eeglab')
+    return dataset_object
+
+def test_fingerprint_changes_with_new_file(tmp_path):
+    tmp_path.joinpath('sub-001').mkdir()
+    fingerprint = directory_fingerprint(tmp_path)
+    assert fingerprint == directory_fingerprint(tmp_path)
+    stat = tmp_path.joinpath('sub-001').stat()
+    tmp_path.joinpath('sub-001', 'new_file.txt').write_text('')
+    os.utime(tmp_path.joinpath('sub-001'),
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert fingerprint != directory_fingerprint(tmp_path)
+
+def test_fingerprint_ignores_hidden_directories(tmp_path):
+    fingerprint = directory_fingerprint(tmp_path)
+    tmp_path.joinpath('.hidden').mkdir()
+    hidden_fingerprint = directory_fingerprint(tmp_path)
+    tmp_path.joinpath('.hidden', 'file.txt').write_text('')
+    assert hidden_fingerprint == directory_fingerprint(tmp_path)
+
+def test_fingerprint_ignores_derivatives(tmp_path):
+    tmp_path.joinpath('sub-001').mkdir()
+    tmp_path.joinpath('DERIVATIVES').mkdir()
+    database_path = tmp_path.joinpath('sub-001', 'bids_layout')
+    database_path.mkdir()
+    fingerprint = directory_fingerprint(tmp_path, excluded=[database_path])
+    # Only the mtimes of the skipped folders change.
+    tmp_path.joinpath('DERIVATIVES', 'decoded').mkdir()
+    database_path.joinpath('layout_index.sqlite').write_text('')
+    assert fingerprint == directory_fingerprint(tmp_path,
+                                                excluded=[database_path])
+
+def test_load_layout_is_persisted(dataset, tmp_path):
+    database_path = tmp_path.joinpath('bids_layout')
+    layout = load_layout(dataset.bids_path, database_path)
+    files = [file.path for file in layout.get(extension='.set')]
+    assert files
+    fingerprint_filename = database_path.joinpath(FINGERPRINT_FILENAME)
+    assert fingerprint_filename.read_text() == directory_fingerprint(
+        dataset.bids_path, excluded=[database_path]
+    )
+    fingerprint_mtime = fingerprint_filename.stat().st_mtime_ns
+    layout = load_layout(dataset.bids_path, database_path)
+    assert [file.path for file in layout.get(extension='.set')] == files
+    assert fingerprint_filename.stat().st_mtime_ns == fingerprint_mtime
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from metrics_store import MetricsStore
+
+
+def make_metrics(filename, values, subject='001'):
+    """Build the metrics of a file from {(variant, metric): [per channel]}."""
+    rows = [
+        dict(file=filename,
+             subject=subject,
+             session='01',
+             task='checker',
+             run=np.int64(1),
+             variant=variant,
+             process_history=variant.upper(),
+             channel=f'EEG{channel:03d}',
+             metric=metric,
+             value=value)
+        for (variant, metric), channel_values in values.items()
+        for channel, value in enumerate(channel_values)
+    ]
+    return pd.DataFrame.from_records(rows)
+
+@pytest.fixture
+def store(tmp_path):
+    store = MetricsStore(tmp_path.joinpath('DERIVATIVES', 'metrics.sqlite'))
+    store.update_file('a.set', make_metrics('a.set', {
+        ('cbin', 'snr'): [1.0, 3.0],
+        ('cbin_asr', 'snr'): [4.0, 6.0],
+        ('cbin', 'bcg_residual'): [2.0, np.nan],
+    }), signature='a1')
+    store.update_file('b.set', make_metrics('b.set', {
+        ('cbin', 'snr'): [3.0, 3.0],
+        ('cbin_asr', 'snr'): [2.0, 2.0],
+        ('cbin', 'bcg_residual'): [4.0, 4.0],
+    }, subject='002'), signature='b1')
+    return store
+
+def test_file_summaries(store):
+    summaries = store.file_summaries().set_index(['file', 'variant', 'metric'])
+    assert summaries.loc[('a.set', 'cbin_asr', 'snr'), 'value'] == 5
+    # The NaN of a channel is left out of the average.
+    assert summaries.loc[('a.set', 'cbin', 'bcg_residual'), 'value'] == 2
+    assert summaries.loc[('a.set', 'cbin', 'bcg_residual'), 'n_channels'] == 1
+    assert len(store.channel_metrics()) == 12
+
+def test_group_means(store):
+    means = store.group_means().set_index(['variant', 'metric'])
+    assert means.loc[('cbin_asr', 'snr'), 'mean'] == 3.5
+    assert means.loc[('cbin_asr', 'snr'), 'std'] == pytest.approx(1.5)
+    assert means.loc[('cbin', 'snr'), 'n_files'] == 2
+    by_subject = store.group_means(by=('subject', 'variant'))
+    assert set(by_subject['subject']) == {'001', '002'}
+    with pytest.raises(ValueError):
+        store.group_means(by=('value',))
+
+def test_rank_variants(store):
+    # Each variant has the best SNR of one file.
+    ranking = store.rank_variants('snr')
+    assert ranking['mean_rank'].tolist() == [1.5, 1.5]
+    ranking = store.rank_variants('snr', higher_is_better=False)
+    assert ranking['n_files'].tolist() == [2, 2]
+
+def test_update_replaces_file(store):
+    store.update_file('b.set', make_metrics('b.set', {
+        ('cbin', 'snr'): [1.0, 1.0],
+        ('cbin_asr', 'snr'): [2.0, 2.0],
+    }), signature='b2')
+    assert store.signature('b.set') == 'b2'
+    ranking = store.rank_variants('snr')
+    assert ranking.iloc[0]['variant'] == 'cbin_asr'
+    assert ranking.iloc[0]['mean_rank'] == 1
+    summaries = store.file_summaries()
+    assert not ((summaries['file'] == 'b.set')
+                & (summaries['metric'] == 'bcg_residual')).any()
+
+def test_remove_file(store):
+    store.remove_file('a.set')
+    assert store.signature('a.set') is None
+    assert set(store.channel_metrics()['file']) == {'b.set'}
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+import quality_metrics
+import simulated_data
+from metrics_store import MetricsStore
+from pipeline_variants import variant_histories
+from quality_metrics import (
+    BANDS,
+    compare_outputs,
+    estimate_slice_frequency,
+    find_output,
+    update_metrics_store,
+)
+from recording_descriptor import RecordingDescriptor
+
+FILENAME = 'sub-001_ses-002_task-checker_run-003_eeg.set'
+
+
+def simulate(**kwargs):
+    return simulated_data.simulate_eeg_fmri_data(n_channels=4,
+                                                 duration=40,
+                                                 sampling_frequency=500,
+                                                 random_state=0,
+                                                 **kwargs)
+
+@pytest.fixture(scope='module')
+def metrics():
+    readers = {
+        'clean': simulate(gradient_amplitude=0, bcg_amplitude=0),
+        'bcg': simulate(gradient_amplitude=0),
+        'raw': simulate(),
+    }
+    metrics = compare_outputs(readers)
+    return metrics.groupby(['metric', 'variant'])['value'].mean()
+
+def test_tidy_table(metrics):
+    assert set(metrics.index.get_level_values('variant')) == {
+        'clean', 'bcg', 'raw'
+    }
+    assert set(metrics.index.get_level_values('metric')) == {
+        'gradient_residual_power',
+        'bcg_residual',
+        'snr',
+        'variance_explained',
+        *[f'{band}_power' for band in BANDS],
+    }
+
+def test_gradient_residual(metrics):
+    power = metrics['gradient_residual_power']
+    assert power['raw'] > 100 * power['clean']
+
+def test_bcg_residual(metrics):
+    residual = metrics['bcg_residual']
+    assert residual['bcg'] > 2 * residual['clean']
+
+def test_variance_explained(metrics):
+    variance_explained = metrics['variance_explained']
+    assert variance_explained['clean'] == pytest.approx(1)
+    assert variance_explained['raw'] < variance_explained['bcg'] < 1
+
+def test_too_short_recording():
+    raw = simulated_data.simulate_eeg_fmri_data(n_channels=2,
+                                                duration=2,
+                                                sampling_frequency=250,
+                                                random_state=0)
+    with pytest.raises(ValueError):
+        compare_outputs({'raw': raw})
+
+def test_estimate_slice_frequency():
+    freqs = np.arange(0, 250.25, 0.25)
+    psd = np.ones((2, len(freqs)))
+    for frequency, power in [(15, 50), (30, 80), (45, 60)]:
+        psd[:, int(frequency / 0.25)] = power
+    assert estimate_slice_frequency(freqs, psd, 0.5) == 15
+
+def test_find_output(tmp_path):
+    path = tmp_path.joinpath('RAW', 'sub-001', 'ses-002', 'eeg', FILENAME)
+    descriptor = RecordingDescriptor.from_path(path)
+    histories = variant_histories(descriptor)
+    assert histories['cbin_pyprep_asr'] == ['GRAD', 'BCG', 'PREP', 'ASR']
+    assert find_output(descriptor, histories['cbin']) is None
+    filename = descriptor.modality_path(histories['cbin']).joinpath(
+        descriptor.base_filename + '.h5'
+    )
+    filename.parent.mkdir(parents=True)
+    filename.touch()
+    assert find_output(descriptor, histories['cbin']) == filename
+
+def test_update_metrics_store_skips_unchanged_outputs(tmp_path, monkeypatch):
+    path = tmp_path.joinpath('RAW', 'sub-001', 'ses-002', 'eeg', FILENAME)
+    descriptor = RecordingDescriptor.from_path(path)
+    filename = descriptor.output_filename(['GRAD', 'BCG'])
+    filename.parent.mkdir(parents=True)
+    filename.write_bytes(b'0')
+    calls = list()
+
+    def compare_file(descriptor, variants, **kwargs):
+        calls.append(descriptor.filename)
+        return pd.DataFrame(dict(file=[descriptor.filename],
+                                 variant=['cbin'],
+                                 channel=['Fz'],
+                                 metric=['snr'],
+                                 value=[1.0]))
+
+    monkeypatch.setattr(quality_metrics, 'compare_file', compare_file)
+    store = MetricsStore(tmp_path.joinpath('metrics.sqlite'))
+    assert update_metrics_store(store, descriptor)
+    assert not update_metrics_store(store, descriptor)
+    filename.write_bytes(b'00')
+    assert update_metrics_store(store, descriptor)
+    assert len(calls) == 2
+    assert len(store.file_summaries()) == 1
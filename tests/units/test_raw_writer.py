@@ -0,0 +1,67 @@
+import threading
+
+import mne
+import numpy as np
+import pytest
+import simulated_data
+
+from raw_writer import AsyncRawWriter, write_raw_atomic
+
+FILENAME = 'sub-001_ses-001_task-test_run-001_eeg.fif'
+
+
+def test_write_raw_atomic(tmp_path):
+    raw = simulated_data.simulate_light_eeg_data(random_state=0)
+    destination = write_raw_atomic(raw, tmp_path.joinpath(FILENAME),
+                                   fmt='double', fsync='directory')
+    assert [path.name for path in tmp_path.iterdir()] == [FILENAME]
+    saved = mne.io.read_raw_fif(destination, preload=True)
+    assert np.array_equal(saved.get_data(), raw.get_data())
+
+def test_write_raw_atomic_removes_stale_parts(tmp_path):
+    stale_part = tmp_path.joinpath(FILENAME.replace('.fif', '-1.fif'))
+    stale_part.write_bytes(b'previous split')
+    raw = simulated_data.simulate_light_eeg_data()
+    write_raw_atomic(raw, tmp_path.joinpath(FILENAME))
+    assert not stale_part.exists()
+
+def test_write_raw_atomic_failure_keeps_previous_file(tmp_path):
+    destination = tmp_path.joinpath(FILENAME)
+    destination.write_bytes(b'previous output')
+
+    class FailingRaw:
+        def save(self, *args, **kwargs):
+            raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        write_raw_atomic(FailingRaw(), destination)
+    assert destination.read_bytes() == b'previous output'
+    assert [path.name for path in tmp_path.iterdir()] == [FILENAME]
+
+def test_write_raw_atomic_rejects_half_precision(tmp_path):
+    raw = simulated_data.simulate_light_eeg_data()
+    with pytest.raises(ValueError):
+        write_raw_atomic(raw, tmp_path.joinpath(FILENAME), fmt='float16')
+
+def test_async_writer_queue_is_bounded():
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocked_job():
+        started.set()
+        release.wait()
+
+    writer = AsyncRawWriter(max_pending=1)
+    writer.submit(blocked_job)
+    started.wait()
+    writer.submit(lambda: None)
+    submitted = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (writer.submit(lambda: None), submitted.set())
+    )
+    thread.start()
+    assert not submitted.wait(0.2)
+    release.set()
+    thread.join()
+    writer.close()
+    assert submitted.is_set()
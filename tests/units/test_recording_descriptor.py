@@ -0,0 +1,75 @@
+import pickle
+from pathlib import Path
+
+import recording_descriptor
+from recording_descriptor import (
+    RecordingDescriptor,
+    derivatives_root,
+    forget_created_directories,
+    make_directories,
+)
+
+FILENAME = 'sub-001_ses-002_task-checker_run-003_eeg.set'
+
+
+def test_from_path_parses_entities(tmp_path):
+    path = tmp_path.joinpath('RAW', 'sub-001', 'ses-002', 'eeg', FILENAME)
+    descriptor = RecordingDescriptor.from_path(path)
+    assert descriptor.entities == {
+        'subject': '001',
+        'session': '002',
+        'task': 'checker',
+        'run': 3,
+        'suffix': 'eeg',
+        'extension': '.set',
+    }
+    assert descriptor.base_filename == FILENAME[:-4]
+    assert descriptor.sidecar_path == path.with_suffix('.json')
+    assert descriptor.derivatives_path == tmp_path.joinpath('DERIVATIVES')
+
+def test_output_paths(tmp_path):
+    path = tmp_path.joinpath('RAW', 'sub-001', 'ses-002', 'eeg', FILENAME)
+    descriptor = RecordingDescriptor.from_path(path)
+    assert descriptor.output_filename(['GRAD', 'BCG']) == tmp_path.joinpath(
+        'DERIVATIVES',
+        'GRAD_BCG',
+        'sub-001',
+        'ses-002',
+        'eeg',
+        FILENAME.replace('.set', '.fif'),
+    )
+
+def test_derivatives_root_of_dataset_root(tmp_path):
+    assert derivatives_root(tmp_path.joinpath('RAW')) == tmp_path.joinpath(
+        'DERIVATIVES'
+    )
+
+def test_descriptor_is_picklable(tmp_path):
+    path = tmp_path.joinpath('RAW', 'sub-001', 'ses-002', 'eeg', FILENAME)
+    descriptor = pickle.loads(pickle.dumps(RecordingDescriptor.from_path(path)))
+    assert descriptor.path == path
+    assert descriptor.entities['run'] == 3
+
+def test_make_directories_creates_each_folder_once(tmp_path, monkeypatch):
+    created = list()
+    mkdir = Path.mkdir
+
+    def counting_mkdir(self, *args, **kwargs):
+        created.append(self)
+        mkdir(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, 'mkdir', counting_mkdir)
+    directories = [tmp_path.joinpath('a', 'b', name) for name in 'cd']
+    make_directories(directories + [tmp_path.joinpath('a')])
+    make_directories(directories)
+    assert all(directory.is_dir() for directory in directories)
+    assert created == [tmp_path.joinpath('a'), *directories]
+    assert tmp_path.joinpath('a') in recording_descriptor._CREATED_DIRECTORIES
+
+def test_forget_created_directories(tmp_path):
+    directory = tmp_path.joinpath('a', 'b')
+    make_directories([directory])
+    directory.rmdir()
+    forget_created_directories()
+    make_directories([directory])
+    assert directory.is_dir()
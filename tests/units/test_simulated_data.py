@@ -1,11 +1,17 @@
 
 # Generated by CodiumAI
 import mne
+import numpy as np
 import pytest
 import pandas as pd
 import os
 from pathlib import Path
-from simulated_data import simulate_eeg_data, simulate_light_eeg_data, DummyDataset
+from simulated_data import (
+    DummyDataset,
+    simulate_eeg_data,
+    simulate_eeg_fmri_data,
+    simulate_light_eeg_data,
+)
 
 @pytest.fixture
 def raw_data():
@@ -58,6 +64,14 @@ def test_participant_metadata():
     for column in dataset.participant_metadata.columns:
         assert not any(nan_mask[column].values)
 
+def test_participant_metadata_is_reproducible():
+    first = DummyDataset(n_subjects=5)
+    first.create_participants_metadata(random_state=0)
+    second = DummyDataset(n_subjects=5)
+    second.create_participants_metadata(random_state=0)
+    pd.testing.assert_frame_equal(first.participant_metadata,
+                                  second.participant_metadata)
+
 def test_add_participant_metadata():
     dataset = DummyDataset(n_subjects = 5)
     dataset.create_participants_metadata()
@@ -190,3 +204,181 @@ def test_populate_label():
         for i, asserting_label in enumerate(assertion):
             assert  attribute_values[i] == asserting_label
     
+
+def test_simulate_eeg_data_shape_with_fractional_duration():
+    result = simulate_eeg_data(duration=2.5,
+                               sampling_frequency=1000,
+                               misc_channels=['ecg', 'emg'],
+                               events_kwargs=None)
+    assert result.get_data().shape == (18, 2500)
+
+def test_simulate_eeg_data_is_reproducible():
+    first = simulate_eeg_data(random_state=42).get_data()
+    second = simulate_eeg_data(random_state=42).get_data()
+    third = simulate_eeg_data(random_state=43).get_data()
+    assert (first == second).all()
+    assert not (first == third).all()
+
+def test_simulate_eeg_data_methods_have_similar_amplitude():
+    kwargs = dict(duration=10,
+                  sampling_frequency=500,
+                  misc_channels=None,
+                  events_kwargs=None,
+                  random_state=0)
+    numpy_data = simulate_eeg_data(method='numpy', **kwargs).get_data()
+    neurokit_data = simulate_eeg_data(method='neurokit', **kwargs).get_data()
+    assert numpy_data.shape == neurokit_data.shape
+    ratio = numpy_data.std() / neurokit_data.std()
+    assert 0.5 < ratio < 2
+
+def test_simulate_eeg_data_wrong_method():
+    with pytest.raises(ValueError):
+        simulate_eeg_data(method='matlab')
+
+def test_create_eeg_dataset_in_parallel(tmp_path):
+    dataset = DummyDataset(n_subjects=2, n_sessions=2, root=tmp_path)
+    dataset.create_eeg_dataset(fmt='eeglab', light=True, n_jobs=2)
+    eeg_files = sorted(dataset.bids_path.rglob('*.set'))
+    assert len(eeg_files) == 4
+    for eeg_file in eeg_files:
+        assert eeg_file.with_suffix('.json').exists()
+
+def test_create_eeg_dataset_from_cache(tmp_path):
+    cache_dir = tmp_path.joinpath('cache')
+    first = DummyDataset(n_subjects=2, root=tmp_path)
+    first.create_eeg_dataset(fmt='fif',
+                             light=True,
+                             random_state=42,
+                             cache_dir=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+    second = DummyDataset(n_subjects=2, root=tmp_path)
+    second.create_eeg_dataset(fmt='fif',
+                              light=True,
+                              random_state=42,
+                              cache_dir=cache_dir)
+    assert second.subjects == first.subjects
+    first_files = sorted(first.bids_path.rglob('*_eeg.fif'))
+    second_files = sorted(second.bids_path.rglob('*_eeg.fif'))
+    assert len(first_files) == len(second_files) == 2
+    for first_file, second_file in zip(first_files, second_files):
+        assert first_file.read_bytes() == second_file.read_bytes()
+
+def test_create_eeg_dataset_cache_depends_on_seed(tmp_path):
+    cache_dir = tmp_path.joinpath('cache')
+    for random_state in [1, 2]:
+        dataset = DummyDataset(root=tmp_path)
+        dataset.create_eeg_dataset(fmt='fif',
+                                   light=True,
+                                   random_state=random_state,
+                                   cache_dir=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 2
+
+def test_create_eeg_dataset_eeg_fmri(tmp_path):
+    dataset = DummyDataset(root=tmp_path)
+    dataset.create_eeg_dataset(fmt='fif',
+                               simulator='eeg_fmri',
+                               repetition_time=1.5,
+                               heart_rate=60,
+                               random_state=0,
+                               duration=10,
+                               sampling_frequency=1000,
+                               brain_signal=False)
+    eeg_file, = dataset.bids_path.rglob('*_eeg.fif')
+    raw = mne.io.read_raw_fif(eeg_file)
+    onsets = raw.annotations.onset[raw.annotations.description == 'R128']
+    assert np.allclose(np.diff(onsets), 1.5)
+    assert 'ecg' in raw.get_channel_types()
+
+def test_create_eeg_dataset_cache_depends_on_simulator(tmp_path):
+    cache_dir = tmp_path.joinpath('cache')
+    for simulator in ['light', 'eeg_fmri']:
+        dataset = DummyDataset(root=tmp_path)
+        dataset.create_eeg_dataset(fmt='fif',
+                                   simulator=simulator,
+                                   random_state=0,
+                                   cache_dir=cache_dir,
+                                   duration=5,
+                                   sampling_frequency=500)
+    assert len(list(cache_dir.iterdir())) == 2
+
+def test_create_eeg_dataset_eeg_fmri_montage(tmp_path):
+    dataset = DummyDataset(root=tmp_path)
+    dataset.create_eeg_dataset(fmt='eeglab',
+                               simulator='eeg_fmri',
+                               random_state=0,
+                               n_channels=64,
+                               duration=3,
+                               sampling_frequency=250,
+                               brain_signal=False)
+    eeg_file, = dataset.bids_path.rglob('*_eeg.set')
+    raw = mne.io.read_raw_eeglab(eeg_file)
+    raw.pick('eeg')
+    montage = mne.channels.make_standard_montage('biosemi64')
+    assert raw.ch_names == montage.ch_names
+    positions = np.array([ch['loc'][:3] for ch in raw.info['chs']])
+    assert np.all(np.isfinite(positions))
+    assert not np.any(np.all(positions == 0, axis=1))
+
+def test_create_eeg_dataset_wrong_simulator(tmp_path):
+    with pytest.raises(ValueError):
+        DummyDataset(root=tmp_path).create_eeg_dataset(simulator='matlab')
+    with pytest.raises(ValueError):
+        DummyDataset(root=tmp_path).create_eeg_dataset(light=True,
+                                                       repetition_time=2)
+
+def test_simulate_eeg_fmri_data_volume_markers():
+    raw = simulate_eeg_fmri_data(n_channels=8,
+                                 duration=21,
+                                 sampling_frequency=1000,
+                                 repetition_time=2,
+                                 first_volume=1,
+                                 random_state=0)
+    assert raw.get_data().shape == (9, 21000)
+    assert raw.get_channel_types()[-1] == 'ecg'
+    onsets = raw.annotations.onset
+    assert len(onsets) == 10
+    assert np.allclose(np.diff(onsets), 2)
+    assert set(raw.annotations.description) == {'R128'}
+
+def test_simulate_eeg_fmri_data_gradient_is_tr_locked():
+    raw = simulate_eeg_fmri_data(n_channels=4,
+                                 duration=11,
+                                 sampling_frequency=1000,
+                                 repetition_time=2,
+                                 first_volume=1,
+                                 bcg_amplitude=0,
+                                 brain_signal=False,
+                                 random_state=0)
+    data = raw.get_data(picks='eeg')
+    assert np.allclose(data[:, 1000:3000], data[:, 3000:5000])
+    assert np.all(data[:, :1000] == 0)
+
+def test_simulate_eeg_fmri_data_bcg_follows_ecg():
+    raw = simulate_eeg_fmri_data(n_channels=4,
+                                 duration=20,
+                                 sampling_frequency=500,
+                                 gradient_amplitude=0,
+                                 brain_signal=False,
+                                 heart_rate=60,
+                                 random_state=0)
+    ecg = raw.get_data(picks='ecg')[0]
+    eeg = raw.get_data(picks='eeg')
+    assert ecg.max() > 0
+    assert np.abs(eeg).max() > 0
+    assert np.abs(eeg[:, :50]).max() < np.abs(eeg).max()
+
+def test_simulate_eeg_fmri_data_is_reproducible():
+    first = simulate_eeg_fmri_data(duration=5,
+                                   sampling_frequency=500,
+                                   random_state=3)
+    second = simulate_eeg_fmri_data(duration=5,
+                                    sampling_frequency=500,
+                                    random_state=3)
+    assert np.array_equal(first.get_data(), second.get_data())
+
+def test_simulate_eeg_fmri_data_many_channels():
+    raw = simulate_eeg_fmri_data(n_channels=40,
+                                 duration=3,
+                                 sampling_frequency=250,
+                                 random_state=0)
+    assert len(raw.ch_names) == 41
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+import simulated_data
+
+from step_cache import StepCache
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    eeg_path = tmp_path.joinpath('RAW', 'sub-001', 'ses-001', 'eeg')
+    eeg_path.mkdir(parents=True)
+    filename = eeg_path.joinpath('sub-001_ses-001_task-test_run-001_eeg.set')
+    filename.write_bytes(b'header')
+    eeg_path.joinpath(filename.stem + '.fdt').write_bytes(b'data')
+    eeg_path.joinpath(filename.stem + '.json').write_text('{}')
+    return filename
+
+@pytest.fixture
+def cache(tmp_path):
+    return StepCache(tmp_path.joinpath('cache'))
+
+def test_key_depends_on_history_step_and_parameters(cache, source_file):
+    key = cache.make_key(source_file, ['GRAD'], 'run_asr', {})
+    assert key == cache.make_key(source_file, ['GRAD'], 'run_asr', {})
+    assert key != cache.make_key(source_file, ['BCG'], 'run_asr', {})
+    assert key != cache.make_key(source_file, ['GRAD'], 'run_pyprep', {})
+    assert key != cache.make_key(source_file, ['GRAD'], 'run_asr', {'a': 1})
+    assert key != cache.make_key(source_file, ['GRAD'], 'run_asr', {},
+                                 parent_key='0' * 64)
+
+def test_key_depends_on_companion_file(tmp_path, source_file):
+    key = StepCache(tmp_path).make_key(source_file, [], 'run_asr', {})
+    source_file.with_suffix('.fdt').write_bytes(b'other data')
+    assert key != StepCache(tmp_path).make_key(source_file, [], 'run_asr', {})
+
+def test_key_ignores_sidecar(tmp_path, source_file):
+    key = StepCache(tmp_path).make_key(source_file, [], 'run_asr', {})
+    source_file.with_suffix('.json').write_text('{"changed": true}')
+    assert key == StepCache(tmp_path).make_key(source_file, [], 'run_asr', {})
+
+def test_store_and_load(cache, source_file):
+    raw = simulated_data.simulate_light_eeg_data()
+    key = cache.make_key(source_file, [], 'run_asr', {})
+    assert cache.load(key) is None
+    cache.store(key, raw, ['ASR'])
+    cached_raw, process_history = cache.load(key)
+    assert process_history == ['ASR']
+    assert np.allclose(cached_raw.get_data(), raw.get_data())
+
+def test_evict_least_recently_used(cache, source_file):
+    raw = simulated_data.simulate_light_eeg_data()
+    keys = [cache.make_key(source_file, [], str(i), {}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, raw, [str(i)])
+        entry_history = cache.root.joinpath(key[:2], key, 'history.json')
+        os.utime(entry_history, (i, i))
+    entry_size = cache.size() // 3
+    removed = cache.evict(max_size=2 * entry_size)
+    assert len(removed) == 1
+    assert cache.load(keys[0]) is None
+    assert cache.load(keys[2]) is not None
+
+def test_clear(cache, source_file):
+    raw = simulated_data.simulate_light_eeg_data()
+    key = cache.make_key(source_file, [], 'run_asr', {})
+    cache.store(key, raw, ['ASR'])
+    cache.clear()
+    assert cache.load(key) is None
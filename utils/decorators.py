@@ -1,4 +1,7 @@
 import functools
+import inspect
+import resource
+import time
 from pathlib import Path
 from typing import Callable, Dict, Tuple, TypeVar, cast, Any
 
@@ -6,25 +9,158 @@ import bids
 from simulated_data import DummyDataset
 
 FunctionType = TypeVar('FunctionType', bound=Callable[..., Any])
+
+def _raw_dimensions(raw: object) -> tuple[int | None, int | None]:
+    """Get the number of channels and samples of a raw object if any."""
+    if raw is None:
+        return None, None
+    return len(raw.ch_names), raw.n_times
+
+def instrumented(func: FunctionType) -> FunctionType:  # noqa: ANN001
+    """Decorator that records the resources used by a step.
+
+    A record is appended to the step_metrics list of the pipeline with the
+    wall time, the CPU time, the increase of the peak resident memory (in MB)
+    and the dimensions of the data before and after the step. The data is the
+    'raw' argument of the step if it has one, the raw attribute otherwise.
+    CPU time and peak memory are measured for the whole process, including the
+    background writer thread.
+
+    A step run after the pipeline moved on (e.g. a save done by the background
+    writer) is given a 'metrics_context' keyword argument. It holds the fields
+    of the record captured when the step was submitted (process history and
+    dimensions), which replace the ones read from the pipeline.
+
+    Args:
+        func (_type_): The step to measure.
+
+    Returns:
+        _type_: The wrapped step.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper_decorator(self: object,  # noqa: ANN001
+                          *args: tuple,
+                          **kwargs: dict[str, Any]) -> Any:  # noqa: ANN002
+        metrics_context = kwargs.pop("metrics_context", None) or dict()
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        n_channels_in, n_samples_in = _raw_dimensions(
+            arguments.get("raw", getattr(self, "raw", None))
+        )
+        peak_rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        result = func(self, *args, **kwargs)
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        peak_rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        n_channels_out, n_samples_out = _raw_dimensions(
+            arguments.get("raw", getattr(self, "raw", None))
+        )
+        self.step_metrics.append({
+            "file": self.rawdata_path.name,
+            "step": func.__name__,
+            "process_history": "_".join(self.process_history),
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            # ru_maxrss is in kilobytes on Linux.
+            "peak_rss_delta": (peak_rss_end - peak_rss_start) / 1024,
+            "n_channels_in": n_channels_in,
+            "n_samples_in": n_samples_in,
+            "n_channels_out": n_channels_out,
+            "n_samples_out": n_samples_out,
+            **metrics_context,
+        })
+        return result
+    return cast(FunctionType, wrapper_decorator)
+
 def pipe(func: FunctionType) -> FunctionType:  # noqa: ANN001
     """Decorator that pipes to the folder creation and saving methods.
 
+    The output of the step is converted to the precision of the pipeline and
+    saved according to its save policy. Every step runs while the previous
+    output is written by the background writer, if any. The steps that could
+    modify the data in place (all but ASYNC_SAFE_STEPS) first get their own
+    copy of the data if it is still held by the forks or by a pending write
+    (see CleanerPipelines._own_data). The resources used by the step are
+    recorded (see instrumented).
+
     Args:
         func (_type_):
 
     Returns:
         _type_: _description_
     """
+    measured_func = instrumented(func)
+
     @functools.wraps(func)
     def wrapper_decorator(self: object,  # noqa: ANN001
-                          *args: tuple, 
-                          **kwargs: dict[str, Any]) -> None:  # noqa: ANN002
-        func(self,*args, **kwargs)
-        self._make_process_path()
-        self._make_subject_session_path()
-        self._make_modality_path()
-        self._save_raw()
-        self._copy_sidecar()
+                          *args: tuple,
+                          **kwargs: dict[str, Any]) -> Any:  # noqa: ANN002
+        if func.__name__ not in self.ASYNC_SAFE_STEPS:
+            # The step could modify the data still being written or shared
+            # with the forks of the pipeline.
+            self._own_data()
+        result = measured_func(self,*args, **kwargs)
+        # The output is held in the precision of the pipeline.
+        self._apply_precision()
+        self._release_shared_data()
+        if self._step_must_be_saved():
+            self.save()
+        return result
+    return cast(FunctionType, wrapper_decorator)
+
+def cached(func: FunctionType) -> FunctionType:  # noqa: ANN001
+    """Decorator that loads the output of a step from the step cache.
+
+    If the pipeline has a step cache, the step is looked up with a key made of
+    the raw recording, the process history, the key of the previous step, the
+    step parameters and the state of the pipeline that changes the output (see
+    CleanerPipelines._cache_context). The parameters listed in
+    CACHE_IGNORED_PARAMETERS (e.g. n_jobs) are left out. On a hit
+    the cleaned data and the process history are restored from the cache and
+    the step is not run. On a miss the step is run and its output is stored.
+    In both cases the key is kept by the pipeline for the next step, so the
+    keys chain the parameters of the whole lineage.
+
+    Args:
+        func (_type_): The step to cache.
+
+    Returns:
+        _type_: The wrapped step.
+    """
+    @functools.wraps(func)
+    def wrapper_decorator(self: object,  # noqa: ANN001
+                          *args: tuple,
+                          **kwargs: dict[str, Any]) -> Any:  # noqa: ANN002
+        step_cache = getattr(self, "step_cache", None)
+        if step_cache is None:
+            return func(self, *args, **kwargs)
+
+        bound_arguments = inspect.signature(func).bind(self, *args, **kwargs)
+        bound_arguments.apply_defaults()
+        parameters = dict(bound_arguments.arguments)
+        parameters.pop("self")
+        for name in getattr(self, "CACHE_IGNORED_PARAMETERS", ()):
+            parameters.pop(name, None)
+        parameters["pipeline_state"] = self._cache_context(func.__name__,
+                                                           parameters)
+        key = step_cache.make_key(self.rawdata_path,
+                                  self.process_history,
+                                  func.__name__,
+                                  parameters,
+                                  parent_key=getattr(self, "_step_cache_key", None))
+        entry = step_cache.load(key)
+        if entry is not None:
+            self.raw, self.process_history = entry
+            self._step_cache_key = key
+            return self
+
+        result = func(self, *args, **kwargs)
+        step_cache.store(key, self.raw, self.process_history)
+        self._step_cache_key = key
+        return result
     return cast(FunctionType, wrapper_decorator)
 
 def dummy_dataset(func: FunctionType) -> None:
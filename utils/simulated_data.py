@@ -1,8 +1,10 @@
 import functools
+import hashlib
 import json
 import os
 import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Any, Callable, List, Optional, TypeVar, Union, cast
 
@@ -18,13 +20,12 @@ from path_handler import DirectoryTree
 #   - refactor the eeg dataset generation with the newly populate labels method
 #   - add the simulation of: 
 #                           - EOG
-#                           - gradient artifacts
-#                           - BCG artifacts  
 FunctionType = TypeVar('FunctionType', bound=Callable[..., Any])
 def simulate_light_eeg_data(
     n_channels: int = 16,
     duration: int = 2,
     sampling_frequency: int = 256,
+    random_state: Optional[Union[int, np.random.Generator]] = None,
 ) -> RawArray:
     """Simulate EEG data that have low impact on memory.
     
@@ -35,6 +36,8 @@ def simulate_light_eeg_data(
         n_channels (int): The number of EEG channels.
         duration (int): The duration of the EEG data in seconds.
         sampling_frequency (int): The sampling frequency of the EEG data.
+        random_state (int | np.random.Generator, optional): The seed or the
+            generator of the random numbers. Defaults to None.
 
     Returns:
         RawArray: The simulated EEG data.
@@ -45,13 +48,113 @@ def simulate_light_eeg_data(
     if duration <= 0:
         raise ValueError("The duration must be greater than 0.")
 
-    eeg_data = np.random.randn(n_channels, duration * sampling_frequency)
+    rng = np.random.default_rng(random_state)
+    eeg_data = rng.standard_normal(
+        (n_channels, int(round(duration * sampling_frequency)))
+    )
     channel_names = [str(i) for i in range(n_channels)]
     info = create_info(channel_names, sampling_frequency, ch_types='eeg')
     raw = RawArray(eeg_data, info)
     
     return raw
-    
+
+def _fit_length(signal: np.ndarray, n_samples: int) -> np.ndarray:
+    """Crop or edge pad a signal to a number of samples.
+
+    The signals simulated by neurokit are resampled internally and can be
+    a few samples longer or shorter than duration * sampling_frequency.
+    """
+    signal = np.asarray(signal)[:n_samples]
+    if len(signal) < n_samples:
+        signal = np.pad(signal, (0, n_samples - len(signal)), mode='edge')
+    return signal
+
+def _simulate_neurokit_channel(
+    arguments: tuple[float, int, float, int]
+) -> np.ndarray:
+    """Simulate a single EEG channel with neurokit (process pool worker)."""
+    duration, sampling_frequency, noise, seed = arguments
+    signal = nk.eeg_simulate(duration=duration,
+                             sampling_rate=sampling_frequency,
+                             noise=noise,
+                             random_state=seed)
+    return _fit_length(signal, int(round(duration * sampling_frequency)))
+
+def _interpolated_noise(
+    rng: np.random.Generator,
+    n_channels: int,
+    n_samples: int,
+    duration: float,
+    noise_frequency: float,
+    noise_amplitude: Union[float, np.ndarray],
+) -> np.ndarray:
+    """Generate Laplace noise varying at a given frequency for all channels.
+
+    Random points are drawn at noise_frequency and linearly interpolated to
+    the sampling frequency, as done by neurokit signal_distort. The noise
+    amplitude is the scale of the Laplace distribution, one per channel when
+    it has the shape (n_channels, 1).
+    """
+    n_points = max(int(duration * noise_frequency), 2)
+    points = rng.laplace(0, noise_amplitude, size=(n_channels, n_points))
+    positions = np.linspace(0, n_points - 1, n_samples)
+    lower = np.minimum(positions.astype(int), n_points - 2)
+    weights = positions - lower
+    return points[:, lower] * (1 - weights) + points[:, lower + 1] * weights
+
+def _simulate_eeg_signals(
+    n_channels: int,
+    duration: float,
+    sampling_frequency: int,
+    noise: float,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Simulate the EEG signals of all channels in one batched pass.
+
+    It follows the structure of neurokit eeg_simulate: a brain like signal
+    of a few microvolts (1/f background and a 10 Hz rhythm) to which Laplace
+    noise varying at 5, 10 and 100 Hz is added. As in neurokit
+    signal_distort, the noise amplitude is relative to the standard
+    deviation of the signal of each channel. The noise components at or
+    above the Nyquist frequency are skipped.
+
+    Args:
+        n_channels (int): The number of channels.
+        duration (float): The duration in seconds.
+        sampling_frequency (int): The sampling frequency in Hz.
+        noise (float): The amplitude of the noise relative to the standard
+            deviation of the signal.
+        rng (np.random.Generator): The generator of the random numbers.
+
+    Returns:
+        np.ndarray: The signals, shape (n_channels, n_samples).
+    """
+    n_samples = int(round(duration * sampling_frequency))
+    spectrum = np.fft.rfft(rng.standard_normal((n_channels, n_samples)),
+                           axis=1)
+    frequencies = np.fft.rfftfreq(n_samples, d=1 / sampling_frequency)
+    frequencies[0] = frequencies[1] if len(frequencies) > 1 else 1
+    spectrum /= np.sqrt(frequencies)
+    background = np.fft.irfft(spectrum, n=n_samples, axis=1)
+    background /= background.std(axis=1, keepdims=True)
+
+    times = np.arange(n_samples) / sampling_frequency
+    phases = rng.uniform(0, 2 * np.pi, size=(n_channels, 1))
+    alpha = np.sin(2 * np.pi * 10 * times + phases)
+    eeg_data = 5e-6 * (background + alpha)
+
+    if noise > 0:
+        noise_amplitude = noise * eeg_data.std(axis=1, ddof=1, keepdims=True)
+        for noise_frequency in [5, 10, 100]:
+            if noise_frequency < sampling_frequency / 2:
+                eeg_data += _interpolated_noise(rng,
+                                                n_channels,
+                                                n_samples,
+                                                duration,
+                                                noise_frequency,
+                                                noise_amplitude)
+    return eeg_data
+
 def simulate_eeg_data(
     n_channels: int = 16,
     duration: int = 2,
@@ -62,17 +165,32 @@ def simulate_eeg_data(
         number= 1,
         start = 1,
         stop = 5
-    )
+    ),
+    method: str = 'numpy',
+    random_state: Optional[Union[int, np.random.Generator]] = None,
+    n_jobs: int = 1,
 ) -> RawArray:
     """Simulate EEG data.
 
-    This function generates simulated EEG data.
+    This function generates simulated EEG data. The 'numpy' method simulates
+    all the channels at once (see _simulate_eeg_signals) and is orders of
+    magnitude faster than the 'neurokit' method which calls eeg_simulate for
+    each channel, optionally in a pool of n_jobs processes.
 
     Args:
         n_channels (int): The number of EEG channels.
-        duration_seconds (int): The duration of the EEG data in seconds.
+        duration (int): The duration of the EEG data in seconds.
+        misc_channels (list, optional): The physiological channels to add
+            ('ecg', 'emg'). Defaults to ['ecg'].
         sampling_frequency (int): The sampling frequency of the EEG data.
-        events_name (str, optional): The name of the events. Defaults to 'R128'.
+        events_kwargs (dict, optional): The name, number, start and stop of
+            the events to annotate. No event is added if None.
+        method (str, optional): The simulation engine, 'numpy' or 'neurokit'.
+            Defaults to 'numpy'.
+        random_state (int | np.random.Generator, optional): The seed or the
+            generator of the random numbers. Defaults to None.
+        n_jobs (int, optional): The number of processes used by the 'neurokit'
+            method. Defaults to 1.
 
     Returns:
         RawArray: The simulated EEG data.
@@ -83,17 +201,29 @@ def simulate_eeg_data(
     if duration <= 0:
         raise ValueError("The duration must be greater than 0.")
 
-    eeg_data = np.zeros((n_channels, duration * sampling_frequency))
-    for channel in range(n_channels):
-        # !!!!!!
-        # Careful it is sensitive to the duration. Somewhat it doesn't have 
-        # the same shape as the premade eeg_data array so numpy throws an error
-        # saying it couldn't broadcast the array.
-        # I will need to take care of that
-        eeg_data[channel,:] = nk.eeg_simulate(duration=duration, 
-                                sampling_rate=sampling_frequency,
-                                noise= 0.1)
-        
+    if method not in ['numpy', 'neurokit']:
+        raise ValueError("The method must be 'numpy' or 'neurokit'.")
+
+    rng = np.random.default_rng(random_state)
+    n_samples = int(round(duration * sampling_frequency))
+    if method == 'numpy':
+        eeg_data = _simulate_eeg_signals(n_channels,
+                                         duration,
+                                         sampling_frequency,
+                                         noise=0.1,
+                                         rng=rng)
+    else:
+        seeds = rng.integers(0, 2**31 - 1, size=n_channels)
+        arguments = [
+            (duration, sampling_frequency, 0.1, int(seed)) for seed in seeds
+        ]
+        if n_jobs == 1:
+            signals = list(map(_simulate_neurokit_channel, arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                signals = list(executor.map(_simulate_neurokit_channel,
+                                            arguments))
+        eeg_data = np.stack(signals)
 
     channel_names = [str(i) for i in range(n_channels)]
     montage = mne.channels.make_standard_montage('biosemi16')
@@ -104,7 +234,9 @@ def simulate_eeg_data(
         misc_channels_object_list = list()
         if 'ecg' in misc_channels:
             ecg = nk.ecg_simulate(duration=duration, 
-                                  sampling_rate=sampling_frequency)
+                                  sampling_rate=sampling_frequency,
+                                  random_state=int(rng.integers(2**31 - 1)))
+            ecg = _fit_length(ecg, n_samples)
             
             eeg_data[ch_names.index('T8'),:] *= (ecg * 2)*1e-6
             eeg_data[ch_names.index('T7'),:] *= - (ecg * 2)*1e-6
@@ -116,8 +248,9 @@ def simulate_eeg_data(
             
         if 'emg' in misc_channels:
             emg = nk.emg_simulate(duration=duration, 
-                                  sampling_rate=sampling_frequency)
-            emg = np.expand_dims(emg, axis=0)
+                                  sampling_rate=sampling_frequency,
+                                  random_state=int(rng.integers(2**31 - 1)))
+            emg = np.expand_dims(_fit_length(emg, n_samples), axis=0)
             raw_emg = RawArray(
                 emg, 
                 create_info(['emg'], sampling_frequency, ch_types='emg'))
@@ -138,7 +271,6 @@ def simulate_eeg_data(
             num=events_kwargs['number'], 
             endpoint=False
             )
-        print(len(events_index))
         events_name = [events_kwargs['name']] * events_kwargs['number']
         annotations = mne.Annotations(
             onset=events_index/sampling_frequency,
@@ -150,6 +282,271 @@ def simulate_eeg_data(
     return raw
 
 
+def _eeg_channel_names(n_channels: int) -> tuple[list[str], Optional[str]]:
+    """Get the channel names of the smallest biosemi montage that fits.
+
+    Returns:
+        tuple[list[str], str | None]: The channel names and the name of the
+            montage, None if the channels are too many for any montage.
+    """
+    for n_montage_channels in [16, 32, 64, 128, 256]:
+        if n_channels <= n_montage_channels:
+            montage_name = f'biosemi{n_montage_channels}'
+            montage = mne.channels.make_standard_montage(montage_name)
+            return montage.ch_names[:n_channels], montage_name
+    return [f'EEG{i:03d}' for i in range(n_channels)], None
+
+def _gradient_volume_template(
+    volume_samples: int,
+    n_slices: int,
+    sampling_frequency: float,
+    readout_frequency: float,
+) -> np.ndarray:
+    """Build the gradient artifact of one fMRI volume.
+
+    Each slice starts with a slice selection pulse followed by the switching
+    of the EPI readout gradient, modeled as a trapezoidal square wave. The
+    slices are repeated n_slices times and the remaining samples of the TR
+    are left silent.
+    """
+    slice_samples = volume_samples // n_slices
+    times = np.arange(slice_samples) / sampling_frequency
+    readout = np.clip(3 * np.sin(2 * np.pi * readout_frequency * times), -1, 1)
+    readout[: slice_samples // 10] = 0
+    pulse_width = max(slice_samples // 20, 1)
+    pulse_times = np.arange(pulse_width) - pulse_width / 2
+    readout[:pulse_width] += 2 * np.exp(-(pulse_times / (pulse_width / 4))**2)
+    volume = np.zeros(volume_samples)
+    volume[: slice_samples * n_slices] = np.tile(readout, n_slices)
+    return volume
+
+def _place_template(
+    positions: np.ndarray,
+    template: np.ndarray,
+    weights: np.ndarray,
+    n_samples: int,
+) -> np.ndarray:
+    """Sum weighted copies of a template starting at each position."""
+    indices = positions[:, None] + np.arange(len(template))
+    values = weights[:, None] * template
+    inside = indices < n_samples
+    return np.bincount(indices[inside],
+                       weights=values[inside],
+                       minlength=n_samples)
+
+def simulate_eeg_fmri_data(
+    n_channels: int = 16,
+    duration: float = 25,
+    sampling_frequency: int = 5000,
+    repetition_time: float = 2.0,
+    n_slices: int = 30,
+    first_volume: float = 1.0,
+    gradient_amplitude: float = 5e-3,
+    readout_frequency: float = 1000.0,
+    heart_rate: float = 70.0,
+    heart_rate_variability: float = 0.05,
+    bcg_amplitude: float = 5e-5,
+    bcg_delay: float = 0.2,
+    bcg_jitter: float = 0.01,
+    brain_signal: bool = True,
+    events_name: str = 'R128',
+    random_state: Optional[Union[int, np.random.Generator]] = None,
+) -> RawArray:
+    """Simulate EEG data recorded inside the MRI scanner.
+
+    The EEG is contaminated by the two artifacts cleaned by the CBIN
+    pipelines. The gradient artifact is a TR locked template (see
+    _gradient_volume_template) with a gain per channel, and each volume is
+    annotated with an events_name marker. The BCG artifact is a pulse
+    waveform following the R peaks of the simulated ECG after bcg_delay, with
+    a timing jitter per beat. Every channel mixes the waveform and its time
+    derivative with its own weights, which gives a different shape and
+    latency per channel. All the artifacts are built with vectorized
+    operations, so long recordings with many channels are generated in
+    seconds.
+
+    Args:
+        n_channels (int, optional): The number of EEG channels.
+            Defaults to 16.
+        duration (float, optional): The duration in seconds. Defaults to 25.
+        sampling_frequency (int, optional): The sampling frequency in Hz.
+            Defaults to 5000.
+        repetition_time (float, optional): The repetition time (TR) of the
+            fMRI sequence in seconds. Defaults to 2.
+        n_slices (int, optional): The number of slices per volume.
+            Defaults to 30.
+        first_volume (float, optional): The onset of the first volume in
+            seconds. Defaults to 1.
+        gradient_amplitude (float, optional): The amplitude of the gradient
+            artifact in volts. Defaults to 5e-3.
+        readout_frequency (float, optional): The frequency of the EPI readout
+            gradient in Hz, limited to a quarter of the sampling frequency.
+            Defaults to 1000.
+        heart_rate (float, optional): The mean heart rate in beats per minute.
+            Defaults to 70.
+        heart_rate_variability (float, optional): The standard deviation of
+            the heart period relative to its mean. Defaults to 0.05.
+        bcg_amplitude (float, optional): The amplitude of the BCG artifact in
+            volts. Defaults to 5e-5.
+        bcg_delay (float, optional): The delay of the BCG after the R peak in
+            seconds. Defaults to 0.2.
+        bcg_jitter (float, optional): The standard deviation of the BCG delay
+            across beats in seconds. Defaults to 0.01.
+        brain_signal (bool, optional): Add the simulated brain activity of
+            simulate_eeg_data. Without it the EEG only holds the artifacts and
+            the generation is faster. Defaults to True.
+        events_name (str, optional): The description of the volume markers.
+            Defaults to 'R128'.
+        random_state (int | np.random.Generator, optional): The seed or the
+            generator of the random numbers. Defaults to None.
+
+    Returns:
+        RawArray: The simulated EEG with an 'ecg' channel.
+    """
+    if n_channels <= 0:
+        raise ValueError("The number of channels must be greater than 0.")
+
+    if duration <= 0:
+        raise ValueError("The duration must be greater than 0.")
+
+    rng = np.random.default_rng(random_state)
+    n_samples = int(round(duration * sampling_frequency))
+    if brain_signal:
+        eeg_data = _simulate_eeg_signals(n_channels,
+                                         duration,
+                                         sampling_frequency,
+                                         noise=0,
+                                         rng=rng)
+    else:
+        eeg_data = np.zeros((n_channels, n_samples))
+
+    # Gradient artifact
+    volume_samples = int(round(repetition_time * sampling_frequency))
+    first_volume_sample = int(round(first_volume * sampling_frequency))
+    n_volumes = max((n_samples - first_volume_sample) // volume_samples, 0)
+    volume_onsets = first_volume_sample + volume_samples * np.arange(n_volumes)
+    if n_volumes:
+        volume_template = _gradient_volume_template(
+            volume_samples,
+            n_slices,
+            sampling_frequency,
+            min(readout_frequency, sampling_frequency / 4),
+        )
+        gradient = gradient_amplitude * np.tile(volume_template, n_volumes)
+        gradient_gains = rng.normal(1, 0.3, size=n_channels)
+        gradient_stop = first_volume_sample + len(gradient)
+        for channel in range(n_channels):
+            eeg_data[channel, first_volume_sample:gradient_stop] += (
+                gradient_gains[channel] * gradient
+            )
+
+    # ECG and BCG artifact
+    mean_period = 60 / heart_rate
+    n_beats = int(duration / mean_period * 1.5) + 2
+    periods = mean_period * (
+        1 + heart_rate_variability * rng.standard_normal(n_beats)
+    )
+    periods = np.clip(periods, 0.3 * mean_period, None)
+    r_peaks = rng.uniform(0, mean_period) + np.cumsum(periods) - periods[0]
+    r_peaks = r_peaks[r_peaks < duration]
+
+    ecg_times = np.arange(int(0.6 * sampling_frequency)) / sampling_frequency
+    ecg_template = (
+        0.15 * np.exp(-((ecg_times - 0.1) / 0.025)**2)
+        - 0.1 * np.exp(-((ecg_times - 0.185) / 0.008)**2)
+        + 1.0 * np.exp(-((ecg_times - 0.2) / 0.01)**2)
+        - 0.25 * np.exp(-((ecg_times - 0.215) / 0.01)**2)
+        + 0.3 * np.exp(-((ecg_times - 0.45) / 0.05)**2)
+    ) * 1e-3
+    ecg_starts = np.round(
+        (r_peaks - 0.2) * sampling_frequency
+    ).astype(int)
+    keep = ecg_starts >= 0
+    ecg = _place_template(ecg_starts[keep],
+                          ecg_template,
+                          np.ones(keep.sum()),
+                          n_samples)
+
+    bcg_times = np.arange(int(0.5 * sampling_frequency)) / sampling_frequency
+    bcg_template = (
+        np.sin(2 * np.pi * 4 * bcg_times) * np.exp(-bcg_times / 0.12)
+    )
+    bcg_derivative = np.gradient(bcg_template) * sampling_frequency / 25
+    bcg_onsets = np.round(
+        (r_peaks + bcg_delay + bcg_jitter * rng.standard_normal(len(r_peaks)))
+        * sampling_frequency
+    ).astype(int)
+    bcg_onsets = bcg_onsets[(bcg_onsets >= 0) & (bcg_onsets < n_samples)]
+    beat_amplitudes = rng.normal(1, 0.1, size=len(bcg_onsets))
+    bcg = _place_template(bcg_onsets,
+                          bcg_template,
+                          beat_amplitudes,
+                          n_samples)
+    bcg_shift = _place_template(bcg_onsets,
+                                bcg_derivative,
+                                beat_amplitudes,
+                                n_samples)
+    bcg_gains = bcg_amplitude * rng.normal(0, 1, size=n_channels)
+    bcg_shift_gains = bcg_amplitude * rng.normal(0, 0.5, size=n_channels)
+    for channel in range(n_channels):
+        eeg_data[channel] += bcg_gains[channel] * bcg
+        eeg_data[channel] += bcg_shift_gains[channel] * bcg_shift
+
+    channel_names, montage_name = _eeg_channel_names(n_channels)
+    info = create_info(channel_names + ['ecg'],
+                       sampling_frequency,
+                       ch_types=['eeg'] * n_channels + ['ecg'])
+    raw = RawArray(np.vstack([eeg_data, ecg[np.newaxis]]), info)
+    if montage_name is not None:
+        raw.set_montage(mne.channels.make_standard_montage(montage_name),
+                        on_missing='ignore')
+    raw.set_annotations(mne.Annotations(
+        onset=volume_onsets / sampling_frequency,
+        duration=0,
+        description=[events_name] * n_volumes,
+    ))
+    return raw
+
+# Increment when the simulation changes to invalidate the cached datasets.
+DATASET_CACHE_VERSION = 3
+
+# The functions simulating the recordings of a DummyDataset.
+SIMULATORS = {
+    'eeg': simulate_eeg_data,
+    'light': simulate_light_eeg_data,
+    'eeg_fmri': simulate_eeg_fmri_data,
+}
+
+def _link_or_copy(source: str, destination: str) -> None:
+    """Hard link a file, or copy it across file systems."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def _simulate_and_export(
+    arguments: tuple[Path, str, str, Optional[int], dict]
+) -> Path:
+    """Simulate a recording and export it (process pool worker).
+
+    Args:
+        arguments (tuple): The file name, the export format, the name of the
+            simulator (see SIMULATORS), the seed and the simulation arguments.
+
+    Returns:
+        Path: The file name of the recording.
+    """
+    eeg_absolute_filename, fmt, simulator, seed, kwargs = arguments
+    raw = SIMULATORS[simulator](random_state=seed, **kwargs)
+
+    mne.export.export_raw(
+        fname=eeg_absolute_filename,
+        raw=raw,
+        fmt=fmt,
+        overwrite=True
+    )
+    return eeg_absolute_filename
+
 class DummyDataset:
     """A class to create a dummy BIDS dataset for EEG data.
     
@@ -280,12 +677,20 @@ class DummyDataset:
             setattr(self,lab_type, label_list)
             
         return self
-    def create_participants_metadata(self) -> 'DummyDataset':
+    def create_participants_metadata(
+        self,
+        random_state: Optional[Union[int, np.random.Generator]] = None,
+    ) -> 'DummyDataset':
         """Create participant metadata for the dataset.
 
+        Args:
+            random_state (int | np.random.Generator, optional): The seed or the
+                generator of the ages, sexes and handedness. Defaults to None.
+
         Returns:
             DummyDataset: The DummyDataset object.
         """
+        rng = np.random.default_rng(random_state)
         holder = {
             "participant_id": [],
             "sex": [],
@@ -293,10 +698,10 @@ class DummyDataset:
             "handedness": []
         }
         for subject_number in range(1, self.n_subjects + 1):
-            holder['age'].append(np.random.randint(18, 60))
-            holder['sex'].append(np.random.choice(['M', 'F']))
+            holder['age'].append(int(rng.integers(18, 60)))
+            holder['sex'].append(str(rng.choice(['M', 'F'])))
             holder['handedness'].append(
-                np.random.choice(['right', 'left', 'ambidextrous'])
+                str(rng.choice(['right', 'left', 'ambidextrous']))
             )
             holder['participant_id'].append(
                 self._generate_label(
@@ -482,10 +887,70 @@ class DummyDataset:
             else:
                 print("The tree was successfully removed.")
     
+    def _cache_key(
+        self,
+        fmt: str,
+        simulator: str,
+        random_state: int,
+        simulation_kwargs: dict,
+    ) -> str:
+        """Hash the parameters that define the content of the dataset."""
+        content = {
+            'version': DATASET_CACHE_VERSION,
+            'fmt': fmt,
+            'simulator': simulator,
+            'random_state': random_state,
+            'simulation_kwargs': simulation_kwargs,
+            'n_subjects': self.n_subjects,
+            'n_sessions': self.n_sessions,
+            'n_runs': self.n_runs,
+            'task': self.task,
+            'sessions_label_str': self.sessions_label_str,
+            'subjects_label_str': self.subjects_label_str,
+        }
+        serialized = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def _load_from_cache(self, cached_path: Path) -> 'DummyDataset':
+        """Link the files of a cached dataset in the bids path."""
+        shutil.copytree(cached_path,
+                        self.bids_path,
+                        copy_function=_link_or_copy,
+                        dirs_exist_ok=True)
+        self.participant_metadata = pd.read_csv(
+            self.bids_path.joinpath("participants.tsv"),
+            sep="\t"
+        )
+        self.subjects = self.participant_metadata['participant_id'].tolist()
+        with open(self.bids_path.joinpath("dataset_description.json")) as f:
+            self.dataset_description = json.load(f)
+        return self
+
+    def _store_in_cache(self, cached_path: Path) -> None:
+        """Copy the dataset in the cache, atomically."""
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = Path(tempfile.mkdtemp(prefix='.tmp-',
+                                               dir=cached_path.parent))
+        try:
+            shutil.copytree(self.bids_path, temporary_path, dirs_exist_ok=True)
+            os.replace(temporary_path, cached_path)
+        except OSError:
+            # Another process stored the same dataset in the meantime.
+            if not cached_path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
     def create_eeg_dataset(
         self,
         fmt: str = 'brainvision',
         light: bool = False,
+        n_jobs: int = 1,
+        random_state: Optional[int] = None,
+        cache_dir: Optional[Union[str, os.PathLike]] = None,
+        simulator: Optional[str] = None,
+        repetition_time: Optional[float] = None,
+        heart_rate: Optional[float] = None,
         **kwargs
     ) -> str:
         """Create temporary BIDS dataset.
@@ -493,33 +958,104 @@ class DummyDataset:
         Create a dummy BIDS dataset for EEG data with multiple subjects, sessions, 
         and runs.
 
+        The recordings are simulated and exported in a pool of n_jobs
+        processes. When a random_state is given the dataset, participants
+        metadata included, is deterministic and can be cached: the first
+        generation is copied in cache_dir and the next datasets created with
+        the same parameters are hard linked from it instead of being simulated
+        again. The files of a dataset loaded from the cache must not be
+        modified in place.
+
+        The 'eeg_fmri' simulator (see simulate_eeg_fmri_data) adds the
+        gradient and BCG artifacts and the TR locked volume markers of a
+        recording made inside the scanner, which the cleaning pipelines need.
+
         Args:
             fmt (str, optional): The format of the EEG data to simulate. 
                 Defaults to 'brainvision'.
+            light (bool, optional): Use simulate_light_eeg_data instead of
+                simulate_eeg_data, same as simulator='light'.
+                Defaults to False.
+            n_jobs (int, optional): The number of processes simulating the
+                recordings. Defaults to 1.
+            random_state (int, optional): The seed of the simulation. Each
+                recording gets its own seed drawn from it. Defaults to None.
+            cache_dir (str | os.PathLike, optional): The directory of the
+                generated datasets cache. Only used with a random_state.
+                Defaults to None.
+            simulator (str, optional): The function simulating the
+                recordings, 'eeg' (simulate_eeg_data), 'light'
+                (simulate_light_eeg_data) or 'eeg_fmri'
+                (simulate_eeg_fmri_data). Defaults to 'light' if light is
+                True, 'eeg' otherwise.
+            repetition_time (float, optional): The repetition time of the
+                fMRI sequence in seconds. Only used by the 'eeg_fmri'
+                simulator. Defaults to the one of simulate_eeg_fmri_data.
+            heart_rate (float, optional): The mean heart rate in beats per
+                minute. Only used by the 'eeg_fmri' simulator. Defaults to
+                the one of simulate_eeg_fmri_data.
+            **kwargs: The arguments of the simulation function.
 
         Returns:
             str: The path of the temporary BIDS dataset.
+
+        Raises:
+            ValueError: If the simulator is unknown, or if a repetition time or
+                a heart rate is given to a simulator without fMRI artifacts.
         """
+        if simulator is None:
+            simulator = 'light' if light else 'eeg'
+        if simulator not in SIMULATORS:
+            raise ValueError(
+                f"The simulator must be one of {', '.join(SIMULATORS)}."
+            )
+        fmri_kwargs = {
+            name: value
+            for name, value in [('repetition_time', repetition_time),
+                                ('heart_rate', heart_rate)]
+            if value is not None
+        }
+        if fmri_kwargs and simulator != 'eeg_fmri':
+            raise ValueError(
+                "The repetition time and the heart rate can only be set with "
+                "the 'eeg_fmri' simulator."
+            )
+        kwargs = {**kwargs, **fmri_kwargs}
+
+        cached_path = None
+        if cache_dir is not None and random_state is not None:
+            cached_path = Path(cache_dir).joinpath(
+                self._cache_key(fmt, simulator, random_state, kwargs)
+            )
+            if cached_path.is_dir():
+                self._load_from_cache(cached_path)
+                print(f"Temporary BIDS EEG dataset loaded from {cached_path}")
+                self.print_bids_tree()
+                return self
+
+        # The participants and the seeds of the recordings are drawn from the
+        # same generator, so the whole dataset follows the random_state.
+        rng = np.random.default_rng(random_state)
         path_list = self.create_modality_agnostic_dir()
         self._create_dataset_description()
-        self.create_participants_metadata()
-         
+        self.create_participants_metadata(random_state=rng)
+
+        # Define file names for EEG data files
+        if fmt == 'brainvision':
+            extension = '.vhdr'
+        elif fmt == 'edf':
+            extension = '.edf'
+        elif fmt == 'eeglab':
+            extension = '.set'
+        elif fmt == 'fif':
+            extension = '.fif'
+
+        eeg_absolute_filenames = list()
         for path in path_list:
             for run_number in range(1, self.n_runs + 1):
                 run_label = self._generate_label('runs', run_number)
                 eeg_directory = path.joinpath('eeg')
                 eeg_directory.mkdir(parents=True, exist_ok=True)
-
-                # Define file names for EEG data files
-                if fmt == 'brainvision':
-                    extension = '.vhdr'
-                elif fmt == 'edf':
-                    extension = '.edf'
-                elif fmt == 'eeglab':
-                    extension = '.set'
-                elif fmt == 'fif':
-                    extension = '.fif'
-                    
                 entities = self._extract_entities_from_path(path)
 
                 eeg_filename = "_".join([
@@ -531,25 +1067,35 @@ class DummyDataset:
                 ])
 
                 eeg_filename += extension
-                eeg_absolute_filename = eeg_directory.joinpath(eeg_filename)
-
-                if light:
-                    raw = simulate_light_eeg_data(**kwargs)
-                else:
-                    raw = simulate_eeg_data(**kwargs)
-
-                mne.export.export_raw(
-                    fname=eeg_absolute_filename,
-                    raw=raw,
-                    fmt=fmt,
-                    overwrite=True
+                eeg_absolute_filenames.append(
+                    eeg_directory.joinpath(eeg_filename)
                 )
 
-                # Create sidecar JSON file
-                self._create_sidecar_json(eeg_absolute_filename)
+        if random_state is None:
+            seeds = [None] * len(eeg_absolute_filenames)
+        else:
+            seeds = [
+                int(seed) for seed in
+                rng.integers(0, 2**31 - 1, size=len(eeg_absolute_filenames))
+            ]
+        jobs = [
+            (eeg_absolute_filename, fmt, simulator, seed, kwargs)
+            for eeg_absolute_filename, seed in zip(eeg_absolute_filenames,
+                                                   seeds)
+        ]
+        if n_jobs == 1:
+            list(map(_simulate_and_export, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(_simulate_and_export, jobs))
 
+        for eeg_absolute_filename in eeg_absolute_filenames:
+            # Create sidecar JSON file
+            self._create_sidecar_json(eeg_absolute_filename)
 
         self._save_participant_metadata()
+        if cached_path is not None:
+            self._store_in_cache(cached_path)
         print(f"Temporary BIDS EEG dataset created at {self.bids_path}")
         self.print_bids_tree()
         return self